@@ -0,0 +1,174 @@
+"""
+Per-process in-memory indexes of the distinct values behind the
+autocomplete views, so that a keystroke does not have to scan ActionKit's
+tables.
+
+Each index loads its values incrementally: it remembers the highest row
+id it has read, and a background thread periodically reads any newer
+rows. Values are kept in MySQL's case-insensitive order, with a trigram
+index for substring searches. Edited or deleted rows are only noticed
+when the index is rebuilt from scratch, every
+USERSEARCH_AUTOCOMPLETE_REBUILD seconds. Indexes are loaded from a read
+replica when one is configured.
+"""
+from array import array
+from bisect import bisect_left
+from django.conf import settings
+from django.db import connections
+import logging
+import threading
+import time
+
+from actionkit_usersearch import replicas
+
+log = logging.getLogger(__name__)
+
+def refresh_interval():
+    return getattr(settings, 'USERSEARCH_AUTOCOMPLETE_REFRESH', 60)
+
+def rebuild_interval():
+    return getattr(settings, 'USERSEARCH_AUTOCOMPLETE_REBUILD', 60 * 60 * 24)
+
+def trigrams(key):
+    return set(key[i:i + 3] for i in xrange(len(key) - 2))
+
+class ValueIndex(object):
+    """
+    A sorted array of distinct values for prefix lookups, plus a map from
+    each trigram to the values containing it for substring lookups.
+    """
+
+    def __init__(self):
+        self.sorted = ([], [])
+        self.by_id = []
+        self.grams = {}
+        self.seen = set()
+
+    def add(self, values):
+        """merges a batch of new values into the index"""
+        new = set(value for value in values if value and value not in self.seen)
+        if not new:
+            return
+        for value in new:
+            self.seen.add(value)
+            id = len(self.by_id)
+            self.by_id.append(value)
+            for gram in trigrams(value.lower()):
+                self.grams.setdefault(gram, array("I")).append(id)
+
+        ## timsort merges the two sorted runs in linear time; the new
+        ## arrays are swapped in together so readers never see a mix
+        merged = sorted(zip(*self.sorted) + [(value.lower(), value) for value in new])
+        self.sorted = ([key for key, value in merged],
+                       [value for key, value in merged])
+
+    def prefix(self, prefix, limit):
+        """the first `limit` values, in order, which start with `prefix`"""
+        prefix = prefix.lower()
+        keys, values = self.sorted
+        found = []
+        i = bisect_left(keys, prefix)
+        while i < len(keys) and len(found) < limit and keys[i].startswith(prefix):
+            found.append(values[i])
+            i += 1
+        return found
+
+    def substring(self, substring, limit):
+        """the first `limit` values, in order, which contain `substring`"""
+        substring = substring.lower()
+        grams = trigrams(substring)
+        if not grams:
+            ## too short to use the trigram index: walk the values in
+            ## order until we have enough
+            found = []
+            keys, values = self.sorted
+            for i in xrange(len(keys)):
+                if substring in keys[i]:
+                    found.append(values[i])
+                    if len(found) >= limit:
+                        break
+            return found
+        ## every match contains every trigram, so it is enough to check
+        ## the values under the rarest one
+        candidates = min((self.grams.get(gram, ()) for gram in grams), key=len)
+        by_id = self.by_id
+        found = [by_id[id] for id in candidates
+                 if substring in by_id[id].lower()]
+        found.sort(key=lambda value: (value.lower(), value))
+        return found[:limit]
+
+    def __len__(self):
+        return len(self.by_id)
+
+class AutocompleteSource(object):
+    """
+    Keeps a ValueIndex of one column up to date. `sql` must select
+    (id, value) rows with an id greater than the single parameter,
+    ordered by id. With no alias, it is read from a replica.
+    """
+    batch_size = 50000
+
+    def __init__(self, sql, alias=None):
+        self.sql = sql
+        self.alias = alias
+        self.index = ValueIndex()
+        self.watermark = 0
+        self.ready = False
+        self.refreshed_at = None
+        self.built_at = None
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+    def load(self, index, watermark, alias):
+        """reads rows past the watermark into the index"""
+        cursor = connections[alias].cursor()
+        while True:
+            cursor.execute(self.sql + " LIMIT %s", [watermark, self.batch_size])
+            rows = cursor.fetchall()
+            if not rows:
+                return watermark
+            index.add(row[1] for row in rows)
+            watermark = rows[-1][0]
+
+    def refresh(self):
+        try:
+            now = time.time()
+            if self.built_at is None or now - self.built_at > rebuild_interval():
+                index = ValueIndex()
+                watermark = replicas.read(
+                    lambda alias: self.load(index, 0, alias), self.alias)
+                self.index, self.watermark = index, watermark
+                self.built_at = now
+            else:
+                self.watermark = replicas.read(
+                    lambda alias: self.load(self.index, self.watermark, alias),
+                    self.alias)
+            self.refreshed_at = now
+            self.ready = True
+        except Exception:
+            log.exception("Could not refresh autocomplete index")
+            ## wait out the refresh interval before trying again
+            self.refreshed_at = time.time()
+        finally:
+            self.refreshing = False
+
+    def maybe_refresh(self):
+        """starts a background refresh if the index is due for one"""
+        if (self.refreshed_at is not None
+            and time.time() - self.refreshed_at < refresh_interval()):
+            return
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        thread = threading.Thread(target=self.refresh)
+        thread.daemon = True
+        thread.start()
+
+campuses = AutocompleteSource(
+    "SELECT id, value FROM core_userfield "
+    "WHERE name=\"campus\" AND id > %s ORDER BY id")
+
+sources = AutocompleteSource(
+    "SELECT id, source FROM core_user "
+    "WHERE id > %s ORDER BY id")
@@ -0,0 +1,777 @@
+"""
+Timing harness for the search compiler; run it with
+`manage.py usersearch_benchmark`.
+
+Benchmarks which execute SQL do so against the database alias named by
+the USERSEARCH_BENCHMARK_DATABASE setting (default "benchmark"), which
+they fill with synthetic ActionKit tables. Never point it at a real
+ActionKit database.
+"""
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import connections
+from multiprocessing.pool import ThreadPool
+import datetime
+import json
+import random
+import time
+import urllib
+
+## A typical search from the builder: three OR'd include groups mixing
+## plain column filters, multi-valued relations and a date.
+MULTI_GROUP_SEARCH = (
+    "include:0=country&include:0_country=United+States"
+    "&include:0=tag&include:0_tag=12"
+    "&include:0=created_after&include:0_created_after=2012-01-01"
+    "&include:1=campus&include:1_campus=Oberlin+College"
+    "&include:1=source&include:1_source=website"
+    "&include:2=action&include:2_action=101&include:2_action=102"
+    "&include:2=language&include:2_language=1"
+    "&user_name=smith")
+
+def timed(fn, iterations):
+    timings = []
+    for i in range(iterations):
+        start = time.time()
+        fn()
+        timings.append(time.time() - start)
+    return {
+        'iterations': iterations,
+        'total': sum(timings),
+        'mean': sum(timings) / iterations,
+        'min': min(timings),
+        'max': max(timings),
+        }
+
+def benchmark_database():
+    return getattr(settings, 'USERSEARCH_BENCHMARK_DATABASE', 'benchmark')
+
+def dummy_database():
+    """
+    the alias the 'compile' benchmark's baseline runs its doomed queries
+    on, as the 'dummy' database once was; an empty in-memory SQLite
+    database unless USERSEARCH_BENCHMARK_DUMMY_DATABASE names another
+    """
+    alias = getattr(settings, 'USERSEARCH_BENCHMARK_DUMMY_DATABASE', None)
+    if alias is None:
+        alias = "usersearch_dummy"
+        if alias not in connections.databases:
+            connections.databases[alias] = {
+                'ENGINE': "django.db.backends.sqlite3", 'NAME': ":memory:"}
+            connections.ensure_defaults(alias)
+    return alias
+
+def create_tables(alias, models):
+    connection = connections[alias]
+    cursor = connection.cursor()
+    existing = connection.introspection.table_names()
+    for model in models:
+        if model._meta.db_table in existing:
+            cursor.execute("DELETE FROM %s" % connection.ops.quote_name(
+                    model._meta.db_table))
+            continue
+        statements, pending = connection.creation.sql_create_model(
+            model, no_style(), set(models))
+        for statement in statements:
+            cursor.execute(statement)
+
+def _default_value(field, n):
+    internal_type = field.get_internal_type()
+    if internal_type in ("DateTimeField", "DateField"):
+        return datetime.datetime(2010, 1, 1) + datetime.timedelta(minutes=n)
+    if internal_type in ("CharField", "TextField", "EmailField", "SlugField"):
+        return "%s-%s" % (field.name, n)
+    if internal_type in ("BooleanField", "NullBooleanField"):
+        return False
+    if internal_type in ("DecimalField", "FloatField"):
+        return 0
+    return 1
+
+def insert_rows(alias, model, rows, batch_size=5000):
+    """
+    inserts rows (dicts of field name to value) into the model's table,
+    filling in any field the row leaves out with a placeholder value
+    """
+    connection = connections[alias]
+    qn = connection.ops.quote_name
+    fields = [field for field in model._meta.local_fields]
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(model._meta.db_table),
+        ", ".join(qn(field.column) for field in fields),
+        ", ".join(["%s"] * len(fields)))
+    cursor = connection.cursor()
+    batch = []
+    for n, row in enumerate(rows):
+        batch.append([row[field.attname] if field.attname in row
+                      else _default_value(field, n)
+                      for field in fields])
+        if len(batch) >= batch_size:
+            cursor.executemany(sql, batch)
+            batch = []
+    if batch:
+        cursor.executemany(sql, batch)
+
+def execute(alias, raw_sql):
+    from actionkit_usersearch import sql
+    cursor = connections[alias].cursor()
+    cursor.execute(*sql.executable(raw_sql))
+    return cursor.fetchall()
+
+def populate_userfields(alias, num_users, fields_per_user):
+    from actionkit.models import CorePhone, CoreUser, CoreUserField
+    create_tables(alias, [CoreUser, CorePhone, CoreUserField])
+    insert_rows(alias, CoreUser, (
+            {'id': i, 'subscription_status': 'subscribed'}
+            for i in xrange(1, num_users + 1)))
+    insert_rows(alias, CorePhone, (
+            {'id': i, 'user_id': i, 'normalized_phone': '555%07d' % i}
+            for i in xrange(1, num_users + 1)))
+    names = ['campus', 'skills', 'engagement_level', 'affiliation',
+             'student', 'shirt_size', 'referrer', 'notes']
+    def userfields():
+        n = 0
+        for user_id in xrange(1, num_users + 1):
+            for i in xrange(fields_per_user):
+                n += 1
+                yield {'id': n, 'parent_id': user_id,
+                       'name': random.choice(names),
+                       'value': "value-%s" % random.randint(1, 1000)}
+    insert_rows(alias, CoreUserField, userfields())
+
+def related_model(model, name):
+    """returns the model on the other side of a (possibly reverse) relation"""
+    field, field_model, direct, m2m = model._meta.get_field_by_name(name)
+    if direct:
+        return field.rel.to
+    return field.model
+
+def random_datetime():
+    return datetime.datetime(2008, 1, 1) + datetime.timedelta(
+        seconds=random.randint(0, 6 * 365 * 24 * 60 * 60))
+
+def populate_activity(alias, num_users, per_user):
+    """
+    fills in users along with actions, completed and failed orders, and
+    email opens, averaging `per_user` rows of each per user
+    """
+    from actionkit.models import CoreUser
+    CoreAction = related_model(CoreUser, "action")
+    CoreOrder = related_model(CoreUser, "orders")
+    CoreOpen = related_model(CoreUser, "email_opens")
+    create_tables(alias, [CoreUser, CoreAction, CoreOrder, CoreOpen])
+    insert_rows(alias, CoreUser, (
+            {'id': i, 'subscription_status': 'subscribed'}
+            for i in xrange(1, num_users + 1)))
+    def rows(make_row):
+        n = 0
+        for user_id in xrange(1, num_users + 1):
+            for i in xrange(random.randint(0, per_user * 2)):
+                n += 1
+                yield make_row(n, user_id)
+    insert_rows(alias, CoreAction, rows(lambda n, user_id: {
+                'id': n, 'user_id': user_id, 'page_id': random.randint(1, 50),
+                'status': 'complete', 'created_at': random_datetime()}))
+    insert_rows(alias, CoreOrder, rows(lambda n, user_id: {
+                'id': n, 'user_id': user_id, 'action_id': n,
+                'status': random.choice(['completed', 'completed', 'failed']),
+                'total': random.randint(5, 250), 'created_at': random_datetime()}))
+    insert_rows(alias, CoreOpen, rows(lambda n, user_id: {
+                'id': n, 'user_id': user_id, 'created_at': random_datetime()}))
+
+AGGREGATE_FILTERS = (
+    ('emails_opened', '3', '2011-01-01'),
+    ('more_actions', '2', '2011-01-01'),
+    ('donated_more', '100', '2011-01-01'),
+    ('donated_times', '2', '2011-01-01'),
+    )
+
+def legacy_aggregate_filter(users, item, value, since):
+    """
+    the annotate() form these filters were compiled to before they
+    became grouped semi-joins, kept here for comparison
+    """
+    from django.db.models import Count, Sum
+    if item == 'emails_opened':
+        return users.filter(email_opens__created_at__gte=since).annotate(
+            n=Count('email_opens', distinct=True)).filter(n__gte=int(value))
+    if item == 'more_actions':
+        return users.filter(action__created_at__gte=since).annotate(
+            n=Count('action', distinct=True)).filter(n__gt=int(value))
+    users = users.filter(orders__created_at__gte=since,
+                         orders__status='completed')
+    if item == 'donated_more':
+        return users.annotate(n=Sum('orders__total')).filter(n__gte=float(value))
+    return users.annotate(n=Count('orders', distinct=True)).filter(n__gte=int(value))
+
+def bench_aggregate_filters(options):
+    """
+    execution time of each aggregate filter, as an annotate() over the
+    joined fact table and as a grouped semi-join
+    """
+    from actionkit.models import CoreUser
+    from actionkit_usersearch import sql
+    from actionkit_usersearch.search_functions import QUERIES
+    alias = benchmark_database()
+    populate_activity(alias, options['users'], options['rows_per_user'])
+    base = CoreUser.objects.using("ak").order_by()
+    results = {}
+    for item, value, since in AGGREGATE_FILTERS:
+        legacy = legacy_aggregate_filter(
+            base, item, value, datetime.datetime(2011, 1, 1)).values_list("id")
+        legacy_sql, legacy_params = legacy.query.get_compiler(
+            using=legacy.db).as_sql()
+        users, human_query = QUERIES[item]['query_fn'](
+            base, QUERIES[item], [value], item,
+            {'since': since, 'istoggle': True})
+        semijoin_sql = sql.raw_sql_from_queryset(users.values_list("id"))
+        legacy_sql = sql.interpolate(legacy_sql, legacy_params)
+        results[item] = {
+            'annotate': timed(lambda: execute(alias, legacy_sql),
+                              options['iterations']),
+            'semijoin': timed(lambda: execute(alias, semijoin_sql),
+                              options['iterations']),
+            }
+    return results
+
+def bench_default_columns(options):
+    """
+    execution time of the default output columns, fetched with correlated
+    subqueries and with a pivot join, over a synthetic core_userfield
+    """
+    from actionkit.models import CoreUser
+    from actionkit_usersearch import planner
+    from actionkit_usersearch import sql
+    from actionkit_usersearch.search_functions import add_default_columns
+    alias = benchmark_database()
+    populate_userfields(alias, options['users'], options['fields_per_user'])
+    results = {}
+    for strategy in ("subquery", "join"):
+        column_planner = planner.ColumnPlanner(strategy)
+        users = add_default_columns(
+            CoreUser.objects.using("ak").order_by("id"), column_planner)
+        raw_sql = sql.raw_sql_from_queryset(users, column_planner.joins())
+        results[strategy] = timed(lambda: execute(alias, raw_sql),
+                                  options['iterations'])
+    return results
+
+def bench_export(options):
+    """
+    rows per second streamed out as CSV for the default output columns,
+    over a synthetic core_userfield
+    """
+    from actionkit.models import CoreUser
+    from actionkit_usersearch import planner
+    from actionkit_usersearch import sql
+    from actionkit_usersearch.export import csv_stream
+    from actionkit_usersearch.search_functions import add_default_columns
+    alias = benchmark_database()
+    populate_userfields(alias, options['users'], options['fields_per_user'])
+    column_planner = planner.ColumnPlanner(planner.column_strategy())
+    users = add_default_columns(
+        CoreUser.objects.using("ak").order_by("id"), column_planner)
+    raw_sql = sql.raw_sql_from_queryset(users, column_planner.joins())
+
+    def export():
+        for chunk in csv_stream(raw_sql, alias):
+            pass
+    results = timed(export, options['iterations'])
+    results['rows'] = options['users']
+    results['rows_per_second'] = options['users'] / results['mean']
+    return results
+
+def bench_bitmap(options):
+    """
+    set algebra on two random audiences of --users ids each, drawn from
+    an id space three times that size
+    """
+    from actionkit_usersearch.bitmap import IdBitmap
+    space = xrange(1, options['users'] * 3)
+    a = IdBitmap.from_ids(random.sample(space, options['users']))
+    b = IdBitmap.from_ids(random.sample(space, options['users']))
+    return {
+        'union': timed(lambda: a | b, options['iterations']),
+        'intersection': timed(lambda: a & b, options['iterations']),
+        'difference': timed(lambda: a - b, options['iterations']),
+        'cardinality': timed(lambda: len(a - b), options['iterations']),
+        'serialized_bytes': len(a.to_bytes()),
+        }
+
+def bench_rest_client(options):
+    """
+    create_report and run_report pairs per second against a stand-in
+    ActionKit with 10ms of latency per call: one fresh connection per
+    call in sequence, as actionkit.rest does, against the pooled client
+    """
+    from actionkit_usersearch.restclient import RestClient
+    from actionkit_usersearch.tests.standin import StandInActionKit
+    server = StandInActionKit().start()
+    calls = options['iterations']
+
+    def submit(client):
+        report = client.create_report("SELECT 1", "benchmark", "b", "b")
+        client.run_report(report['short_name'], "benchmark@example.com")
+
+    results = {}
+    try:
+        for name, concurrency in (("serial_fresh_connections", 1),
+                                  ("pooled", 8)):
+            client = RestClient(server.host, "user", "password",
+                                concurrency=concurrency, rate=0, retries=0)
+            if concurrency == 1:
+                ## forget each connection after use
+                client.pool.idle.put = lambda connection: connection.close()
+            pool = ThreadPool(concurrency)
+            server.connections = 0
+            start = time.time()
+            pool.map(lambda i: submit(client), range(calls))
+            elapsed = time.time() - start
+            pool.close()
+            results[name] = {
+                'submissions': calls,
+                'total': elapsed,
+                'per_second': calls / elapsed,
+                'connections_opened': server.connections,
+                }
+    finally:
+        server.shutdown()
+    return results
+
+def model_for_table(table):
+    """returns the installed model whose table is `table`"""
+    from django.db.models import get_models
+    for model in get_models():
+        if model._meta.db_table == table:
+            return model
+    raise LookupError("No model for table %s" % table)
+
+class BenchmarkRouter(object):
+    """sends queries for the given models to the benchmark database"""
+
+    def __init__(self, alias, models):
+        self.alias = alias
+        self.models = set(models)
+
+    def db_for_read(self, model, **hints):
+        if model in self.models:
+            return self.alias
+
+    db_for_write = db_for_read
+
+@contextmanager
+def routed(alias, models):
+    """
+    points the models at the benchmark database, for the local tables
+    (contact records, snapshots, geocoded zip codes) that search filters
+    read with their default managers
+    """
+    from django.db import router
+    benchmark_router = BenchmarkRouter(alias, models)
+    router.routers.insert(0, benchmark_router)
+    try:
+        yield
+    finally:
+        router.routers.remove(benchmark_router)
+
+SUITE_COUNTRIES = ("United States", "Canada", "Mexico", "United Kingdom")
+SUITE_STATES = ("NY", "CA", "TX", "MA", "IL")
+SUITE_CITIES = ("Brooklyn", "Oakland", "Austin", "Boston", "Chicago")
+SUITE_ZIPS = ("10001", "11211", "94612", "78701", "02139", "60601", "")
+SUITE_SOURCES = ("website", "import", "petition", "facebook", "event")
+SUITE_USERFIELDS = {
+    'campus': ["Campus %s" % i for i in range(200)],
+    'skills': ["Skill %s" % i for i in range(30)],
+    'engagement_level': ["1", "2", "3", "4", "5"],
+    'affiliation': ["Affiliation %s" % i for i in range(20)],
+    'student': ["yes"],
+    }
+SUITE_ORGANIZERS = ["organizer%s" % i for i in range(10)]
+
+def populate_member_file(alias, options):
+    """
+    fills the benchmark database with a synthetic member file: users
+    with locations and phones, userfields, pages with tags, actions with
+    actionfields, orders, email opens and contact records
+    """
+    from actionkit.models import ContactRecord, CoreUser
+    from actionkit_usersearch.bitmap import IdBitmap
+    from actionkit_usersearch.models import AudienceSnapshot, GeocodedZipcode
+    num_users = options['users']
+    per_user = options['rows_per_user']
+    num_pages = options['pages']
+    CoreLanguage = related_model(CoreUser, "lang")
+    CoreLocation = related_model(CoreUser, "location")
+    CorePhone = model_for_table("core_phone")
+    CoreUserField = model_for_table("core_userfield")
+    CoreAction = related_model(CoreUser, "action")
+    CoreActionField = model_for_table("core_actionfield")
+    CorePage = related_model(CoreAction, "page")
+    CorePageTag = model_for_table("core_page_tags")
+    CoreTag = model_for_table("core_tag")
+    CoreOrder = related_model(CoreUser, "orders")
+    CoreOpen = related_model(CoreUser, "email_opens")
+    Organizer = related_model(ContactRecord, "user")
+    create_tables(alias, [
+            CoreLanguage, CoreUser, CoreLocation, CorePhone, CoreUserField,
+            CoreTag, CorePage, CorePageTag, CoreAction, CoreActionField,
+            CoreOrder, CoreOpen, Organizer, ContactRecord,
+            AudienceSnapshot, GeocodedZipcode])
+
+    insert_rows(alias, CoreLanguage, (
+            {'id': i, 'name': "Language %s" % i} for i in range(1, 6)))
+    insert_rows(alias, CoreUser, (
+            {'id': i, 'subscription_status':
+                 random.choice(['subscribed', 'subscribed', 'unsubscribed']),
+             'first_name': "First%s" % i, 'last_name': "Last%s" % (i % 5000),
+             'email': "user%s@example.com" % i,
+             'country': random.choice(SUITE_COUNTRIES),
+             'state': random.choice(SUITE_STATES),
+             'city': random.choice(SUITE_CITIES),
+             'zip': random.choice(SUITE_ZIPS),
+             'source': random.choice(SUITE_SOURCES),
+             'lang_id': random.randint(1, 5),
+             'created_at': random_datetime()}
+            for i in xrange(1, num_users + 1)))
+    insert_rows(alias, CoreLocation, (
+            {'id': i, 'user_id': i,
+             'latitude': random.uniform(25, 49),
+             'longitude': random.uniform(-124, -67)}
+            for i in xrange(1, num_users + 1)))
+    insert_rows(alias, CorePhone, (
+            {'id': i, 'user_id': i, 'normalized_phone': '555%07d' % i}
+            for i in xrange(1, num_users + 1)))
+    def userfields():
+        n = 0
+        for user_id in xrange(1, num_users + 1):
+            for i in xrange(options['fields_per_user']):
+                n += 1
+                name = random.choice(SUITE_USERFIELDS.keys())
+                yield {'id': n, 'parent_id': user_id, 'name': name,
+                       'value': random.choice(SUITE_USERFIELDS[name])}
+    insert_rows(alias, CoreUserField, userfields())
+
+    insert_rows(alias, CoreTag, (
+            {'id': i, 'name': "tag%s" % i} for i in range(1, 11)))
+    insert_rows(alias, CorePage, (
+            {'id': i, 'title': "Page %s" % i, 'name': "page-%s" % i}
+            for i in range(1, num_pages + 1)))
+    insert_rows(alias, CorePageTag, (
+            {'id': i, 'page_id': i, 'tag_id': i % 10 + 1}
+            for i in range(1, num_pages + 1)))
+
+    def rows(make_row):
+        n = 0
+        for user_id in xrange(1, num_users + 1):
+            for i in xrange(random.randint(0, per_user * 2)):
+                n += 1
+                yield make_row(n, user_id)
+    insert_rows(alias, CoreAction, rows(lambda n, user_id: {
+                'id': n, 'user_id': user_id,
+                'page_id': random.randint(1, num_pages),
+                'status': 'complete', 'created_at': random_datetime()}))
+    cursor = connections[alias].cursor()
+    cursor.execute("SELECT MAX(`id`) FROM `core_action`")
+    num_actions = cursor.fetchone()[0] or 0
+    insert_rows(alias, CoreActionField, (
+            {'id': n, 'parent_id': n, 'name': "comment",
+             'value': "comment %s" % n}
+            for n in xrange(1, num_actions + 1, 3)))
+    insert_rows(alias, CoreOrder, rows(lambda n, user_id: {
+                'id': n, 'user_id': user_id,
+                'action_id': random.randint(1, max(num_actions, 1)),
+                'status': random.choice(['completed', 'completed', 'failed']),
+                'total': random.randint(5, 250), 'created_at': random_datetime()}))
+    insert_rows(alias, CoreOpen, rows(lambda n, user_id: {
+                'id': n, 'user_id': user_id, 'created_at': random_datetime()}))
+
+    insert_rows(alias, Organizer, (
+            {'id': i + 1, 'username': username}
+            for i, username in enumerate(SUITE_ORGANIZERS)))
+    insert_rows(alias, ContactRecord, rows(lambda n, user_id: {
+                'id': n, 'akid': user_id,
+                'user_id': random.randint(1, len(SUITE_ORGANIZERS)),
+                'completed_at': random_datetime()}))
+
+    ## so the zip radius filter never needs a remote geocoder
+    GeocodedZipcode.objects.using(alias).create(
+        zipcode="10001", latitude=40.7506, longitude=-73.9971,
+        source="benchmark")
+    snapshot = AudienceSnapshot(id=1, name="benchmark", query_string="",
+                                human_query="")
+    snapshot.set_bitmap(IdBitmap.from_ids(
+            random.sample(xrange(1, num_users + 1), num_users // 10)))
+    snapshot.save(using=alias)
+    return [ContactRecord, AudienceSnapshot, GeocodedZipcode]
+
+## a value for every filter in QUERIES, plus the paired fields that go
+## with some of them
+SUITE_FILTERS = {
+    'country': ["United States"],
+    'region': ["NY"],
+    'state': ["NY"],
+    'city': ["Brooklyn"],
+    'action': ["1", "2"],
+    'source': ["website"],
+    'tag': ["3"],
+    'campus': ["Campus 7"],
+    'skills': ["Skill 3"],
+    'engagement_level': ["4"],
+    'student': ["yes"],
+    'affiliation': ["Affiliation 2"],
+    'language': ["1"],
+    'created_before': ["01/01/2010"],
+    'created_after': ["01/01/2012"],
+    'zipcode': ["10001"],
+    'contacted_since': ["01/01/2012"],
+    'contacted_by': ["organizer3"],
+    'emails_opened': ["3"],
+    'more_actions': ["2"],
+    'donated_more': ["100"],
+    'donated_times': ["2"],
+    'snapshot': ["1"],
+    }
+
+SUITE_PAIRED = {
+    'zipcode': ("zipcode__distance", "25"),
+    'contacted_since': ("contacted_since__contacted_by", "organizer3"),
+    'emails_opened': ("emails_opened__since", "01/01/2011"),
+    'more_actions': ("more_actions__since", "01/01/2011"),
+    'donated_more': ("donated_more__since", "01/01/2011"),
+    'donated_times': ("donated_times__since", "01/01/2011"),
+    }
+
+def filter_querystring(item, group=0, istoggle=True):
+    """the querystring of a search for one filter in one include group"""
+    params = [("include:%s" % group, item)]
+    params.extend(("include:%s_%s" % (group, item), value)
+                  for value in SUITE_FILTERS[item])
+    if item in SUITE_PAIRED:
+        paired, value = SUITE_PAIRED[item]
+        params.append(("include:%s_%s" % (group, paired), value))
+    if not istoggle:
+        params.append(("include:%s_%s_istoggle" % (group, item), "0"))
+    return urllib.urlencode(params)
+
+## a SearchColumn for every column type
+SUITE_COLUMNS = (
+    ('userfield', 'campus', None),
+    ('actionfield', 'comment', None),
+    ('actionfield', 'comment', {'page_ids': [1, 2, 3]}),
+    ('num_actions', 'num_actions', None),
+    ('num_donations', 'num_donations', None),
+    ('total_donations', 'total_donations', None),
+    ('total_donations', 'total_donations', {'tag': "tag3"}),
+    ('yearly_donations', 'donations_2012', {'year': 2012}),
+    )
+
+def suite_search(alias, querystring, iterations):
+    """compile and execution times of the report query for a search"""
+    from actionkit_usersearch.search_functions import _build_query
+    raw_sql = _build_query(querystring).raw_sql
+    return {
+        'compile': timed(lambda: _build_query(querystring), iterations),
+        'execute': timed(lambda: execute(alias, raw_sql), iterations),
+        'rows': len(execute(alias, raw_sql)),
+        }
+
+def bench_suite(options):
+    """
+    compile and execution times over a synthetic member file for every
+    filter (included and excluded), multi-group searches, and every
+    column type under each column strategy
+    """
+    from actionkit.models import CoreUser
+    from actionkit_usersearch import planner
+    from actionkit_usersearch import sql
+    from actionkit_usersearch.models import SearchColumn
+    from actionkit_usersearch.search_functions import QUERIES
+    from django.test.utils import override_settings
+    alias = benchmark_database()
+    iterations = options['iterations']
+    results = {'filters': {}, 'groups': {}, 'columns': {}}
+    ## staged id sets would otherwise be written to the real staging
+    ## database
+    with override_settings(USERSEARCH_STAGING_DATABASE=None):
+        with routed(alias, populate_member_file(alias, options)):
+            for item in sorted(QUERIES):
+                results['filters'][item] = dict(
+                    (istoggle and "include" or "exclude",
+                     suite_search(alias, filter_querystring(item, 0, istoggle),
+                                  iterations))
+                    for istoggle in (True, False))
+
+            items = ['country', 'campus', 'action', 'donated_more',
+                     'contacted_by', 'zipcode']
+            for groups in (1, 2, 4, 6):
+                querystring = "&".join(
+                    filter_querystring(item, group)
+                    for group, item in enumerate(items[:groups]))
+                results['groups'][groups] = suite_search(
+                    alias, querystring, iterations)
+            results['groups']['builder_sample'] = suite_search(
+                alias, MULTI_GROUP_SEARCH, iterations)
+
+    base = CoreUser.objects.using("ak").order_by("id")
+    for column_type, name, parameters in SUITE_COLUMNS:
+        column = SearchColumn(name=name, type=column_type,
+                              parameters=parameters and json.dumps(parameters))
+        key = column_type
+        if parameters:
+            key = "%s %s" % (column_type, json.dumps(parameters))
+        results['columns'][key] = {}
+        for strategy in ("subquery", "join"):
+            def compile_column():
+                column_planner = planner.ColumnPlanner(strategy)
+                users = column_planner.apply(base, [column.load()])
+                return sql.raw_sql_from_queryset(users, column_planner.joins())
+            raw_sql = compile_column()
+            results['columns'][key][strategy] = {
+                'compile': timed(compile_column, iterations),
+                'execute': timed(lambda: execute(alias, raw_sql), iterations),
+                }
+    return results
+
+## the join lookups the multi-valued filters were compiled to before
+## they became EXISTS subqueries, kept here for comparison
+LEGACY_MULTIVALUED = {
+    'action': {'query': "action__page__id"},
+    'tag': {'query': "action__page__pagetags__tag__id"},
+    'campus': {'query': "fields__value", 'extra': {"fields__name": "campus"}},
+    'skills': {'query': "fields__value", 'extra': {"fields__name": "skills"}},
+    }
+
+def bench_multivalued_filters(options):
+    """
+    execution time and result size of each multi-valued filter,
+    included and excluded, as a join with DISTINCT (or Django's nested
+    NOT IN) and as a correlated EXISTS / NOT EXISTS, over a synthetic
+    member file
+    """
+    from actionkit.models import CoreUser
+    from actionkit_usersearch import sql
+    from actionkit_usersearch.search_functions import QUERIES
+    from actionkit_usersearch.search_functions import make_default_user_query
+    alias = benchmark_database()
+    iterations = options['iterations']
+    populate_member_file(alias, options)
+    base = CoreUser.objects.using("ak").order_by()
+    results = {}
+    for item in sorted(LEGACY_MULTIVALUED):
+        for istoggle in (True, False):
+            values = SUITE_FILTERS[item]
+            extra_data = {'istoggle': istoggle}
+            legacy, human_query = make_default_user_query(
+                base, LEGACY_MULTIVALUED[item], values, item, extra_data)
+            exists, human_query = QUERIES[item]['query_fn'](
+                base, QUERIES[item], values, item, extra_data)
+            compiled = {
+                'join': sql.raw_sql_from_queryset(
+                    legacy.values_list("id", flat=True).distinct()),
+                'exists': sql.raw_sql_from_queryset(
+                    exists.values_list("id", flat=True)),
+                }
+            result = {}
+            for form, raw_sql in compiled.items():
+                result[form] = timed(lambda: execute(alias, raw_sql),
+                                     iterations)
+                result[form]['rows'] = len(execute(alias, raw_sql))
+                result[form]['sql_length'] = len(raw_sql)
+            results["%s %s" % (item, istoggle and "include" or "exclude")] = result
+    return results
+
+def dummy_raw_sql_from_queryset(alias):
+    """
+    the way raw_sql_from_queryset got a search's SQL before it was
+    compiled in-process: run the query on a database without
+    ActionKit's tables, and read the SQL back out of the debug log of
+    the query that failed
+    """
+    from actionkit_usersearch import sql
+    def raw_sql_from_queryset(queryset, joins=()):
+        connection = connections[alias]
+        connection.use_debug_cursor = True
+        compiled, params = sql.compile_queryset(queryset, joins)
+        try:
+            connection.cursor().execute(compiled, params)
+        except Exception:
+            actual_sql = connection.queries[-1]['sql']
+            return actual_sql.replace(sql.USER_IDS_SENTINEL,
+                                      sql.USER_IDS_PLACEHOLDER)
+        finally:
+            ## each search the builder compiled connected anew
+            connection.close()
+        raise AssertionError("Dummy query was expected to fail")
+    return raw_sql_from_queryset
+
+def bench_compile(options):
+    """
+    per-call latency of build_query for a multi-group search, compiled
+    in-process and, as the baseline, through a dummy database
+    """
+    from actionkit_usersearch import sql
+    from actionkit_usersearch.search_functions import build_query
+    from actionkit_usersearch.search_functions import invalidate_query_cache
+    def run():
+        invalidate_query_cache()
+        build_query(MULTI_GROUP_SEARCH)
+    results = {'in_process': timed(run, options['iterations'])}
+    in_process = sql.raw_sql_from_queryset
+    sql.raw_sql_from_queryset = dummy_raw_sql_from_queryset(dummy_database())
+    try:
+        results['dummy_database'] = timed(run, options['iterations'])
+    finally:
+        sql.raw_sql_from_queryset = in_process
+    return results
+
+def bench_compile_cached(options):
+    """per-call latency of build_query when the search is already cached"""
+    from actionkit_usersearch.search_functions import build_query
+    build_query(MULTI_GROUP_SEARCH)
+    return timed(lambda: build_query(MULTI_GROUP_SEARCH), options['iterations'])
+
+def bench_zip_radius(options):
+    """latency of a 50-mile zip code radius lookup in the centroid grid"""
+    from actionkit_usersearch.zipcodes import get_grid
+    grid = get_grid()
+    return timed(lambda: grid.within(40.7, -74.0, 50), options['iterations'])
+
+def bench_autocomplete(options):
+    """
+    latency of prefix and substring lookups in an autocomplete index of
+    1M distinct values
+    """
+    from actionkit_usersearch.autocomplete import ValueIndex
+    random.seed(0)
+    words = ["state", "university", "college", "community", "north",
+             "south", "east", "west", "technical", "institute", "saint"]
+    index = ValueIndex()
+    batch = []
+    for i in xrange(1000000):
+        batch.append("%s %s %s" % (random.choice(words).title(),
+                                   random.choice(words).title(), i))
+        if len(batch) == 100000:
+            index.add(batch)
+            batch = []
+    index.add(batch)
+    return {
+        'prefix': timed(lambda: index.prefix("north sou", 10),
+                        options['iterations']),
+        'substring': timed(lambda: index.substring("ege 4242", 10),
+                           options['iterations']),
+        'short_substring': timed(lambda: index.substring("99", 10),
+                                 options['iterations']),
+        }
+
+BENCHMARKS = {
+    'aggregate_filters': bench_aggregate_filters,
+    'bitmap': bench_bitmap,
+    'compile': bench_compile,
+    'compile_cached': bench_compile_cached,
+    'autocomplete': bench_autocomplete,
+    'default_columns': bench_default_columns,
+    'export': bench_export,
+    'multivalued_filters': bench_multivalued_filters,
+    'rest_client': bench_rest_client,
+    'suite': bench_suite,
+    'zip_radius': bench_zip_radius,
+    }
@@ -0,0 +1,288 @@
+"""
+Compressed sets of user ids, in the style of roaring bitmaps.
+
+Ids are split into chunks by their high 16 bits. A sparse chunk keeps
+its low 16 bits in a sorted array of shorts; a dense chunk (more than
+4096 members, where the array would outgrow a fixed 8KB bitmap) keeps
+them as the bits of one long integer, so that set algebra on it runs as
+a single C-level bitwise operation.
+"""
+from array import array
+from binascii import hexlify, unhexlify
+import struct
+
+ARRAY_MAX = 4096
+CHUNK_BYTES = 1 << 13
+
+MAGIC = "UIDB"
+VERSION = 1
+
+## the positions of the set bits in each possible byte
+BYTE_BITS = [tuple(bit for bit in range(8) if byte & (1 << bit))
+             for byte in range(256)]
+
+## maps each hex digit to its number of set bits
+HEX_BITS = "".join(
+    str(bin(int(chr(i), 16)).count("1")) if chr(i) in "0123456789abcdef"
+    else "0" for i in range(256))
+
+def _bits_to_int(bits):
+    """a bytearray of 8192 little-endian bytes as a long"""
+    bits.reverse()
+    return int(hexlify(bits), 16)
+
+def _int_to_bits(n):
+    """a long as a bytearray of 8192 little-endian bytes"""
+    bits = bytearray(unhexlify("%0*x" % (CHUNK_BYTES * 2, n)))
+    bits.reverse()
+    return bits
+
+def _array_to_int(values):
+    bits = bytearray(CHUNK_BYTES)
+    for value in values:
+        bits[value >> 3] |= 1 << (value & 7)
+    return _bits_to_int(bits)
+
+def _int_to_array(n):
+    values = array("H")
+    for i, byte in enumerate(_int_to_bits(n)):
+        if byte:
+            base = i << 3
+            values.extend(base + bit for bit in BYTE_BITS[byte])
+    return values
+
+def _popcount(n):
+    ## bin() is slow for large longs in Python 2; counting the hex
+    ## digits of each weight is several times faster
+    digits = ("%x" % n).translate(HEX_BITS)
+    return (digits.count("1") + 2 * digits.count("2")
+            + 3 * digits.count("3") + 4 * digits.count("4"))
+
+def _cardinality(chunk):
+    if isinstance(chunk, array):
+        return len(chunk)
+    return _popcount(chunk)
+
+def _as_int(chunk):
+    if isinstance(chunk, array):
+        return _array_to_int(chunk)
+    return chunk
+
+def _normalize(chunk):
+    """picks the smaller representation for a chunk; None if it is empty"""
+    if isinstance(chunk, array):
+        if len(chunk) > ARRAY_MAX:
+            return _array_to_int(chunk)
+        return chunk or None
+    if not chunk:
+        return None
+    if _popcount(chunk) <= ARRAY_MAX:
+        return _int_to_array(chunk)
+    return chunk
+
+def _filter_array(values, n, keep):
+    """the values whose bit in n is (keep=True) or is not set"""
+    bits = _int_to_bits(n)
+    return array("H", (value for value in values
+                       if bool(bits[value >> 3] & (1 << (value & 7))) == keep))
+
+def _union(a, b):
+    if isinstance(a, array) and isinstance(b, array):
+        return array("H", sorted(set(a).union(b)))
+    return _as_int(a) | _as_int(b)
+
+def _intersection(a, b):
+    if isinstance(a, array) and isinstance(b, array):
+        return array("H", sorted(set(a).intersection(b)))
+    if isinstance(a, array):
+        return _filter_array(a, b, True)
+    if isinstance(b, array):
+        return _filter_array(b, a, True)
+    return a & b
+
+def _difference(a, b):
+    if isinstance(a, array) and isinstance(b, array):
+        return array("H", sorted(set(a).difference(b)))
+    if isinstance(a, array):
+        return _filter_array(a, b, False)
+    return a & ~_as_int(b)
+
+def _trim(chunk):
+    """
+    normalizes array chunks, but leaves dense results as bitmaps: counting
+    their bits costs far more than the bitwise operation that made them,
+    so that is put off until the bitmap is compacted
+    """
+    if isinstance(chunk, array):
+        return _normalize(chunk)
+    return chunk or None
+
+class IdBitmap(object):
+    """
+    An immutable set of non-negative 32-bit integers. Combine bitmaps with
+    |, & and -, or the equivalent union, intersection and difference.
+    """
+
+    def __init__(self, chunks=None):
+        self.chunks = chunks or {}
+        self._len = None
+
+    @classmethod
+    def from_ids(cls, ids):
+        grouped = {}
+        for id in ids:
+            grouped.setdefault(id >> 16, []).append(id & 0xFFFF)
+        chunks = {}
+        for key, values in grouped.iteritems():
+            chunks[key] = _normalize(array("H", sorted(set(values))))
+        return cls(chunks)
+
+    def compact(self):
+        """returns the same set with every chunk in its smaller form"""
+        chunks = {}
+        for key, chunk in self.chunks.iteritems():
+            chunk = _normalize(chunk)
+            if chunk is not None:
+                chunks[key] = chunk
+        return IdBitmap(chunks)
+
+    def _combine(self, other, fn, keys):
+        chunks = {}
+        for key in keys:
+            a = self.chunks.get(key)
+            b = other.chunks.get(key)
+            if a is None:
+                chunk = b
+            elif b is None:
+                chunk = a
+            else:
+                chunk = _trim(fn(a, b))
+            if chunk is not None:
+                chunks[key] = chunk
+        return IdBitmap(chunks)
+
+    def union(self, other):
+        return self._combine(other, _union,
+                             set(self.chunks).union(other.chunks))
+
+    def intersection(self, other):
+        return self._combine(other, _intersection,
+                             set(self.chunks).intersection(other.chunks))
+
+    def difference(self, other):
+        chunks = {}
+        for key, a in self.chunks.iteritems():
+            b = other.chunks.get(key)
+            chunk = a if b is None else _trim(_difference(a, b))
+            if chunk is not None:
+                chunks[key] = chunk
+        return IdBitmap(chunks)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+    def __len__(self):
+        if self._len is None:
+            self._len = sum(_cardinality(chunk)
+                            for chunk in self.chunks.itervalues())
+        return self._len
+
+    def __contains__(self, id):
+        chunk = self.chunks.get(id >> 16)
+        if chunk is None:
+            return False
+        low = id & 0xFFFF
+        if isinstance(chunk, array):
+            values = chunk
+            lo, hi = 0, len(values)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if values[mid] < low:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo < len(values) and values[lo] == low
+        return bool((chunk >> low) & 1)
+
+    def __iter__(self):
+        for key in sorted(self.chunks):
+            chunk = self.chunks[key]
+            if not isinstance(chunk, array):
+                chunk = _int_to_array(chunk)
+            base = key << 16
+            for low in chunk:
+                yield base + low
+
+    def __eq__(self, other):
+        return (isinstance(other, IdBitmap)
+                and self.compact().chunks == other.compact().chunks)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def batches(self, size):
+        """yields the ids in order, as lists of at most `size` ids"""
+        batch = []
+        for id in self:
+            batch.append(id)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def to_bytes(self):
+        """
+        serializes the bitmap as a header followed by, for each chunk in
+        order, its key, kind, length and little-endian contents
+        """
+        chunks = self.compact().chunks
+        parts = [MAGIC, struct.pack("<BI", VERSION, len(chunks))]
+        for key in sorted(chunks):
+            chunk = chunks[key]
+            if isinstance(chunk, array):
+                values = array("H", chunk)
+                if struct.pack("=H", 1) != struct.pack("<H", 1):
+                    values.byteswap()
+                payload = values.tostring()
+                parts.append(struct.pack("<HBI", key, 0, len(chunk)))
+            else:
+                payload = str(_int_to_bits(chunk))
+                parts.append(struct.pack("<HBI", key, 1, len(payload)))
+            parts.append(payload)
+        return "".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        if data[:4] != MAGIC:
+            raise ValueError("Not a serialized IdBitmap")
+        version, count = struct.unpack_from("<BI", data, 4)
+        if version != VERSION:
+            raise ValueError("Unsupported IdBitmap version %s" % version)
+        offset = 4 + struct.calcsize("<BI")
+        header = struct.calcsize("<HBI")
+        chunks = {}
+        for i in range(count):
+            key, kind, length = struct.unpack_from("<HBI", data, offset)
+            offset += header
+            if kind == 0:
+                values = array("H")
+                values.fromstring(data[offset:offset + length * 2])
+                if struct.pack("=H", 1) != struct.pack("<H", 1):
+                    values.byteswap()
+                chunks[key] = values
+                offset += length * 2
+            else:
+                chunks[key] = _bits_to_int(bytearray(data[offset:offset + length]))
+                offset += length
+        return cls(chunks)
+
+    def save(self, path):
+        with open(path, "wb") as fp:
+            fp.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as fp:
+            return cls.from_bytes(fp.read())
@@ -0,0 +1,45 @@
+"""
+Submits many searches at once, for instance one audience per state,
+building each one and running its report over the pooled REST client.
+"""
+from django.db import connections
+from multiprocessing.pool import ThreadPool
+import logging
+
+from actionkit_usersearch import reports
+from actionkit_usersearch import restclient
+from actionkit_usersearch.search_functions import build_query
+
+log = logging.getLogger(__name__)
+
+def submit_search(querystring, email_to, client):
+    """returns a dict describing the submitted report, or the error"""
+    result = {'query_string': querystring}
+    try:
+        query = build_query(querystring)
+        report, task_id, merged = reports.run_report(query, email_to, client)
+        result.update(report_id=report.report_id,
+                      short_name=report.short_name,
+                      task_id=task_id,
+                      merged=merged)
+    except Exception, e:
+        log.exception("Could not submit search %r", querystring)
+        result['error'] = str(e)
+    finally:
+        for connection in connections.all():
+            connection.close()
+    return result
+
+def submit_searches(querystrings, email_to, client=None):
+    """
+    submits every search, as many at a time as the client has
+    connections, and returns a result dict for each, in order
+    """
+    client = client or restclient.get_client()
+    pool = ThreadPool(client.pool.size)
+    try:
+        return pool.map(lambda querystring: submit_search(
+                querystring, email_to, client), querystrings)
+    finally:
+        pool.close()
+        pool.join()
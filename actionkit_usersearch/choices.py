@@ -0,0 +1,147 @@
+"""
+Precomputed choice lists for the search builder, kept in the shared
+Django cache for USERSEARCH_CHOICES_REFRESH seconds.
+
+Every list is stored already serialized to JSON (and gzipped, for the
+lists that are always sent whole) along with an ETag and modification
+time, so that a request only has to check headers and copy bytes. The
+lists are loaded from a read replica when one is configured.
+"""
+from actionkit.models import CorePage, CoreUser
+from cStringIO import StringIO
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.http import HttpResponseNotModified
+from django.utils.http import http_date
+from django.utils.http import parse_http_date_safe
+import gzip
+import hashlib
+import json
+import time
+
+from actionkit_usersearch import replicas
+
+CACHE_PREFIX = "actionkit_usersearch.choices."
+
+def refresh_interval():
+    return getattr(settings, 'USERSEARCH_CHOICES_REFRESH', 60 * 60)
+
+def load_countries(alias):
+    countries = CoreUser.objects.using(alias).values_list(
+        "country", flat=True).distinct().order_by("country")
+    return [(i, i) for i in countries]
+
+def load_cities(alias):
+    cities = CoreUser.objects.using(alias).values_list(
+        "city", flat=True).distinct().order_by("city")
+    return [(i, i) for i in cities]
+
+def load_pages(alias):
+    pages = CorePage.objects.using(alias).all().order_by("title")
+    return [(i.id, str(i)) for i in pages]
+
+def _group_by_country(field):
+    def load(alias):
+        rows = CoreUser.objects.using(alias).values(
+            "country", field).distinct().order_by("country", field)
+        groups = {}
+        for row in rows:
+            groups.setdefault(row['country'], []).append(row[field])
+        return groups
+    return load
+
+LISTS = {
+    'countries': load_countries,
+    'cities': load_cities,
+    'pages': load_pages,
+    }
+
+GROUPED_LISTS = {
+    'regions': _group_by_country("region"),
+    'states': _group_by_country("state"),
+    }
+
+def gzip_bytes(data):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as fp:
+        fp.write(data)
+    return buf.getvalue()
+
+def etag(data):
+    return '"%s"' % hashlib.sha1(data).hexdigest()
+
+def _build(name):
+    if name in LISTS:
+        body = json.dumps(replicas.read(LISTS[name]))
+        return {
+            'body': body,
+            'gzip': gzip_bytes(body),
+            'etag': etag(body),
+            'last_modified': int(time.time()),
+            }
+    groups = dict((key, json.dumps(values))
+                  for key, values in replicas.read(GROUPED_LISTS[name]).items())
+    return {
+        'groups': groups,
+        'etag': etag(repr(sorted(groups.items()))),
+        'last_modified': int(time.time()),
+        }
+
+def get(name):
+    """returns the cached entry for the named choice list, building it if needed"""
+    entry = cache.get(CACHE_PREFIX + name)
+    if entry is None:
+        entry = _build(name)
+        cache.set(CACHE_PREFIX + name, entry, refresh_interval())
+    return entry
+
+def invalidate(*names):
+    """drops the named choice lists (or all of them) from the cache"""
+    names = names or (LISTS.keys() + GROUPED_LISTS.keys())
+    cache.delete_many([CACHE_PREFIX + name for name in names])
+
+def _not_modified(request, tag, last_modified):
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None:
+        tags = [i.strip() for i in if_none_match.split(",")]
+        return tag in tags or "*" in tags
+    if_modified_since = parse_http_date_safe(
+        request.META.get("HTTP_IF_MODIFIED_SINCE") or "")
+    return if_modified_since is not None and last_modified <= if_modified_since
+
+def respond(request, body, tag, last_modified, compressed=None):
+    """
+    returns the JSON body, or a 304 if the client already has it; the
+    precompressed body is sent instead to clients which accept gzip
+    """
+    if _not_modified(request, tag, last_modified):
+        response = HttpResponseNotModified()
+    elif (compressed is not None
+          and "gzip" in request.META.get("HTTP_ACCEPT_ENCODING", "")):
+        response = HttpResponse(compressed, content_type="application/json")
+        response['Content-Encoding'] = "gzip"
+    else:
+        response = HttpResponse(body, content_type="application/json")
+    response['ETag'] = tag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Vary'] = "Accept-Encoding"
+    return response
+
+def list_response(request, name):
+    entry = get(name)
+    return respond(request, entry['body'], entry['etag'],
+                   entry['last_modified'], entry['gzip'])
+
+def grouped_response(request, name, keys):
+    """
+    responds with the named grouped list, sliced down to the requested
+    keys, in the same shape as {key: [values]}
+    """
+    entry = get(name)
+    groups = entry['groups']
+    keys = sorted(set(key for key in keys if key in groups))
+    body = "{%s}" % ", ".join(
+        "%s: %s" % (json.dumps(key), groups[key]) for key in keys)
+    tag = etag(entry['etag'] + repr(keys))
+    return respond(request, body, tag, entry['last_modified'])
@@ -1,6 +1,8 @@
 from django.utils.translation import ugettext_lazy as _
 import json
 
+from actionkit_usersearch.planner import year_range
+
 TYPE_CHOICES = {
     "userfield": (_("Userfield Value"), 
                   "actionkit_usersearch.columns.UserField"),
@@ -30,6 +32,9 @@ class UserField(object):
                             )},
                               select_params=[self.name])
 
+    def plan(self, queryset, planner):
+        return queryset.extra(select={self.name: planner.userfield(self.name)})
+
 class ActionField(object):
 
     def __init__(self, data):
@@ -54,15 +59,16 @@ class ActionField(object):
                    "JOIN `core_action` "
                    "ON `core_action`.`id`=`core_actionfield`.`parent_id` "
                    "WHERE `core_action`.`user_id`=`core_user`.`id` "
-                   "AND (")
-            sql_or = []
-            for page in self.pages:
-                sql_or.append("`core_action`.`page_id` = %s")
-            sql += " OR ".join(sql_or)
-            sql += (") AND `core_actionfield`.`name`=%s LIMIT 1")
+                   "AND `core_action`.`page_id` IN (%s) "
+                   "AND `core_actionfield`.`name`=%%s LIMIT 1"
+                   ) % ", ".join(["%s"] * len(self.pages))
             return queryset.extra(select={self.name: sql},
                                   select_params=self.pages + [self.name])
 
+    def plan(self, queryset, planner):
+        return queryset.extra(select={
+                self.name: planner.actionfield(self.name, self.pages)})
+
 class YearlyDonations(object):
     def __init__(self, data):
         self.name = data.name
@@ -73,10 +79,15 @@ class YearlyDonations(object):
                     self.name: ("SELECT SUM(`total`) FROM `core_order` "
                                 "WHERE `core_order`.`user_id`=`core_user`.`id` "
                                 "AND `core_order`.`status`=\"completed\" "
-                                "AND YEAR(`core_order`.`created_at`) = %s "
+                                "AND `core_order`.`created_at` >= %s "
+                                "AND `core_order`.`created_at` < %s "
                                 )
                     },
-                              select_params=[self.year])
+                              select_params=list(year_range(self.year)))
+
+    def plan(self, queryset, planner):
+        return queryset.extra(select={
+                self.name: planner.orders().yearly(self.year)})
             
 class TotalDonations(object):
 
@@ -111,6 +122,10 @@ class TotalDonations(object):
                                 )
                     },
                                   select_params=[self.tag])
+
+    def plan(self, queryset, planner):
+        return queryset.extra(select={
+                self.name: planner.orders().total(self.tag)})
             
 
 class NumDonations(object):
@@ -125,6 +140,9 @@ class NumDonations(object):
                             "AND `core_order`.`status`=\"completed\" ")
                 })
 
+    def plan(self, queryset, planner):
+        return queryset.extra(select={self.name: planner.orders().count()})
+
 class NumActions(object):
 
     def __init__(self, data):
@@ -0,0 +1,149 @@
+"""
+Audience size previews: counts each include group of a search, and the
+whole search, without building or running an ActionKit report.
+
+The counts run concurrently on a thread pool. If they don't all finish
+within USERSEARCH_COUNT_TIME_BUDGET seconds, the stragglers are replaced
+with estimates from the row counts in the query's EXPLAIN plan, and
+the stragglers are killed with KILL QUERY so they don't hold a pool
+thread (and the database) for as long as they would have run; the
+MAX_EXECUTION_TIME hint only stops them by itself on MySQL 5.7 and up.
+
+Unless an alias is given, counts and estimates run on a read replica.
+"""
+from django.conf import settings
+from django.db import DatabaseError
+from django.db import connections
+from django.http import QueryDict
+from multiprocessing.pool import ThreadPool
+from multiprocessing import TimeoutError
+import logging
+import threading
+import time
+
+from actionkit_usersearch import instrument
+from actionkit_usersearch import replicas
+from actionkit_usersearch import sql
+from actionkit_usersearch.cache import LRUCache
+from actionkit_usersearch.search_functions import build_count_queries
+from actionkit_usersearch.search_functions import canonical_querystring
+
+log = logging.getLogger(__name__)
+
+def time_budget():
+    return getattr(settings, 'USERSEARCH_COUNT_TIME_BUDGET', 10)
+
+count_cache = LRUCache(
+    maxsize=getattr(settings, 'USERSEARCH_COUNT_CACHE_SIZE', 256),
+    ttl=getattr(settings, 'USERSEARCH_COUNT_CACHE_TTL', 600))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(getattr(settings, 'USERSEARCH_COUNT_THREADS', 4))
+    return _pool
+
+class RunningCount(object):
+    """where a count is running, so that it can be killed"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.target = None
+
+    def start(self, alias, connection_id):
+        """records the connection a count runs on; False if it was cancelled"""
+        with self.lock:
+            if self.cancelled:
+                return False
+            self.target = (alias, connection_id)
+            return True
+
+    def cancel(self):
+        """stops the count, whether or not it has started yet"""
+        with self.lock:
+            self.cancelled = True
+            target = self.target
+        if target is None or target[1] is None:
+            ## not started, or not on MySQL
+            return
+        alias, connection_id = target
+        def kill(alias):
+            connections[alias].cursor().execute(
+                "KILL QUERY %d" % int(connection_id))
+        try:
+            replicas.read(kill, alias)
+        except DatabaseError:
+            log.exception("Could not kill count on %s", alias)
+
+def run_count(raw_sql, alias=None, running=None):
+    """
+    counts the rows selected by raw_sql, giving up on the server side
+    once the time budget is spent; returns None if `running`, a
+    RunningCount, is cancelled before the count starts
+    """
+    count_sql = "SELECT /*+ MAX_EXECUTION_TIME(%d) */ COUNT(*) FROM (%s) `ids`" % (
+        time_budget() * 1000, raw_sql)
+    def count(alias):
+        wrapper = connections[alias]
+        cursor = wrapper.cursor()
+        if running is not None:
+            connection_id = None
+            if wrapper.vendor == "mysql":
+                cursor.execute("SELECT CONNECTION_ID()")
+                connection_id = cursor.fetchone()[0]
+            if not running.start(alias, connection_id):
+                return None
+        cursor.execute(*sql.executable(count_sql))
+        return cursor.fetchone()[0]
+    return replicas.read(count, alias)
+
+def estimate_count(raw_sql, alias=None):
+    """
+    estimates the number of rows selected by raw_sql from its EXPLAIN
+    plan: the rows MySQL expects to read from the driving table, scaled
+    by the fraction it expects to survive the filters
+    """
+    return replicas.read(
+        lambda alias: instrument.explain(raw_sql, alias)['estimated_rows'],
+        alias)
+
+def count_search(querystring, alias=None):
+    """
+    returns a list of {"query", "count", "estimated"} dicts, one per
+    include group, with the count for the whole search last
+    """
+    key = canonical_querystring(QueryDict(querystring))
+    counts = count_cache.get(key)
+    if counts is not None:
+        return counts
+
+    queries = build_count_queries(querystring)
+    pool = get_pool()
+    running = [RunningCount() for query in queries]
+    pending = [pool.apply_async(run_count, (raw_sql, alias, running_count))
+               for (human_query, raw_sql), running_count in zip(queries, running)]
+    deadline = time.time() + time_budget()
+    counts = []
+    estimated = False
+    for (human_query, raw_sql), result, running_count in zip(
+        queries, pending, running):
+        try:
+            count = result.get(max(0, deadline - time.time()))
+            is_estimate = False
+        except TimeoutError:
+            running_count.cancel()
+            count = estimate_count(raw_sql, alias)
+            is_estimate = estimated = True
+        counts.append({
+                'query': human_query,
+                'count': count,
+                'estimated': is_estimate,
+                })
+    if not estimated:
+        count_cache.set(key, counts)
+    return counts
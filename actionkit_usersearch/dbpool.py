@@ -0,0 +1,163 @@
+"""
+Pools of persistent database connections, so that the lookup views
+reuse a warm connection instead of connecting to MySQL on every request.
+
+Django keeps one connection per thread per alias and closes it at the
+end of each request. Inside `pooled(alias)`, this thread's connection
+wrapper borrows an idle connection from the alias's pool, if it has one.
+On the way out the connection is rolled back, so the next user doesn't
+read from a stale transaction, and returned to the pool. A connection
+is discarded if an error was raised while it was lent out, or if it is
+older than USERSEARCH_POOL_MAX_AGE seconds.
+
+At most USERSEARCH_POOL_SIZE connections per alias are lent out at once;
+further callers wait for one to come back.
+"""
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connections
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+def pool_size():
+    return getattr(settings, 'USERSEARCH_POOL_SIZE', 4)
+
+def max_age():
+    return getattr(settings, 'USERSEARCH_POOL_MAX_AGE', 600)
+
+def _close(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+class DatabasePool(object):
+    """the idle connections to one database alias, and their metrics"""
+
+    def __init__(self, alias, size, max_age):
+        self.alias = alias
+        self.size = size
+        self.max_age = max_age
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+        self.in_use = 0
+        self.max_in_use = 0
+        self.lent = 0
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def _take(self):
+        """the newest idle connection and when it was opened, if any"""
+        with self.lock:
+            while self.idle:
+                connection, opened_at = self.idle.pop()
+                if time.time() - opened_at < self.max_age:
+                    self.reused += 1
+                    return connection, opened_at
+                self.discarded += 1
+                _close(connection)
+        return None, None
+
+    def _give_back(self, connection, opened_at, reusable):
+        if reusable and time.time() - opened_at < self.max_age:
+            try:
+                connection.rollback()
+            except Exception:
+                log.exception("Could not reset a connection to %s", self.alias)
+            else:
+                with self.lock:
+                    self.idle.append((connection, opened_at))
+                return
+        with self.lock:
+            self.discarded += 1
+        _close(connection)
+
+    @contextmanager
+    def lend(self):
+        """lends a connection to this thread's wrapper for the alias"""
+        wrapper = connections[self.alias]
+        if wrapper.connection is not None:
+            ## nested, or opened outside the pool; leave it alone
+            yield wrapper
+            return
+        started = time.time()
+        if not self.slots.acquire(False):
+            self.slots.acquire()
+            with self.lock:
+                self.waits += 1
+                self.wait_seconds += time.time() - started
+        with self.lock:
+            self.lent += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+        connection, opened_at = self._take()
+        wrapper.connection = connection
+        reusable = True
+        try:
+            yield wrapper
+        except Exception:
+            reusable = False
+            raise
+        finally:
+            connection, wrapper.connection = wrapper.connection, None
+            if connection is not None:
+                if opened_at is None:
+                    ## the wrapper connected on first use
+                    opened_at = time.time()
+                    with self.lock:
+                        self.created += 1
+                self._give_back(connection, opened_at, reusable)
+            with self.lock:
+                self.in_use -= 1
+            self.slots.release()
+
+    def close_idle(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection, opened_at in idle:
+            _close(connection)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'in_use': self.in_use,
+                'idle': len(self.idle),
+                'utilization': float(self.in_use) / self.size,
+                'max_in_use': self.max_in_use,
+                'lent': self.lent,
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded,
+                'waits': self.waits,
+                'wait_seconds': self.wait_seconds,
+                }
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(alias):
+    with _pools_lock:
+        if alias not in _pools:
+            _pools[alias] = DatabasePool(alias, pool_size(), max_age())
+        return _pools[alias]
+
+def pooled(alias):
+    """
+    a context manager in which connections[alias] uses a pooled
+    connection; yields the connection wrapper
+    """
+    return get_pool(alias).lend()
+
+def metrics():
+    """the utilization and counters of every pool"""
+    with _pools_lock:
+        pools = _pools.items()
+    return dict((alias, pool.snapshot()) for alias, pool in pools)
@@ -0,0 +1,175 @@
+"""
+Runs a search directly against the ActionKit database and streams the
+result out as CSV, instead of handing it to ActionKit's report runner.
+
+Rows are read through an unbuffered server-side cursor in batches of
+USERSEARCH_EXPORT_BATCH_SIZE, so memory use does not grow with the size
+of the audience.
+
+Large exports can also be split into shards by ranges of core_user.id
+and run on USERSEARCH_EXPORT_CONCURRENCY worker processes, each with its
+own connection, writing one numbered part file per shard.
+"""
+from cStringIO import StringIO
+from django.conf import settings
+from django.db import connections
+from multiprocessing import Pool
+import csv
+import logging
+import os
+import shutil
+
+from actionkit_usersearch.search_functions import build_query
+
+log = logging.getLogger(__name__)
+
+def batch_size():
+    return getattr(settings, 'USERSEARCH_EXPORT_BATCH_SIZE', 5000)
+
+def export_concurrency():
+    return getattr(settings, 'USERSEARCH_EXPORT_CONCURRENCY', 4)
+
+def export_retries():
+    """number of times a failed shard is run again before giving up"""
+    return getattr(settings, 'USERSEARCH_EXPORT_RETRIES', 2)
+
+def split_method():
+    """
+    "minmax" splits the id space into equal widths; "quantile" splits it
+    into shards of equal numbers of users, which costs a few index reads
+    but copes with sparse or lopsided id ranges
+    """
+    return getattr(settings, 'USERSEARCH_EXPORT_SPLIT', "minmax")
+
+def stream_batches(raw_sql, alias="ak", size=None):
+    """
+    executes raw_sql and yields the column names, then each batch of rows
+    """
+    ## imported here so that views (and sqlite setups) don't need MySQLdb
+    import MySQLdb.cursors
+    size = size or batch_size()
+    connection = connections[alias]
+    ## make sure the underlying connection is open
+    connection.cursor()
+    cursor = connection.connection.cursor(MySQLdb.cursors.SSCursor)
+    try:
+        cursor.execute(raw_sql)
+        yield [column[0] for column in cursor.description]
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+
+def _encode(row):
+    return [value.encode("utf-8") if isinstance(value, unicode) else value
+            for value in row]
+
+def csv_stream(raw_sql, alias="ak", size=None):
+    """
+    yields the result of raw_sql as chunks of CSV text, one chunk per
+    batch of rows, starting with a header line
+    """
+    batches = stream_batches(raw_sql, alias, size)
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(_encode(batches.next()))
+    yield buf.getvalue()
+    for rows in batches:
+        buf = StringIO()
+        writer = csv.writer(buf)
+        writer.writerows(_encode(row) for row in rows)
+        yield buf.getvalue()
+
+def id_ranges(shards, alias="ak", method=None):
+    """
+    returns up to `shards` half-open (start, stop) ranges which together
+    cover every core_user id, in order
+    """
+    method = method or split_method()
+    cursor = connections[alias].cursor()
+    cursor.execute("SELECT MIN(`id`), MAX(`id`), COUNT(*) FROM `core_user`")
+    low, high, total = cursor.fetchone()
+    if not total:
+        return []
+    if method == "quantile":
+        boundaries = [low]
+        for k in range(1, shards):
+            cursor.execute("SELECT `id` FROM `core_user` ORDER BY `id` "
+                           "LIMIT 1 OFFSET %s", [total * k // shards])
+            boundaries.append(cursor.fetchone()[0])
+    else:
+        width = (high - low) // shards + 1
+        ## with more shards than ids, the later boundaries would pass
+        ## the end; they collapse into the last one instead
+        boundaries = [min(low + width * k, high) for k in range(shards)]
+    boundaries = sorted(set(boundaries)) + [high + 1]
+    return zip(boundaries[:-1], boundaries[1:])
+
+def part_path(path, number):
+    return "%s.part-%04d" % (path, number)
+
+def _export_shard(raw_sql, path, alias, size):
+    with open(path, "wb") as out:
+        for chunk in csv_stream(raw_sql, alias, size):
+            out.write(chunk)
+    connections[alias].close()
+    return path
+
+def concatenate(paths, output):
+    """joins part files into `output`, keeping only the first header"""
+    with open(output, "wb") as out:
+        for i, path in enumerate(paths):
+            with open(path, "rb") as part:
+                header = part.readline()
+                if i == 0:
+                    out.write(header)
+                shutil.copyfileobj(part, out)
+            os.remove(path)
+
+def parallel_export(querystring, output, shards=None, concurrency=None,
+                    alias="ak", size=None, keep_parts=False):
+    """
+    exports the search to `output` by running one query per id range on
+    a pool of worker processes; returns the paths written, which are the
+    numbered part files if `keep_parts` is set
+    """
+    concurrency = concurrency or export_concurrency()
+    ranges = id_ranges(shards or concurrency * 4, alias)
+    jobs = [(build_query(querystring, id_range=id_range).raw_sql,
+             part_path(output, number), alias, size)
+            for number, id_range in enumerate(ranges)]
+    ## forked workers must not inherit open sockets: a worker cleaning
+    ## up its copy would send COM_QUIT on the parent's connection. Close
+    ## them first, so each worker opens its own.
+    for connection in connections.all():
+        connection.close()
+
+    pool = Pool(concurrency)
+    try:
+        pending = dict((number, pool.apply_async(_export_shard, job))
+                       for number, job in enumerate(jobs))
+        attempts = dict((number, 1) for number in pending)
+        paths = {}
+        while pending:
+            for number in sorted(pending):
+                try:
+                    paths[number] = pending.pop(number).get()
+                except Exception:
+                    if attempts[number] > export_retries():
+                        raise
+                    log.exception("Export shard %s failed; retrying", number)
+                    attempts[number] += 1
+                    pending[number] = pool.apply_async(_export_shard, jobs[number])
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    paths = [paths[number] for number in sorted(paths)]
+    if keep_parts:
+        return paths
+    concatenate(paths, output)
+    return [output]
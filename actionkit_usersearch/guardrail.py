@@ -0,0 +1,198 @@
+"""
+Estimates what a compiled search will cost the ActionKit database before
+it is submitted as a report, and decides whether to run it, run it with
+a warning, hold it for the low-priority queue, or refuse it.
+
+The estimate is the number of rows MySQL expects to examine, from the
+query's EXPLAIN plan, where a dependent subquery is counted once per
+row of the table it depends on. On top of that, the SQL is checked for
+patterns known to be slow here: correlated per-user column subqueries,
+GROUP BY over joined fact tables, very long literal IN lists, and name
+or email searches (LIKE '%...%', which no index can serve) combined
+with exclusions or extra columns.
+
+Queued searches are kept as QueuedSearch rows until the
+usersearch_run_queue command submits them.
+"""
+from collections import namedtuple
+from django.conf import settings
+from django.http import QueryDict
+import datetime
+import logging
+import re
+
+from actionkit_usersearch import instrument
+from actionkit_usersearch import reports
+from actionkit_usersearch.models import QueuedSearch
+from actionkit_usersearch.search_functions import Query
+
+log = logging.getLogger(__name__)
+
+ALLOW, WARN, QUEUE, REJECT = "allow", "warn", "queue", "reject"
+LEVELS = (ALLOW, WARN, QUEUE, REJECT)
+
+Assessment = namedtuple("Assessment", "action rows_examined reasons")
+
+def guardrail_enabled():
+    return getattr(settings, 'USERSEARCH_GUARDRAIL', True)
+
+def row_thresholds():
+    """rows examined at which a search is warned about, queued and rejected"""
+    return getattr(settings, 'USERSEARCH_GUARDRAIL_ROWS', (
+            10 ** 7, 10 ** 8, 10 ** 9))
+
+def max_in_list():
+    return getattr(settings, 'USERSEARCH_GUARDRAIL_MAX_IN_LIST', 10000)
+
+def max_column_subqueries():
+    return getattr(settings, 'USERSEARCH_GUARDRAIL_MAX_COLUMN_SUBQUERIES', 8)
+
+def rows_examined(plan):
+    """
+    totals the rows in the plan, multiplying each dependent subquery by
+    the rows of the outer query it runs once for
+    """
+    if not plan:
+        return 0
+    outer = float(plan[0].get('rows') or 0)
+    total = 0
+    for row in plan:
+        rows = float(row.get('rows') or 0)
+        if "DEPENDENT" in (row.get('select_type') or ""):
+            rows *= max(outer, 1)
+        total += rows
+    return int(total)
+
+## a per-user subquery, as output columns are compiled to by default
+CORRELATED = re.compile(r"`(?:user_id|parent_id)`\s*=\s*`core_user`\.`id`")
+## what can hide a FROM or a parenthesis: quoted strings and names
+SQL_TOKEN = re.compile(r"""'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`|[()]|\bFROM\b""",
+                       re.IGNORECASE)
+## the fields compiled to LIKE '%value%', which scan every user
+LIKE_FIELDS = ("user_name", "user_email")
+EXCLUSION = re.compile(r"^include:\d+_.+_istoggle$")
+OUTER_GROUP_BY = re.compile(r"GROUP BY `core_user`\.`id`")
+IN_LIST = re.compile(r"\bIN \(([\d\s,]+)\)")
+
+def select_list(raw_sql):
+    """the outer query's output columns: the SQL before its own FROM"""
+    depth = 0
+    for match in SQL_TOKEN.finditer(raw_sql):
+        token = match.group()
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+        elif depth == 0 and token.upper() == "FROM":
+            return raw_sql[:match.start()]
+    return raw_sql
+
+def substring_search(query_string):
+    """
+    returns (level, reason) if the search's name or email LIKE is
+    combined with the exclusions or columns that make it run away; a
+    LIKE alone costs the same one scan as every other name search
+    """
+    query_params = QueryDict(query_string or "")
+    fields = [field.split("_")[1] for field in LIKE_FIELDS
+              if query_params.get(field)]
+    if not fields:
+        return None
+    exclusions = len([key for key in query_params.keys()
+                      if EXCLUSION.match(key) and query_params[key] == "0"])
+    columns = len(query_params.getlist("column"))
+    combined = []
+    if exclusions:
+        combined.append("%s exclusion(s)" % exclusions)
+    if columns:
+        combined.append("%s extra column(s)" % columns)
+    if not combined:
+        return None
+    return (len(combined) > 1 and QUEUE or WARN,
+            "a substring %s search is combined with %s" % (
+            " and ".join(fields), " and ".join(combined)))
+
+def patterns(raw_sql, query_string=None):
+    """
+    returns (level, reason) pairs for each expensive pattern in the SQL,
+    or in the search's query string
+    """
+    found = []
+    ## filters' EXISTS subqueries are correlated too, but run at most
+    ## once per candidate user, and are judged by the EXPLAIN plan
+    correlated = len(CORRELATED.findall(select_list(raw_sql)))
+    if correlated > max_column_subqueries():
+        found.append((WARN, "%s correlated column subqueries run once per "
+                      "user" % correlated))
+    substring = substring_search(query_string)
+    if substring is not None:
+        found.append(substring)
+    if OUTER_GROUP_BY.search(raw_sql):
+        found.append((WARN, "users are grouped over joined activity tables"))
+    longest = max([match.count(",") + 1 for match in IN_LIST.findall(raw_sql)]
+                  or [0])
+    if longest > max_in_list():
+        found.append((WARN, "a literal list of %s ids is inlined in the SQL" % (
+                    longest)))
+    if len(found) >= 3:
+        ## each is survivable alone; together they compound
+        found.append((QUEUE, "several expensive patterns combined"))
+    return found
+
+def assess(query, alias="ak"):
+    """scores a compiled Query, returning an Assessment"""
+    reasons = []
+    level = ALLOW
+    try:
+        examined = rows_examined(
+            instrument.explain(query.raw_sql, alias)['plan'])
+    except Exception:
+        log.exception("Could not EXPLAIN search; judging it by its SQL alone")
+        examined = None
+    if examined is not None:
+        for threshold, threshold_level in reversed(zip(row_thresholds(),
+                                                       LEVELS[1:])):
+            if examined >= threshold:
+                level = threshold_level
+                reasons.append("MySQL expects to examine about %s rows" % (
+                        "{:,}".format(examined)))
+                break
+    for pattern_level, reason in patterns(query.raw_sql, query.query_string):
+        reasons.append(reason)
+        if LEVELS.index(pattern_level) > LEVELS.index(level):
+            level = pattern_level
+    return Assessment(level, examined, reasons)
+
+def enqueue(query, email_to, assessment):
+    """holds the search for the low-priority queue"""
+    return QueuedSearch.objects.create(
+        query_string=query.query_string,
+        human_query=query.human_query,
+        raw_sql=query.raw_sql,
+        email_to=email_to,
+        reasons="\n".join(assessment.reasons))
+
+def run_queue(limit=None, client=None):
+    """
+    submits pending queued searches one at a time, oldest first, and
+    returns the QueuedSearches it handled
+    """
+    pending = QueuedSearch.objects.filter(status="pending").order_by("created_at")
+    if limit:
+        pending = pending[:limit]
+    handled = []
+    for queued in pending:
+        query = Query(queued.human_query, queued.query_string,
+                      queued.raw_sql, None)
+        try:
+            report, queued.task_id, merged = reports.run_report(
+                query, queued.email_to, client)
+            queued.status = "submitted"
+        except Exception, e:
+            log.exception("Could not submit queued search %s", queued.id)
+            queued.status = "failed"
+            queued.error = str(e)
+        queued.submitted_at = datetime.datetime.now()
+        queued.save()
+        handled.append(queued)
+    return handled
@@ -0,0 +1,204 @@
+"""
+Instrumentation for searches and for the builder's lookup views, which
+is switched on by the USERSEARCH_INSTRUMENT setting.
+
+A search compiled under a Trace records each include group, each filter
+within it, and each output column. For each one it keeps the time it
+took to compile and the SQL it added to the query. The finished SQL can
+be EXPLAINed, and the plan's row estimate and full table scans are kept
+with the trace.
+
+Traces and per-request measurements of the lookup views are logged as
+JSON lines to this module's logger. Running totals for each view are
+kept in `view_metrics` for the debug view.
+"""
+from django.conf import settings
+from django.db import connections
+from functools import wraps
+import difflib
+import json
+import logging
+import threading
+import time
+
+from actionkit_usersearch import sql
+from actionkit_usersearch.sql import EmptyResultSet
+
+log = logging.getLogger(__name__)
+
+def enabled():
+    return getattr(settings, 'USERSEARCH_INSTRUMENT', False)
+
+def explain_enabled():
+    """whether traces logged from build_query also run EXPLAIN"""
+    return getattr(settings, 'USERSEARCH_INSTRUMENT_EXPLAIN', False)
+
+_local = threading.local()
+
+def current():
+    """the trace being recorded in this thread, if any"""
+    return getattr(_local, 'trace', None)
+
+class Trace(object):
+
+    def __init__(self, querystring):
+        self.querystring = querystring
+        self.query = None
+        self.steps = []
+        self.seconds = None
+        self.sql = None
+        self.joins = []
+        self.explain = None
+
+    def __enter__(self):
+        _local.trace = self
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.time() - self.started
+        _local.trace = None
+
+    def as_dict(self):
+        return {
+            'querystring': self.querystring,
+            'seconds': self.seconds,
+            'steps': self.steps,
+            'joins': self.joins,
+            'sql': self.sql,
+            'explain': self.explain,
+            }
+
+def queryset_sql(queryset):
+    try:
+        return sql.raw_sql_from_queryset(queryset)
+    except EmptyResultSet:
+        return ""
+
+def added_sql(before, after):
+    """the runs of SQL tokens which `after` adds to or changes in `before`"""
+    before, after = before.split(), after.split()
+    matcher = difflib.SequenceMatcher(None, before, after, autojunk=False)
+    return [" ".join(after[j1:j2])
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+            if tag in ("insert", "replace")]
+
+def start(queryset):
+    """
+    begins measuring a step which will change the queryset; returns None
+    (and costs nothing) unless a trace is being recorded
+    """
+    if current() is None:
+        return None
+    return (time.time(), queryset_sql(queryset))
+
+def record(kind, name, timer, queryset, description=None):
+    """ends a step begun with start(), given the queryset it produced"""
+    trace = current()
+    if timer is None or trace is None:
+        return
+    started, before = timer
+    seconds = time.time() - started
+    trace.steps.append({
+            'kind': kind,
+            'name': name,
+            'description': description,
+            'seconds': seconds,
+            'sql': added_sql(before, queryset_sql(queryset)),
+            })
+
+def explain(raw_sql, alias="ak"):
+    """
+    runs EXPLAIN on the SQL and returns the plan, MySQL's estimate of
+    the rows it will return, and the tables it reads in full
+    """
+    cursor = connections[alias].cursor()
+    cursor.execute(*sql.executable("EXPLAIN " + raw_sql))
+    columns = [column[0] for column in cursor.description]
+    plan = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    estimate = 0
+    if plan:
+        estimate = float(plan[0].get('rows') or 0)
+        if plan[0].get('filtered') is not None:
+            estimate *= float(plan[0]['filtered']) / 100
+    full_scans = [row.get('table') for row in plan if row.get('type') == "ALL"]
+    warnings = []
+    for row in plan:
+        extra = row.get('Extra') or ""
+        for warning in ("Using temporary", "Using filesort"):
+            if warning in extra:
+                warnings.append("%s on %s" % (warning, row.get('table')))
+    return {
+        'plan': plan,
+        'estimated_rows': int(estimate),
+        'full_scans': full_scans,
+        'warnings': warnings,
+        }
+
+def log_trace(trace):
+    log.info(json.dumps({'event': "search_compiled", 'trace': trace.as_dict()},
+                        default=str))
+
+class ViewMetrics(object):
+    """running totals of requests, time and SQL for each view"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def add(self, name, seconds, queries, sql_seconds):
+        with self.lock:
+            totals = self.views.setdefault(name, {
+                    'requests': 0, 'seconds': 0.0,
+                    'queries': 0, 'sql_seconds': 0.0})
+            totals['requests'] += 1
+            totals['seconds'] += seconds
+            totals['queries'] += queries
+            totals['sql_seconds'] += sql_seconds
+
+    def snapshot(self):
+        with self.lock:
+            return dict((name, dict(totals))
+                        for name, totals in self.views.items())
+
+view_metrics = ViewMetrics()
+
+def measured(view):
+    """
+    when instrumentation is on, counts the SQL queries a view runs on
+    every connection and times them and the whole request
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not enabled():
+            return view(request, *args, **kwargs)
+        states = []
+        for connection in connections.all():
+            states.append((connection, connection.use_debug_cursor,
+                           len(connection.queries)))
+            connection.use_debug_cursor = True
+        started = time.time()
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            seconds = time.time() - started
+            queries = {}
+            sql_seconds = 0.0
+            for connection, use_debug_cursor, count in states:
+                new = connection.queries[count:]
+                ## don't let the debug log grow from request to request
+                del connection.queries[count:]
+                connection.use_debug_cursor = use_debug_cursor
+                if new:
+                    queries[connection.alias] = len(new)
+                    sql_seconds += sum(float(query['time']) for query in new)
+            view_metrics.add(view.__name__, seconds,
+                             sum(queries.values()), sql_seconds)
+            log.info(json.dumps({
+                        'event': "view",
+                        'view': view.__name__,
+                        'seconds': seconds,
+                        'queries': queries,
+                        'sql_seconds': sql_seconds,
+                        }))
+    return wrapper
@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+import datetime
+import json
+import subprocess
+
+from actionkit_usersearch.benchmarks import BENCHMARKS
+
+class Command(BaseCommand):
+    args = "[benchmark ...]"
+    help = "Times the search compiler. Available benchmarks: %s" % (
+        ", ".join(sorted(BENCHMARKS)))
+
+    option_list = BaseCommand.option_list + (
+        make_option("--iterations", type="int", default=100,
+                    help="Number of times to run each benchmark"),
+        make_option("--users", type="int", default=100000,
+                    help="Number of synthetic users to generate"),
+        make_option("--fields-per-user", type="int", default=4,
+                    dest="fields_per_user",
+                    help="Number of synthetic userfields per user"),
+        make_option("--rows-per-user", type="int", default=3,
+                    dest="rows_per_user",
+                    help="Average number of synthetic actions, orders, "
+                    "opens and contact records per user"),
+        make_option("--pages", type="int", default=50,
+                    help="Number of synthetic pages"),
+        make_option("-o", "--output", dest="output",
+                    help="Write the results to this file as well"),
+        )
+
+    def handle(self, *names, **options):
+        names = names or sorted(BENCHMARKS)
+        for name in names:
+            if name not in BENCHMARKS:
+                raise CommandError("Unknown benchmark: %s" % name)
+        results = {}
+        for name in names:
+            results[name] = BENCHMARKS[name](options)
+        output = json.dumps({
+                'meta': self.meta(options),
+                'results': results,
+                }, indent=2, sort_keys=True) + "\n"
+        self.stdout.write(output)
+        if options.get('output'):
+            with open(options['output'], "w") as fp:
+                fp.write(output)
+
+    def meta(self, options):
+        """what was measured, so runs from different commits can be compared"""
+        try:
+            commit = subprocess.Popen(
+                ["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE).communicate()[0].strip() or None
+        except OSError:
+            commit = None
+        return {
+            'commit': commit,
+            'ran_at': datetime.datetime.now().isoformat(),
+            'scale': dict((key, options[key]) for key in (
+                        'iterations', 'users', 'fields_per_user',
+                        'rows_per_user', 'pages')),
+            }
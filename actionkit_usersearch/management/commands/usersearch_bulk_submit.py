@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+import json
+import sys
+
+from actionkit_usersearch.bulk import submit_searches
+from actionkit_usersearch.restclient import RestClient
+
+class Command(BaseCommand):
+    args = "[file]"
+    help = ("Builds and submits an ActionKit report for each search "
+            "querystring in the file (or standard input), one per line")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--email", dest="email",
+                    help="Address to email the reports to"),
+        make_option("--concurrency", type="int",
+                    help="Number of searches to submit at a time"),
+        make_option("--rate", type="float",
+                    help="Maximum ActionKit API calls per second"),
+        )
+
+    def handle(self, path=None, **options):
+        if not options.get('email'):
+            raise CommandError("--email is required")
+        fp = path and open(path) or sys.stdin
+        querystrings = [line.strip() for line in fp if line.strip()]
+        client = RestClient(settings.ACTIONKIT_API_HOST,
+                            settings.ACTIONKIT_API_USER,
+                            settings.ACTIONKIT_API_PASSWORD,
+                            concurrency=options.get('concurrency'),
+                            rate=options.get('rate'))
+        results = submit_searches(querystrings, options['email'], client)
+        for result in results:
+            self.stdout.write(json.dumps(result) + "\n")
+        failed = [result for result in results if 'error' in result]
+        if failed:
+            raise CommandError("%s of %s searches failed" % (
+                    len(failed), len(results)))
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+import sys
+
+from actionkit_usersearch.export import csv_stream, parallel_export
+from actionkit_usersearch.search_functions import build_query
+
+class Command(BaseCommand):
+    args = "querystring"
+    help = ("Runs a search against the ActionKit database and writes the "
+            "result as CSV")
+
+    option_list = BaseCommand.option_list + (
+        make_option("-o", "--output", dest="output",
+                    help="File to write to (default: standard output)"),
+        make_option("--batch-size", type="int", dest="batch_size",
+                    help="Number of rows to fetch at a time"),
+        make_option("--parallel", action="store_true", default=False,
+                    help="Split the export into id ranges and run them "
+                    "on several worker processes (requires --output)"),
+        make_option("--concurrency", type="int",
+                    help="Number of worker processes for --parallel"),
+        make_option("--shards", type="int",
+                    help="Number of id ranges for --parallel"),
+        make_option("--parts", action="store_true", default=False,
+                    help="With --parallel, leave one numbered part file "
+                    "per shard instead of joining them"),
+        )
+
+    def handle(self, querystring="", **options):
+        if options['parallel']:
+            if not options.get('output'):
+                raise CommandError("--parallel requires --output")
+            paths = parallel_export(
+                querystring, options['output'],
+                shards=options.get('shards'),
+                concurrency=options.get('concurrency'),
+                size=options.get('batch_size'),
+                keep_parts=options['parts'])
+            self.stdout.write("\n".join(paths) + "\n")
+            return
+
+        query = build_query(querystring)
+        if options.get('output'):
+            out = open(options['output'], "wb")
+        else:
+            out = sys.stdout
+        try:
+            for chunk in csv_stream(query.raw_sql, size=options.get('batch_size')):
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout:
+                out.close()
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from actionkit_usersearch.models import SavedSearch
+from actionkit_usersearch.saved_searches import refresh
+
+class Command(BaseCommand):
+    args = "[saved search name ...]"
+    help = ("Brings saved searches up to date, re-checking only the users "
+            "who changed since the last run, and reports who joined and "
+            "left each audience")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--full", action="store_true", default=False,
+                    help="Re-run each search over every user"),
+        make_option("--create", dest="create", metavar="QUERYSTRING",
+                    help="Save a new search under the given name first"),
+        make_option("--ids", action="store_true", default=False,
+                    help="List the ids of the users who joined and left"),
+        )
+
+    def handle(self, *names, **options):
+        if options.get('create'):
+            if len(names) != 1:
+                raise CommandError("--create takes exactly one name")
+            SavedSearch.objects.create(name=names[0],
+                                       query_string=options['create'])
+        saved_searches = SavedSearch.objects.order_by("name")
+        if names:
+            saved_searches = saved_searches.filter(name__in=names)
+            missing = set(names) - set(s.name for s in saved_searches)
+            if missing:
+                raise CommandError("Unknown saved search: %s" % (
+                        ", ".join(sorted(missing))))
+        for saved_search in saved_searches:
+            run = refresh(saved_search, full=options['full'])
+            if run.incremental:
+                checked = "%s changed users checked" % run.users_checked
+            else:
+                checked = "full run"
+            self.stdout.write("%s: %s joined, %s left (%s); %s members\n" % (
+                    saved_search.name, run.added_count, run.removed_count,
+                    checked, saved_search.snapshot.cardinality))
+            if options['ids']:
+                self.stdout.write("joined: %s\n" % " ".join(
+                        str(id) for id in run.added_bitmap()))
+                self.stdout.write("left: %s\n" % " ".join(
+                        str(id) for id in run.removed_bitmap()))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from actionkit_usersearch.guardrail import run_queue
+
+class Command(BaseCommand):
+    help = ("Submits the searches the guardrail queued as too expensive to "
+            "run right away; schedule it for when ActionKit is quiet")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--limit", type="int",
+                    help="Submit at most this many searches"),
+        )
+
+    def handle(self, **options):
+        for queued in run_queue(limit=options.get('limit')):
+            self.stdout.write("%s: %s %s\n" % (
+                    queued.id, queued.status, queued.task_id or queued.error))
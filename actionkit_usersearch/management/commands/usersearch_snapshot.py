@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from actionkit_usersearch.snapshots import snapshot_search
+
+class Command(BaseCommand):
+    args = "querystring"
+    help = ("Runs a search and saves the ids of the users it matches as an "
+            "audience snapshot")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--name", dest="name",
+                    help="Name to save the snapshot under"),
+        make_option("--file", dest="file",
+                    help="Also write the serialized bitmap to this file"),
+        )
+
+    def handle(self, querystring="", **options):
+        if not options.get('name'):
+            raise CommandError("--name is required")
+        snapshot = snapshot_search(querystring, options['name'])
+        if options.get('file'):
+            snapshot.bitmap().save(options['file'])
+        self.stdout.write("Saved snapshot %s: %s users\n" % (
+                snapshot.id, snapshot.cardinality))
@@ -1,6 +1,8 @@
 from django.db import models
 from zope.dottedname.resolve import resolve
+import base64
 
+from actionkit_usersearch.bitmap import IdBitmap
 from actionkit_usersearch.columns import TYPE_CHOICES
 
 class SearchColumn(models.Model):
@@ -17,3 +19,120 @@ class SearchColumn(models.Model):
     def load(self):
         return resolve(TYPE_CHOICES[self.type][1])(self)
 
+
+class GeocodedZipcode(models.Model):
+    """
+    Zip code centroids which were not in the local index and had to be
+    looked up from a remote geocoding service.
+    """
+    zipcode = models.CharField(unique=True, max_length=20)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    source = models.CharField(max_length=50)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class AudienceSnapshot(models.Model):
+    """
+    The ids of the users a search matched at one point in time, stored
+    as a base64-encoded IdBitmap.
+    """
+    name = models.CharField(max_length=255)
+    query_string = models.TextField()
+    human_query = models.TextField()
+    cardinality = models.IntegerField()
+    data = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return self.name
+
+    def bitmap(self):
+        return IdBitmap.from_bytes(base64.b64decode(self.data))
+
+    def set_bitmap(self, bitmap):
+        self.data = base64.b64encode(bitmap.to_bytes())
+        self.cardinality = len(bitmap)
+
+
+class SavedSearch(models.Model):
+    """
+    A recurring search whose membership is kept in an AudienceSnapshot
+    and brought up to date incrementally; `watermarks` is a JSON object
+    recording how far each source of changes had been read.
+    """
+    name = models.CharField(unique=True, max_length=255)
+    query_string = models.TextField()
+    snapshot = models.ForeignKey(AudienceSnapshot, null=True, blank=True)
+    watermarks = models.TextField(default="{}")
+    last_run_at = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return self.name
+
+
+class SavedSearchRun(models.Model):
+    """
+    The users who joined and left a SavedSearch's audience in one run,
+    stored as base64-encoded IdBitmaps. `users_checked` is null for a
+    full run, which checks everyone.
+    """
+    saved_search = models.ForeignKey(SavedSearch, related_name="runs")
+    ran_at = models.DateTimeField(auto_now_add=True)
+    incremental = models.BooleanField(default=False)
+    users_checked = models.IntegerField(null=True, blank=True)
+    added_count = models.IntegerField()
+    removed_count = models.IntegerField()
+    added = models.TextField()
+    removed = models.TextField()
+
+    def added_bitmap(self):
+        return IdBitmap.from_bytes(base64.b64decode(self.added))
+
+    def removed_bitmap(self):
+        return IdBitmap.from_bytes(base64.b64decode(self.removed))
+
+
+class SearchReport(models.Model):
+    """
+    The ActionKit report created for a search, keyed on a fingerprint of
+    its SQL and description, so identical searches reuse it.
+    """
+    fingerprint = models.CharField(unique=True, max_length=40)
+    report_id = models.IntegerField()
+    short_name = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class SearchReportRun(models.Model):
+    """An asynchronous run of a SearchReport, emailed to one recipient."""
+    report = models.ForeignKey(SearchReport, related_name="runs")
+    email_to = models.CharField(max_length=255)
+    data_hash = models.CharField(max_length=40)
+    ## blank while the run is being started
+    task_id = models.CharField(max_length=255, blank=True)
+    started_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+
+class QueuedSearch(models.Model):
+    """
+    A search the guardrail held back from running right away, to be
+    submitted by the usersearch_run_queue command at a quieter time.
+    """
+    STATUS_CHOICES = (
+        ("pending", "Pending"),
+        ("submitted", "Submitted"),
+        ("failed", "Failed"),
+        )
+    query_string = models.TextField()
+    human_query = models.TextField()
+    raw_sql = models.TextField()
+    email_to = models.CharField(max_length=255)
+    reasons = models.TextField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES,
+                              default="pending", db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    submitted_at = models.DateTimeField(null=True, blank=True)
+    task_id = models.CharField(max_length=255, null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
@@ -0,0 +1,257 @@
+from django.conf import settings
+import datetime
+
+from actionkit_usersearch import instrument
+
+def column_strategy():
+    """
+    "subquery" fetches each output column with its own correlated
+    subquery, which is cheapest for small audiences; "join" fetches
+    them through pre-aggregated derived tables joined once per user,
+    which is cheapest for large ones
+    """
+    return getattr(settings, 'USERSEARCH_COLUMN_STRATEGY', 'subquery')
+
+class FirstValuePivot(object):
+    """
+    A derived table with one row per user, holding the first (lowest id)
+    matching value for each requested field -- the same value a
+    correlated `SELECT ... LIMIT 1` would find.
+
+    The table is scanned once: an inner query picks the first row id per
+    user and field, and the outer query pivots those rows into columns
+    with conditional aggregation.
+    """
+
+    def __init__(self, alias, source, user_column, name_column=None,
+                 value_column="`f`.`value`"):
+        self.alias = alias
+        self.source = source
+        self.user_column = user_column
+        self.name_column = name_column
+        self.value_column = value_column
+        self.fields = []
+
+    def add(self, name=None, condition=None, params=()):
+        """
+        requests the field called `name` (or, for tables without a name
+        column, the single value column) and returns the SQL expression
+        which selects it from the joined table
+
+        `condition` is an optional extra SQL predicate, with `params`,
+        which the field's rows must satisfy
+        """
+        field = (name, condition, tuple(params))
+        if field not in self.fields:
+            self.fields.append(field)
+        return "`%s`.`c%s`" % (self.alias, self.fields.index(field))
+
+    def has_name(self, name):
+        return name in [field[0] for field in self.fields]
+
+    def as_join(self):
+        params = []
+        select = []
+        for i, (name, condition, condition_params) in enumerate(self.fields):
+            if self.name_column is None:
+                select.append("MAX(%s) AS `c%s`" % (self.value_column, i))
+            else:
+                select.append("MAX(CASE WHEN %s = %%s THEN %s END) AS `c%s`" % (
+                        self.name_column, self.value_column, i))
+                params.append(name)
+
+        inner = "SELECT MIN(`f`.`id`) AS `id` %s" % self.source
+        group_by = [self.user_column]
+        if self.name_column is not None:
+            if any(field[1] for field in self.fields):
+                where = []
+                for name, condition, condition_params in self.fields:
+                    if condition:
+                        where.append("(%s = %%s AND %s)" % (
+                                self.name_column, condition))
+                    else:
+                        where.append("%s = %%s" % self.name_column)
+                    params.append(name)
+                    params.extend(condition_params)
+                inner += " WHERE %s" % " OR ".join(where)
+            else:
+                inner += " WHERE %s IN (%s)" % (
+                    self.name_column, ", ".join(["%s"] * len(self.fields)))
+                params.extend(field[0] for field in self.fields)
+            group_by.append(self.name_column)
+        inner += " GROUP BY %s" % ", ".join(group_by)
+
+        sql = ("LEFT OUTER JOIN ("
+               "SELECT %(user)s AS `user_id`, %(select)s %(source)s "
+               "JOIN (%(inner)s) `first` ON `first`.`id` = `f`.`id` "
+               "GROUP BY %(user)s"
+               ") `%(alias)s` ON (`%(alias)s`.`user_id` = `core_user`.`id`)") % {
+            'user': self.user_column,
+            'select': ", ".join(select),
+            'source': self.source,
+            'inner': inner,
+            'alias': self.alias,
+            }
+        return sql, params
+
+def userfield_pivot(alias):
+    return FirstValuePivot(
+        alias, "FROM `core_userfield` `f`",
+        user_column="`f`.`parent_id`", name_column="`f`.`name`")
+
+def phone_pivot(alias):
+    return FirstValuePivot(
+        alias, "FROM `core_phone` `f`",
+        user_column="`f`.`user_id`", value_column="`f`.`normalized_phone`")
+
+def actionfield_pivot(alias):
+    return FirstValuePivot(
+        alias, ("FROM `core_actionfield` `f` "
+                "JOIN `core_action` `a` ON `a`.`id` = `f`.`parent_id`"),
+        user_column="`a`.`user_id`", name_column="`f`.`name`")
+
+def year_range(year):
+    """
+    returns the [start, end) datetimes of a calendar year, so that year
+    filters can use an index on the date column
+    """
+    year = int(year)
+    return datetime.datetime(year, 1, 1), datetime.datetime(year + 1, 1, 1)
+
+class OrderRollup(object):
+    """
+    A derived table with one row per user, aggregating that user's
+    completed orders in a single grouped scan of core_order: the order
+    count, the total, and totals for each requested year and page tag.
+    """
+
+    def __init__(self, alias):
+        self.alias = alias
+        self.aggregates = []
+        self.tags = []
+
+    def _add(self, aggregate):
+        if aggregate not in self.aggregates:
+            self.aggregates.append(aggregate)
+        return "`%s`.`c%s`" % (self.alias, self.aggregates.index(aggregate))
+
+    def count(self):
+        return "COALESCE(%s, 0)" % self._add(("count", None))
+
+    def total(self, tag=None):
+        if tag is not None and tag not in self.tags:
+            self.tags.append(tag)
+        return self._add(("total", tag))
+
+    def yearly(self, year):
+        return self._add(("yearly", int(year)))
+
+    def as_join(self):
+        select = []
+        params = []
+        for i, (kind, arg) in enumerate(self.aggregates):
+            if kind == "count":
+                select.append("COUNT(*) AS `c%s`" % i)
+            elif kind == "yearly":
+                select.append(
+                    "SUM(CASE WHEN `o`.`created_at` >= %%s "
+                    "AND `o`.`created_at` < %%s "
+                    "THEN `o`.`total` END) AS `c%s`" % i)
+                params.extend(year_range(arg))
+            elif arg is None:
+                select.append("SUM(`o`.`total`) AS `c%s`" % i)
+            else:
+                select.append(
+                    "SUM(CASE WHEN `tags`.`t%s` THEN `o`.`total` END) AS `c%s`" % (
+                        self.tags.index(arg), i))
+
+        source = "FROM `core_order` `o`"
+        if self.tags:
+            tag_select = []
+            for i, tag in enumerate(self.tags):
+                tag_select.append("MAX(`t`.`name` = %%s) AS `t%s`" % i)
+            source += (
+                " LEFT OUTER JOIN `core_action` `a` ON `a`.`id` = `o`.`action_id`"
+                " LEFT OUTER JOIN ("
+                "SELECT `pt`.`page_id` AS `page_id`, %s "
+                "FROM `core_page_tags` `pt` "
+                "JOIN `core_tag` `t` ON `t`.`id` = `pt`.`tag_id` "
+                "WHERE `t`.`name` IN (%s) "
+                "GROUP BY `pt`.`page_id`"
+                ") `tags` ON `tags`.`page_id` = `a`.`page_id`") % (
+                ", ".join(tag_select), ", ".join(["%s"] * len(self.tags)))
+            ## once for the per-tag flags, once for the IN list
+            params.extend(self.tags)
+            params.extend(self.tags)
+
+        sql = ("LEFT OUTER JOIN ("
+               "SELECT `o`.`user_id` AS `user_id`, %(select)s %(source)s "
+               "WHERE `o`.`status` = 'completed' "
+               "GROUP BY `o`.`user_id`"
+               ") `%(alias)s` ON (`%(alias)s`.`user_id` = `core_user`.`id`)") % {
+            'select': ", ".join(select),
+            'source': source,
+            'alias': self.alias,
+            }
+        return sql, params
+
+class ColumnPlanner(object):
+    """
+    Collects the output columns of a search and decides how to fetch
+    them. With the "join" strategy, columns which know how to plan
+    themselves (by defining `plan(queryset, planner)`) share one derived
+    table per source table; every other column applies its own subquery.
+    """
+
+    def __init__(self, strategy):
+        self.strategy = strategy
+        self.pivots = []
+        self.named_pivots = {}
+
+    def pivot(self, kind, factory):
+        """
+        returns the shared derived table of the given kind, creating it
+        on first use
+        """
+        if kind not in self.named_pivots:
+            self.named_pivots[kind] = factory(kind)
+            self.pivots.append(self.named_pivots[kind])
+        return self.named_pivots[kind]
+
+    def phone(self):
+        return self.pivot("phones", phone_pivot).add()
+
+    def userfield(self, name):
+        return self.pivot("userfields", userfield_pivot).add(name)
+
+    def actionfield(self, name, pages=None):
+        condition, params = None, ()
+        if pages:
+            condition = "`a`.`page_id` IN (%s)" % ", ".join(["%s"] * len(pages))
+            params = pages
+        ## Rows are picked per user and field name, so the same name can
+        ## only be requested once per derived table.
+        n = 1
+        while True:
+            kind = n == 1 and "actionfields" or "actionfields_%s" % n
+            pivot = self.pivot(kind, actionfield_pivot)
+            field = (name, condition, tuple(params))
+            if field in pivot.fields or not pivot.has_name(name):
+                return pivot.add(name, condition, params)
+            n += 1
+
+    def orders(self):
+        return self.pivot("orders", OrderRollup)
+
+    def apply(self, queryset, columns):
+        for column in columns:
+            timer = instrument.start(queryset)
+            if self.strategy == "join" and hasattr(column, "plan"):
+                queryset = column.plan(queryset, self)
+            else:
+                queryset = column(queryset)
+            instrument.record("column", column.name, timer, queryset)
+        return queryset
+
+    def joins(self):
+        return [pivot.as_join() for pivot in self.pivots]
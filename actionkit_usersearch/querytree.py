@@ -0,0 +1,179 @@
+"""
+Parses a search's include groups into a normalized tree of filters, so
+that equivalent criteria compile to one join instead of several.
+
+A search matches the users who satisfy every `shared` filter and at
+least one of the `groups`, each of which is a conjunction of filters.
+Normalizing:
+
+ * unifies "contacted by X since D" with "contacted since D by X"
+ * merges filters on the same field within a group: exclusions become
+   one NOT IN list, and inclusions on single-valued fields become one
+   IN list of the values they have in common
+ * drops duplicate filters, and groups which another group subsumes
+ * hoists filters which every group has into `shared`, so they are
+   applied once to the outer query rather than in each UNION branch
+"""
+from collections import namedtuple
+import re
+
+Filter = namedtuple("Filter", "name values istoggle extra")
+Group = namedtuple("Group", "key filters")
+SearchTree = namedtuple("SearchTree", "shared groups")
+
+INCLUDE_PATTERN = re.compile("^include:(\d+)$")
+
+def paired_params(specs):
+    """the names of the parameters which only qualify another filter"""
+    return set(param for spec in specs.values()
+               for extra_key, param in spec.get('paired', ()))
+
+def _istoggle(value):
+    try:
+        return bool(int(value))
+    except ValueError:
+        return True
+
+def _unify(filter):
+    ## "contacted_by X, since D" is the same search as
+    ## "contacted_since D, by X"; spell it one way
+    extra = dict(filter.extra)
+    if filter.name == "contacted_by" and 'contacted_since' in extra:
+        return Filter("contacted_since", (extra['contacted_since'],),
+                      filter.istoggle,
+                      (('contacted_by', filter.values[0]),))
+    return filter
+
+def parse(query_params, specs):
+    """
+    builds the normalized SearchTree of a search's QueryDict, given the
+    QUERIES specs of its filters
+    """
+    paired = paired_params(specs)
+    groups = []
+    for key in query_params.keys():
+        if not (INCLUDE_PATTERN.match(key)
+                and query_params[key]
+                and not query_params[key].endswith('_istoggle')):
+            continue
+        filters = []
+        for item in query_params.getlist(key):
+            if item in paired:
+                continue
+            values = query_params.getlist("%s_%s" % (key, item))
+            if len(values) == 0:
+                continue
+            extra = []
+            for extra_key, param in specs[item].get('paired', ()):
+                value = query_params.get("%s_%s" % (key, param))
+                if value:
+                    extra.append((extra_key, value))
+            filters.append(_unify(Filter(
+                item, tuple(sorted(set(values))),
+                _istoggle(query_params.get('%s_%s_istoggle' % (key, item), '1')),
+                tuple(sorted(extra)))))
+        if filters:
+            groups.append(Group(key, filters))
+    groups.sort(key=lambda group: int(INCLUDE_PATTERN.match(group.key).group(1)))
+    return normalize(groups, specs)
+
+def _is_list(filter, specs):
+    """whether the filter is a plain IN / NOT IN list over one field"""
+    spec = specs[filter.name]
+    return 'query_fn' not in spec or 'exists' in spec
+
+def merge_filters(filters, specs):
+    """merges the filters of one group which restrict the same field"""
+    merged = []
+    for filter in filters:
+        for i, other in enumerate(merged):
+            if filter == other:
+                break
+            if not (_is_list(filter, specs)
+                    and (filter.name, filter.istoggle, filter.extra)
+                    == (other.name, other.istoggle, other.extra)):
+                continue
+            if not filter.istoggle:
+                ## not in A and not in B: not in A or B
+                values = set(filter.values).union(other.values)
+            elif specs[filter.name].get('multivalued'):
+                ## has a row in A and has a row in B: the rows may differ,
+                ## so both filters are needed
+                continue
+            else:
+                values = set(filter.values).intersection(other.values)
+                if not values:
+                    ## matches nobody; leave it to the database to say so
+                    continue
+            merged[i] = other._replace(values=tuple(sorted(values)))
+            break
+        else:
+            merged.append(filter)
+    return merged
+
+def implies(filter, other, specs):
+    """whether every user who matches `filter` also matches `other`"""
+    if filter == other:
+        return True
+    if not (_is_list(filter, specs)
+            and (filter.name, filter.istoggle, filter.extra)
+            == (other.name, other.istoggle, other.extra)):
+        return False
+    if filter.istoggle:
+        return set(filter.values).issubset(other.values)
+    return set(filter.values).issuperset(other.values)
+
+def subsumes(group, other, specs):
+    """
+    whether `other` only matches users who `group` matches, which makes
+    `other` redundant when the two are alternatives
+    """
+    return all(any(implies(mine, filter, specs) for mine in other.filters)
+               for filter in group.filters)
+
+def drop_subsumed(groups, specs):
+    kept = []
+    for i, group in enumerate(groups):
+        redundant = False
+        for j, other in enumerate(groups):
+            if i == j or not subsumes(other, group, specs):
+                continue
+            ## of two equivalent groups keep the first
+            if j < i or not subsumes(group, other, specs):
+                redundant = True
+                break
+        if not redundant:
+            kept.append(group)
+    return kept
+
+def normalize(groups, specs):
+    groups = [group._replace(filters=merge_filters(group.filters, specs))
+              for group in groups]
+    groups = drop_subsumed(groups, specs)
+    if len(groups) < 2:
+        return SearchTree((), groups)
+
+    shared = [filter for filter in groups[0].filters
+              if all(filter in group.filters for group in groups[1:])]
+    groups = [group._replace(filters=[filter for filter in group.filters
+                                      if filter not in shared])
+              for group in groups]
+    if not all(group.filters for group in groups):
+        ## a group with nothing left matches everyone the shared
+        ## filters do, so the alternatives add nothing
+        return SearchTree((), [Group("shared", shared)])
+    groups = drop_subsumed(groups, specs)
+    if len(groups) == 1:
+        return SearchTree((), [groups[0]._replace(
+                    filters=shared + groups[0].filters)])
+    return SearchTree(shared, groups)
+
+def needs_distinct(filters, specs):
+    """
+    whether applying the filters joins a multi-valued relation, which
+    repeats users; EXISTS subqueries never do
+    """
+    return any(filter.istoggle and _is_list(filter, specs)
+               and specs[filter.name].get('multivalued')
+               and 'exists' not in specs[filter.name]
+               for filter in filters)
@@ -0,0 +1,158 @@
+"""
+Sends the builder's read-only lookups (autocomplete, choice lists and
+audience counts) to read replicas of the ActionKit database, so they
+don't compete with reports on the primary.
+
+USERSEARCH_REPLICAS lists the replicas' database aliases. Each replica
+is health-checked at most every USERSEARCH_REPLICA_CHECK_INTERVAL
+seconds. A check connects to it and reads its replication lag, and the
+replica is skipped while it is unreachable, not replicating, or more
+than USERSEARCH_REPLICA_MAX_LAG seconds behind. Reads rotate over the
+healthy replicas, and fall back to the primary ("ak") when there are
+none.
+
+Databases other than MySQL (such as local stand-ins) are never
+considered to be lagging.
+"""
+from django.conf import settings
+from django.db import DatabaseError
+import itertools
+import logging
+import threading
+import time
+
+from actionkit_usersearch import dbpool
+
+log = logging.getLogger(__name__)
+
+PRIMARY = "ak"
+
+def replica_aliases():
+    return getattr(settings, 'USERSEARCH_REPLICAS', ())
+
+def max_lag():
+    return getattr(settings, 'USERSEARCH_REPLICA_MAX_LAG', 30)
+
+def check_interval():
+    return getattr(settings, 'USERSEARCH_REPLICA_CHECK_INTERVAL', 10)
+
+class ReplicationStopped(Exception):
+    pass
+
+def replication_lag(alias):
+    """how many seconds the database is behind its primary"""
+    with dbpool.pooled(alias) as wrapper:
+        cursor = wrapper.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+        if wrapper.vendor != "mysql":
+            return 0
+        cursor.execute("SHOW SLAVE STATUS")
+        row = cursor.fetchone()
+        if row is None:
+            ## not a replica at all
+            return 0
+        status = dict(zip([column[0] for column in cursor.description], row))
+        lag = status.get('Seconds_Behind_Master',
+                         status.get('Seconds_Behind_Source'))
+        if lag is None:
+            raise ReplicationStopped("Replication is not running")
+        return int(lag)
+
+class ReplicaSet(object):
+    """the health of each replica, and which one the next read goes to"""
+
+    def __init__(self, primary=PRIMARY):
+        self.primary = primary
+        self.health = {}
+        self.lock = threading.Lock()
+        self.turns = itertools.count()
+
+    def _set_health(self, alias, lag, error):
+        health = {
+            'healthy': error is None and lag <= max_lag(),
+            'lag': lag,
+            'error': error,
+            'checked_at': time.time(),
+            }
+        with self.lock:
+            self.health[alias] = health
+        return health
+
+    def check(self, alias):
+        try:
+            lag, error = replication_lag(alias), None
+        except Exception, e:
+            lag, error = None, str(e)
+            log.warning("Replica %s failed its health check: %s", alias, e)
+        return self._set_health(alias, lag, error)
+
+    def current_health(self, alias):
+        with self.lock:
+            health = self.health.get(alias)
+        if health is None or time.time() - health['checked_at'] > check_interval():
+            health = self.check(alias)
+        return health
+
+    def read_alias(self):
+        """a healthy replica, or the primary if there is none"""
+        healthy = [alias for alias in replica_aliases()
+                   if self.current_health(alias)['healthy']]
+        if not healthy:
+            return self.primary
+        return healthy[self.turns.next() % len(healthy)]
+
+    def read(self, fn, alias=None):
+        """
+        returns fn(alias) for a read alias, with a pooled connection to
+        it; if the replica fails and is found to be down, it is retried
+        on the primary. Passing an alias skips the replicas.
+        """
+        if alias is not None:
+            with dbpool.pooled(alias):
+                return fn(alias)
+        alias = self.read_alias()
+        try:
+            with dbpool.pooled(alias):
+                return fn(alias)
+        except DatabaseError:
+            ## a query that failed on its own merits fails the same way on
+            ## the primary
+            if alias == self.primary or self.check(alias)['healthy']:
+                raise
+            log.warning("Replica %s went down; reading from %s instead",
+                        alias, self.primary)
+        with dbpool.pooled(self.primary):
+            return fn(self.primary)
+
+    def status(self):
+        with self.lock:
+            return dict((alias, dict(health))
+                        for alias, health in self.health.items())
+
+replica_set = ReplicaSet()
+
+def read_alias():
+    return replica_set.read_alias()
+
+def read(fn, alias=None):
+    return replica_set.read(fn, alias)
+
+class ReplicaRouter(object):
+    """
+    Routes reads of ActionKit's models to a healthy replica, and writes
+    to the primary. Add it to DATABASE_ROUTERS for code which doesn't
+    pick a database itself; the lookups here choose one with read().
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == "actionkit":
+            return read_alias()
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label == "actionkit":
+            return replica_set.primary
+
+    def allow_syncdb(self, db, model):
+        if db in replica_aliases():
+            return False
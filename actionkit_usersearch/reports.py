@@ -0,0 +1,122 @@
+"""
+Creates and runs ActionKit reports for searches, reusing the report
+already created for an identical search instead of making a new one
+each time.
+
+A run for a recipient whose identical run is still in flight is not
+started again; the caller gets the task of the run already under way,
+and is told so. A run is in flight until ActionKit reports its task
+finished, or for at most USERSEARCH_REPORT_COALESCE seconds.
+
+Calls go through actionkit.rest, or through the pooled client in
+restclient if USERSEARCH_REST_CLIENT is "pooled".
+"""
+from actionkit import rest
+from django.conf import settings
+from django.db import IntegrityError
+from django.db import transaction
+import datetime
+import hashlib
+import json
+import logging
+
+from actionkit_usersearch import restclient
+from actionkit_usersearch import staging
+from actionkit_usersearch.models import SearchReport, SearchReportRun
+
+log = logging.getLogger(__name__)
+
+## backgroundtask statuses of a run that is over, one way or another
+FINISHED_STATUSES = ("complete", "completed", "failed", "error")
+
+def coalesce_interval():
+    return getattr(settings, 'USERSEARCH_REPORT_COALESCE', 5 * 60)
+
+def default_client():
+    if getattr(settings, 'USERSEARCH_REST_CLIENT', None) == "pooled":
+        return restclient.get_client()
+    return rest
+
+def fingerprint(raw_sql, human_query):
+    ## exactly as given: whitespace inside string literals is data
+    text = u"%s\0%s" % (raw_sql, human_query)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def _data_hash(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+
+def _create(key, query, client):
+    slug = hashlib.sha1(
+        key + datetime.datetime.utcnow().isoformat()).hexdigest()
+    ## (https://roboticdogs.actionkit.com/docs/manual/api/rest/reports.html#creating-reports)
+    resp = client.create_report(query.raw_sql, query.human_query, slug, slug)
+    try:
+        return SearchReport.objects.create(
+            fingerprint=key, report_id=resp['id'], short_name=resp['short_name'])
+    except IntegrityError:
+        ## an identical search got there first; use its report, and
+        ## leave ours unused
+        return SearchReport.objects.get(fingerprint=key)
+
+def get_report(query, client=None):
+    """returns the SearchReport for the query, creating it if needed"""
+    key = fingerprint(query.raw_sql, query.human_query)
+    try:
+        return SearchReport.objects.get(fingerprint=key)
+    except SearchReport.DoesNotExist:
+        return _create(key, query, client or default_client())
+
+def _finished(run, client):
+    """whether the run's task is over; asks ActionKit if we don't know"""
+    if run.finished_at is not None:
+        return True
+    if not run.task_id:
+        ## claimed by a caller that is starting it right now
+        return False
+    try:
+        task = client.poll_report(run.task_id)
+    except Exception:
+        log.exception("Could not poll report task %s", run.task_id)
+        return True
+    if not (task.get('completed')
+            or task.get('status') in FINISHED_STATUSES):
+        return False
+    run.finished_at = datetime.datetime.now()
+    run.save()
+    return True
+
+def run_report(query, email_to, client=None):
+    """
+    emails the report for the query to the recipient, and returns
+    (report, task id, merged), where `merged` says the request joined
+    an identical run already in flight; `client` defaults to
+    default_client()
+    """
+    client = client or default_client()
+    report = get_report(query, client)
+    ## the run will outlive any staged id sets it joins on
+    staging.pin_sets(query.raw_sql)
+    data_hash = _data_hash(query.report_data)
+    since = datetime.datetime.now() - datetime.timedelta(
+        seconds=coalesce_interval())
+    with transaction.commit_on_success():
+        ## concurrent submits of the report queue up here, so only one
+        ## of them starts a run
+        SearchReport.objects.select_for_update().get(pk=report.pk)
+        recent = report.runs.filter(email_to=email_to, data_hash=data_hash,
+                                    started_at__gte=since).order_by("-started_at")
+        for run in recent[:1]:
+            if not _finished(run, client):
+                return report, run.task_id or None, True
+        claim = SearchReportRun.objects.create(
+            report=report, email_to=email_to, data_hash=data_hash, task_id="")
+
+    ## (https://roboticdogs.actionkit.com/docs/manual/api/rest/reports.html#running-reports-asynchronously)
+    try:
+        claim.task_id = client.run_report(report.short_name, email_to=email_to,
+                                          data=query.report_data)
+    except Exception:
+        claim.delete()
+        raise
+    claim.save()
+    return report, claim.task_id, False
@@ -0,0 +1,212 @@
+"""
+A thread-safe client for the parts of the ActionKit REST API that
+searches use, which keeps a pool of persistent connections instead of
+opening a new one per call.
+
+Calls are spread over at most USERSEARCH_REST_CONCURRENCY connections,
+limited to USERSEARCH_REST_RATE calls per second (0 for no limit), and
+retried with exponential backoff up to USERSEARCH_REST_RETRIES times
+on connection errors, 429s and 5xxs. Calls which aren't idempotent,
+such as creating a report or starting a run, are only retried on 429s,
+which ActionKit sends without acting on the call; resending them
+otherwise could create a second report or email the results twice.
+"""
+from django.conf import settings
+import base64
+import httplib
+import json
+import logging
+import Queue
+import select
+import socket
+import threading
+import time
+import urlparse
+
+log = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+class RestError(Exception):
+    def __init__(self, status, body):
+        Exception.__init__(self, "ActionKit API returned %s: %s" % (status, body))
+        self.status = status
+        self.body = body
+
+class RateLimiter(object):
+    """spaces out calls from any number of threads to `rate` per second"""
+
+    def __init__(self, rate):
+        self.interval = rate and 1.0 / rate or 0
+        self.next_at = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            at = max(now, self.next_at)
+            self.next_at = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+class ConnectionPool(object):
+    """up to `size` keep-alive connections to one host"""
+
+    def __init__(self, host, size, secure=True, timeout=30):
+        self.host = host
+        self.size = size
+        self.secure = secure
+        self.timeout = timeout
+        self.idle = Queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        cls = self.secure and httplib.HTTPSConnection or httplib.HTTPConnection
+        return cls(self.host, timeout=self.timeout)
+
+    def _dropped(self, connection):
+        """whether the server has closed an idle connection"""
+        if connection.sock is None:
+            return True
+        ## an idle connection is only readable once the server closes it
+        return bool(select.select([connection.sock], [], [], 0)[0])
+
+    def _checkout(self):
+        """an open idle connection, if there is one, and whether it is"""
+        while True:
+            try:
+                connection = self.idle.get_nowait()
+            except Queue.Empty:
+                return self._connect(), False
+            if not self._dropped(connection):
+                return connection, True
+            connection.close()
+
+    def request(self, method, path, body=None, headers={}):
+        """returns (status, response headers, response body)"""
+        with self.slots:
+            connection, reused = self._checkout()
+            try:
+                try:
+                    connection.request(method, path, body, headers)
+                    response = connection.getresponse()
+                except (httplib.BadStatusLine, socket.error):
+                    if not reused or method not in IDEMPOTENT_METHODS:
+                        raise
+                    ## the server closed the idle connection; retry once
+                    ## on a fresh one
+                    connection.close()
+                    connection = self._connect()
+                    connection.request(method, path, body, headers)
+                    response = connection.getresponse()
+                data = response.read()
+            except Exception:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self.idle.put(connection)
+            return response.status, dict(response.getheaders()), data
+
+class RestClient(object):
+    """
+    Has the same create_report and run_report calls as actionkit.rest,
+    so it can be passed to reports.run_report in its place.
+    """
+    ## seconds before the first retry; each further retry waits twice as long
+    backoff = 0.5
+
+    def __init__(self, host, user, password, concurrency=None, rate=None,
+                 retries=None):
+        if concurrency is None:
+            concurrency = getattr(settings, 'USERSEARCH_REST_CONCURRENCY', 4)
+        if rate is None:
+            rate = getattr(settings, 'USERSEARCH_REST_RATE', 0)
+        if retries is None:
+            retries = getattr(settings, 'USERSEARCH_REST_RETRIES', 3)
+        parsed = urlparse.urlparse(host if "//" in host else "//" + host)
+        self.pool = ConnectionPool(parsed.netloc, concurrency,
+                                   secure=parsed.scheme != "http")
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.headers = {
+            'Authorization': "Basic %s" % base64.b64encode(
+                "%s:%s" % (user, password)),
+            'Content-Type': "application/json",
+            'Accept': "application/json",
+            }
+
+    def call(self, method, path, payload=None):
+        """returns (status, headers, body) of a successful call"""
+        body = payload is not None and json.dumps(payload) or None
+        attempt = 0
+        while True:
+            self.limiter.wait()
+            try:
+                status, headers, data = self.pool.request(
+                    method, path, body, self.headers)
+                if status < 400:
+                    return status, headers, data
+                error = RestError(status, data)
+            except (httplib.HTTPException, socket.error), error:
+                ## the call may have reached ActionKit
+                retry = method in IDEMPOTENT_METHODS
+            else:
+                retry = status in RETRY_STATUSES and (
+                    method in IDEMPOTENT_METHODS or status == 429)
+            if not retry or attempt >= self.retries:
+                raise error
+            log.warning("ActionKit API call %s %s failed (%s); retrying",
+                        method, path, error)
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    def _path(self, location):
+        return urlparse.urlparse(location).path
+
+    def create_report(self, sql, description, name, short_name):
+        ## hidden, so searches' reports stay out of ActionKit's report list
+        status, headers, data = self.call("POST", "/rest/v1/queryreport/", {
+                'name': name,
+                'short_name': short_name,
+                'description': description,
+                'sql': sql,
+                'hidden': True,
+                })
+        return {'id': self._path(headers['location']).strip("/").split("/")[-1],
+                'short_name': short_name}
+
+    def run_report(self, short_name, email_to=None, data=None):
+        payload = dict(data or {})
+        ## a reused report must not email its cached results
+        payload['refresh'] = True
+        payload['full_recalc'] = True
+        if email_to is not None:
+            payload['use_email'] = True
+            payload['email'] = email_to
+        status, headers, body = self.call(
+            "POST", "/rest/v1/report/background/%s/" % short_name, payload)
+        ## the task id, as actionkit.rest returns it
+        return self._path(headers['location']).strip("/").split("/")[-1]
+
+    def poll_report(self, task_id):
+        status, headers, data = self.call(
+            "GET", "/rest/v1/backgroundtask/%s/" % task_id)
+        return json.loads(data)
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """the shared client for the configured ActionKit instance"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = RestClient(settings.ACTIONKIT_API_HOST,
+                                 settings.ACTIONKIT_API_USER,
+                                 settings.ACTIONKIT_API_PASSWORD)
+    return _client
@@ -0,0 +1,157 @@
+"""
+Keeps the audiences of SavedSearches up to date without re-running the
+whole search each time.
+
+A run looks for users with rows created or updated in the tables that
+searches filter on since the last run's watermarks, re-runs the search
+over just those users, and patches their membership into the saved
+snapshot; everyone else keeps the membership they had.
+
+Deleted rows, and edits to pages, tags and SearchColumns, are not seen
+as changes; run with full=True after any of those.
+"""
+from django.db import connections
+import base64
+import datetime
+import dateutil.parser
+import json
+
+from actionkit_usersearch.bitmap import IdBitmap
+from actionkit_usersearch.export import stream_batches
+from actionkit_usersearch.models import AudienceSnapshot, SavedSearchRun
+from actionkit_usersearch.search_functions import CONTACT_CHUNK_SIZE
+from actionkit_usersearch.search_functions import build_count_queries
+from actionkit_usersearch.search_functions import contact_record_akids
+from actionkit_usersearch.search_functions import filter_user_ids
+from actionkit_usersearch.sql import interpolate
+
+## (table, user id column, change timestamp column) for every ActionKit
+## table a search can filter on
+CHANGE_SOURCES = (
+    ('core_user', 'id', 'updated_at'),
+    ('core_action', 'user_id', 'updated_at'),
+    ('core_order', 'user_id', 'updated_at'),
+    ('core_userfield', 'parent_id', 'updated_at'),
+    ('core_open', 'user_id', 'created_at'),
+    )
+
+def contact_records():
+    """
+    all ContactRecords, or None if the installed ActionKit models have
+    none (in which case no search can filter on them either)
+    """
+    try:
+        from actionkit.models import ContactRecord
+    except ImportError:
+        return None
+    return ContactRecord.objects.all()
+
+def _ids(raw_sql, alias):
+    batches = stream_batches(raw_sql, alias)
+    batches.next()
+    for rows in batches:
+        for row in rows:
+            yield row[0]
+
+def current_watermarks(alias="ak"):
+    """the newest change in each source, to be stored after a run"""
+    cursor = connections[alias].cursor()
+    watermarks = {}
+    for table, user_column, time_column in CHANGE_SOURCES:
+        cursor.execute("SELECT MAX(`%s`) FROM `%s`" % (time_column, table))
+        newest = cursor.fetchone()[0]
+        if newest is not None:
+            watermarks[table] = newest.isoformat()
+    contacts = contact_records()
+    if contacts is not None:
+        newest = contacts.order_by("-pk").values_list("pk", flat=True)[:1]
+        if newest:
+            watermarks['contact_record'] = newest[0]
+    return watermarks
+
+def changed_users(watermarks, alias="ak"):
+    """
+    returns an IdBitmap of the users with changes at or after the given
+    watermarks; rows changed in the same second as a watermark are read
+    again, which is harmless
+    """
+    changed = IdBitmap()
+    for table, user_column, time_column in CHANGE_SOURCES:
+        if table in watermarks:
+            since = dateutil.parser.parse(watermarks[table])
+            where = "WHERE `%s` >= %%s" % time_column
+            params = [since]
+        else:
+            ## a source with no rows at the last run: every row is new
+            where, params = "", []
+        raw_sql = interpolate(
+            "SELECT DISTINCT `%s` FROM `%s` %s" % (user_column, table, where),
+            params)
+        changed = changed | IdBitmap.from_ids(_ids(raw_sql, alias))
+    contacts = contact_records()
+    if contacts is None:
+        return changed
+    contacts = contacts.filter(akid__isnull=False)
+    if 'contact_record' in watermarks:
+        contacts = contacts.filter(pk__gt=watermarks['contact_record'])
+    changed = changed | IdBitmap.from_ids(
+        akid for chunk in contact_record_akids(contacts) for akid in chunk)
+    return changed
+
+def evaluate(querystring, users=None, alias="ak"):
+    """
+    returns an IdBitmap of the users the search matches, considering
+    only the users in the `users` IdBitmap if one is given
+    """
+    if users is None:
+        base_modifier_fn = None
+    else:
+        base_modifier_fn = lambda base: filter_user_ids(
+            base, users.batches(CONTACT_CHUNK_SIZE), True)
+    human_query, raw_sql = build_count_queries(
+        querystring, base_modifier_fn)[-1]
+    return IdBitmap.from_ids(_ids(raw_sql, alias))
+
+def refresh(saved_search, full=False, alias="ak"):
+    """
+    brings the saved search's snapshot up to date, and returns a
+    SavedSearchRun recording who joined and left its audience
+    """
+    watermarks = current_watermarks(alias)
+    previous = saved_search.snapshot
+    incremental = previous is not None and not full
+    if incremental:
+        old = previous.bitmap()
+        checked = changed_users(json.loads(saved_search.watermarks), alias)
+        new = old
+        if len(checked):
+            new = (old - checked) | evaluate(
+                saved_search.query_string, checked, alias)
+        users_checked = len(checked)
+    else:
+        old = previous.bitmap() if previous is not None else IdBitmap()
+        new = evaluate(saved_search.query_string, alias=alias)
+        users_checked = None
+
+    human_query = build_count_queries(saved_search.query_string)[-1][0]
+    snapshot = previous or AudienceSnapshot(name=saved_search.name)
+    snapshot.query_string = saved_search.query_string
+    snapshot.human_query = human_query
+    snapshot.set_bitmap(new)
+    snapshot.save()
+
+    added = new - old
+    removed = old - new
+    saved_search.snapshot = snapshot
+    saved_search.watermarks = json.dumps(watermarks)
+    saved_search.last_run_at = datetime.datetime.now()
+    saved_search.save()
+
+    return SavedSearchRun.objects.create(
+        saved_search=saved_search,
+        incremental=incremental,
+        users_checked=users_checked,
+        added_count=len(added),
+        removed_count=len(removed),
+        added=base64.b64encode(added.to_bytes()),
+        removed=base64.b64encode(removed.to_bytes()))
@@ -1,19 +1,24 @@
-from actionkit import rest
 from actionkit.models import *
 from collections import namedtuple
-import datetime
 import dateutil.parser
-from django.db.models import Count
-from django.db.models import Sum
+from django.conf import settings
+from django.db.models import Q
 from django.http import QueryDict
-from django.template.defaultfilters import slugify
 import hashlib
 import re
 
+from actionkit_usersearch import instrument
+from actionkit_usersearch import planner
+from actionkit_usersearch import querytree
+from actionkit_usersearch import reports
 from actionkit_usersearch import sql
-from actionkit_usersearch.models import SearchColumn
+from actionkit_usersearch import staging
+from actionkit_usersearch.bitmap import IdBitmap
+from actionkit_usersearch.cache import LRUCache
+from actionkit_usersearch.models import AudienceSnapshot, SearchColumn
 from actionkit_usersearch.utils import latlon_bbox
 from actionkit_usersearch.utils import zipcode_to_latlon
+from actionkit_usersearch.zipcodes import zipcodes_within
 
 
 def make_default_user_query(users, query_data, values, search_on, extra_data={}):
@@ -44,6 +49,28 @@ def make_default_user_query(users, query_data, values, search_on, extra_data={})
         human_query = u"%s is not in (%s)" % (search_on, u', '.join(values))
     return users, human_query
 
+def make_exists_query(users, query_data, values, search_on, extra_data={}):
+    """
+    filters on a relation users have many rows in with a correlated
+    EXISTS (or, if not istoggle, NOT EXISTS) subquery, so the user query
+    keeps one row per user and needs no DISTINCT
+    """
+    subquery = query_data['exists'] % ", ".join(["%s"] * len(values))
+    if extra_data.get('istoggle', True):
+        users = users.extra(where=["EXISTS (%s)" % subquery], params=values)
+        human_query = u"%s is in (%s)" % (search_on, u', '.join(values))
+    else:
+        users = users.extra(where=["NOT EXISTS (%s)" % subquery], params=values)
+        human_query = u"%s is not in (%s)" % (search_on, u', '.join(values))
+    return users, human_query
+
+def userfield_exists(name):
+    """the EXISTS subquery for a userfield filter"""
+    return ("SELECT 1 FROM `core_userfield` "
+            "WHERE `core_userfield`.`parent_id` = `core_user`.`id` "
+            "AND `core_userfield`.`name` = '%s' "
+            "AND `core_userfield`.`value` IN (%%s)" % name)
+
 def make_date_query(users, query_data, values, search_on, extra_data={}):
     date = values[0]
     match = dateutil.parser.parse(date)
@@ -67,13 +94,27 @@ def make_zip_radius_query(users, query_data, values, search_on, extra_data={}):
         bbox = latlon_bbox(lat, lon, distance)
         assert bbox is not None, "Bad bounding box for latlon: %s,%s" % (lat, lon)
         lat1, lat2, lon1, lon2 = bbox
+        in_radius = Q(location__latitude__range=(lat1, lat2),
+                      location__longitude__range=(lon1, lon2))
+        ## Match members by the zip codes whose centroids are in range,
+        ## and fall back to their geocoded location if their zip code
+        ## isn't in the index (none, a foreign one, or one missing from
+        ## the file). Known zip codes out to the corners of the bounding
+        ## box are out of range, so they don't get the fallback.
+        zipcodes = zipcodes_within(lat, lon, distance)
+        if zipcodes is not None:
+            outside = set(zipcodes_within(lat, lon, distance * 1.5))
+            outside.difference_update(zipcodes)
+            if outside:
+                ## (NOT IN is never true of a NULL zip)
+                in_radius = in_radius & (
+                    ~Q(zip__in=sorted(outside)) | Q(zip__isnull=True))
+            in_radius = Q(zip__in=zipcodes) | in_radius
         if extra_data.get('istoggle', True):
-            users = users.filter(location__latitude__range=(lat1, lat2),
-                                 location__longitude__range=(lon1, lon2))
+            users = users.filter(in_radius)
             human_query = "within %s miles of %s" % (distance, zipcode)
         else:
-            users = users.exclude(location__latitude__range=(lat1, lat2),
-                                  location__longitude__range=(lon1, lon2))
+            users = users.exclude(in_radius)
             human_query = "not within %s miles of %s" % (distance, zipcode)
     else:
         if extra_data.get('istoggle', True):
@@ -85,6 +126,64 @@ def make_zip_radius_query(users, query_data, values, search_on, extra_data={}):
     return users, human_query
 
 
+CONTACT_CHUNK_SIZE = 10000
+
+def contact_record_akids(search):
+    """
+    yields the akids of the contact records matched by the search in
+    chunks, paging by primary key so only one chunk is held in memory
+    """
+    search = search.order_by("pk").values_list("pk", "akid")
+    last_pk = None
+    while True:
+        chunk = search
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:CONTACT_CHUNK_SIZE])
+        if not chunk:
+            return
+        last_pk = chunk[-1][0]
+        yield [akid for pk, akid in chunk]
+
+def _filter_contacted(users, search, istoggle):
+    """
+    filters users to those who do (or, if not istoggle, do not) appear
+    in the search over contact records
+    """
+    search = search.filter(akid__isnull=False)
+    operator = istoggle and "IN" or "NOT IN"
+    if sql.same_database(search.db, users.db):
+        ## A semi-join against the contact records themselves
+        subquery, params = sql.compile_queryset(
+            search.values_list("akid", flat=True))
+        return users.extra(
+            where=["`core_user`.`id` %s (%s)" % (operator, subquery)],
+            params=list(params))
+    return filter_user_ids(users, contact_record_akids(search), istoggle)
+
+def filter_user_ids(users, chunks, istoggle):
+    """
+    filters users to those whose ids are (or, if not istoggle, are not)
+    in the given chunks of ids, which come from outside the ActionKit
+    database
+    """
+    if staging.staging_database() is not None:
+        ## Copy the ids into the ActionKit database, and semi-join
+        ## against that
+        operator = istoggle and "IN" or "NOT IN"
+        key = staging.stage_ids(chunks)
+        subquery, params = staging.staged_ids_subquery(key)
+        return users.extra(
+            where=["`core_user`.`id` %s (%s)" % (operator, subquery)],
+            params=list(params))
+    ids = [id for chunk in chunks for id in chunk]
+    if len(ids) == 0:
+        ## TODO give a helpful error message, not a mysterious always-null query
+        ids = [0]
+    if istoggle:
+        return users.filter(id__in=ids)
+    return users.exclude(id__in=ids)
+
 def make_contact_since_query(users, query_data, values, search_on, extra_data={}):
     contacted_since = values[0]
     match = dateutil.parser.parse(contacted_since)
@@ -94,15 +193,11 @@ def make_contact_since_query(users, query_data, values, search_on, extra_data={}
         contacted_by = extra_data['contacted_by']
         search = search.filter(user__username=contacted_by)
         human_query.append("by %s" % contacted_by)
-    akids = list(search.values_list("akid", flat=True))
-    if len(akids) == 0:
-        ## TODO give a helpful error message, not a mysterious always-null query
-        akids = [0]
-    if extra_data.get('istoggle', True):
-        users = users.filter(id__in=akids)
+    istoggle = extra_data.get('istoggle', True)
+    users = _filter_contacted(users, search, istoggle)
+    if istoggle:
         human_query = " ".join(human_query)
     else:
-        users = users.exclude(id__in=akids)
         human_query = 'not %s' % (" ".join(human_query))
     return users, human_query
 
@@ -116,31 +211,55 @@ def make_contact_by_query(users, query_data, values, search_on, extra_data={}):
         match = dateutil.parser.parse(contacted_since)
         search = search.filter(completed_at__gt=match)
         human_query.append("since %s" % contacted_since)
-    akids = list(search.values_list("akid", flat=True))
-    if len(akids) == 0:
-        ## TODO give a helpful error message, not a mysterious always-null query
-        akids = [0]
-    if extra_data.get('istoggle', True):
-        users = users.filter(id__in=akids)
+    istoggle = extra_data.get('istoggle', True)
+    users = _filter_contacted(users, search, istoggle)
+    if istoggle:
         human_query = " ".join(human_query)
     else:
-        users = users.exclude(id__in=akids)
         human_query = 'not %s' % (" ".join(human_query))
     return users, human_query
 
+def make_snapshot_query(users, query_data, values, search_on, extra_data={}):
+    snapshots = AudienceSnapshot.objects.filter(
+        id__in=[int(value) for value in values]).order_by("id")
+    bitmap = IdBitmap()
+    for snapshot in snapshots:
+        bitmap = bitmap | snapshot.bitmap()
+    names = ", ".join(snapshot.name for snapshot in snapshots)
+    istoggle = extra_data.get('istoggle', True)
+    users = filter_user_ids(users, bitmap.batches(CONTACT_CHUNK_SIZE), istoggle)
+    if istoggle:
+        human_query = "in saved audience %s" % names
+    else:
+        human_query = "not in saved audience %s" % names
+    return users, human_query
+
+def _filter_aggregate(users, subquery, params, istoggle):
+    """
+    filters users to those whose ids are (or, if not istoggle, are not)
+    selected by the grouped subquery over a fact table, so the fact
+    table is never joined into the user query itself
+    """
+    operator = istoggle and "IN" or "NOT IN"
+    return users.extra(
+        where=["`core_user`.`id` %s (%s)" % (operator, subquery)],
+        params=params)
+
 def make_emails_opened_query(users, query_data, values, search_on, extra_data={}):
     num_opens = values[0]
     num_opens = int(num_opens)
     human_query = "opened at least %s emails" % num_opens
+    where, params = "", []
     if 'since' in extra_data:
         since = dateutil.parser.parse(extra_data['since'])
-        users = users.filter(email_opens__created_at__gte=since)
+        where, params = "WHERE `created_at` >= %s ", [since]
         human_query += " since %s" % since
-    users = users.annotate(num_opens=Count('email_opens', distinct=True))
-    if extra_data.get('istoggle', True):
-        users = users.filter(num_opens__gte=num_opens)
-    else:
-        users = users.exclude(num_opens__gte=num_opens)
+    users = _filter_aggregate(
+        users,
+        "SELECT `user_id` FROM `core_open` %s"
+        "GROUP BY `user_id` HAVING COUNT(*) >= %%s" % where,
+        params + [num_opens], extra_data.get('istoggle', True))
+    if not extra_data.get('istoggle', True):
         human_query = 'not %s' % human_query
     return users, human_query
 
@@ -149,15 +268,17 @@ def make_more_actions_since_query(users, query_data, values, search_on, extra_da
     num_actions = values[0]
     num_actions = int(num_actions)
     human_query = 'more than %s actions' % num_actions
+    where, params = "", []
     if 'since' in extra_data:
         since = dateutil.parser.parse(extra_data['since'])
-        users = users.filter(action__created_at__gte=since)
+        where, params = "WHERE `created_at` >= %s ", [since]
         human_query += ' since %s' % extra_data['since']
-    users = users.annotate(num_actions=Count('action', distinct=True))
-    if extra_data.get('istoggle', True):
-        users = users.filter(num_actions__gt=num_actions)
-    else:
-        users = users.exclude(num_actions__gt=num_actions)
+    users = _filter_aggregate(
+        users,
+        "SELECT `user_id` FROM `core_action` %s"
+        "GROUP BY `user_id` HAVING COUNT(*) > %%s" % where,
+        params + [num_actions], extra_data.get('istoggle', True))
+    if not extra_data.get('istoggle', True):
         human_query = 'not %s' % human_query
     return users, human_query
 
@@ -168,16 +289,16 @@ def make_donated_more_than_query(users, query_data, values, search_on, extra_dat
     else:
         human_query = 'has not donated more than %s' % values[0]
     total_donated = float(values[0])
+    where, params = "", []
     if 'since' in extra_data:
         since = dateutil.parser.parse(extra_data['since'])
-        users = users.filter(orders__created_at__gte=since)
+        where, params = "AND `created_at` >= %s ", [since]
         human_query += ' since %s' % extra_data['since']
-    users = users.filter(orders__status='completed')
-    users = users.annotate(total_orders=Sum('orders__total'))
-    if extra_data.get('istoggle', True):
-        users = users.filter(total_orders__gte=total_donated)
-    else:
-        users = users.exclude(total_orders__gte=total_donated)
+    users = _filter_aggregate(
+        users,
+        "SELECT `user_id` FROM `core_order` WHERE `status` = 'completed' %s"
+        "GROUP BY `user_id` HAVING SUM(`total`) >= %%s" % where,
+        params + [total_donated], extra_data.get('istoggle', True))
     return users, human_query
 
 
@@ -187,19 +308,23 @@ def make_donated_times_query(users, query_data, values, search_on, extra_data={}
     else:
         human_query = 'has not donated more than %s times' % values[0]
     times_donated = int(values[0])
+    where, params = "", []
     if 'since' in extra_data:
         since = dateutil.parser.parse(extra_data['since'])
-        users = users.filter(orders__created_at__gte=since)
+        where, params = "AND `created_at` >= %s ", [since]
         human_query += ' since %s' % extra_data['since']
-    users = users.filter(orders__status='completed')
-    users = users.annotate(n_orders=Count('orders', distinct=True))
-    if extra_data.get('istoggle', True):
-        users = users.filter(n_orders__gte=times_donated)
-    else:
-        users = users.exclude(n_orders__gte=times_donated)
+    users = _filter_aggregate(
+        users,
+        "SELECT `user_id` FROM `core_order` WHERE `status` = 'completed' %s"
+        "GROUP BY `user_id` HAVING COUNT(*) >= %%s" % where,
+        params + [times_donated], extra_data.get('istoggle', True))
     return users, human_query
 
 
+## 'multivalued' marks lookups through a relation a user can have many
+## rows in, which 'exists' compiles to a correlated subquery; 'paired'
+## lists (extra_data key, parameter) for the values which qualify a
+## filter in the same include group
 QUERIES = {
     'country': {
         'query': "country",
@@ -214,33 +339,48 @@ QUERIES = {
         'query': "city",
         },
     'action': {
-        'query': "action__page__id",
+        'query_fn': make_exists_query,
+        'exists': ("SELECT 1 FROM `core_action` "
+                   "WHERE `core_action`.`user_id` = `core_user`.`id` "
+                   "AND `core_action`.`page_id` IN (%s)"),
+        'multivalued': True,
         },
     'source': {
         'query': "source",
         },
     'tag': {
-        'query': "action__page__pagetags__tag__id",
+        'query_fn': make_exists_query,
+        'exists': ("SELECT 1 FROM `core_action` "
+                   "JOIN `core_page_tags` "
+                   "ON `core_page_tags`.`page_id` = `core_action`.`page_id` "
+                   "WHERE `core_action`.`user_id` = `core_user`.`id` "
+                   "AND `core_page_tags`.`tag_id` IN (%s)"),
+        'multivalued': True,
         },
     'campus': {
-        'query': "fields__value",
-        'extra': {"fields__name": "campus"},
+        'query_fn': make_exists_query,
+        'exists': userfield_exists("campus"),
+        'multivalued': True,
         },
     'skills': {
-        'query': "fields__value",
-        'extra': {"fields__name": "skills"},
+        'query_fn': make_exists_query,
+        'exists': userfield_exists("skills"),
+        'multivalued': True,
         },
     'engagement_level': {
-        'query': "fields__value",
-        'extra': {"fields__name": "engagement_level"},
+        'query_fn': make_exists_query,
+        'exists': userfield_exists("engagement_level"),
+        'multivalued': True,
         },
     'student': {
-        'query': "fields__value",
-        'extra': {"fields__name": "student"},
+        'query_fn': make_exists_query,
+        'exists': userfield_exists("student"),
+        'multivalued': True,
         },
     'affiliation': {
-        'query': "fields__value",
-        'extra': {"fields__name": "affiliation"},
+        'query_fn': make_exists_query,
+        'exists': userfield_exists("affiliation"),
+        'multivalued': True,
         },
     'language': {
         'query': "lang__id",
@@ -255,139 +395,166 @@ QUERIES = {
         },
     'zipcode': {
         'query_fn': make_zip_radius_query,
+        'paired': (("distance", "zipcode__distance"),),
         },
     'contacted_since': {
         'query_fn': make_contact_since_query,
+        'paired': (("contacted_by", "contacted_since__contacted_by"),),
         },
     'contacted_by': {
         'query_fn': make_contact_by_query,
+        'paired': (("contacted_since", "contacted_by__contacted_since"),),
         },
     'emails_opened': {
         'query_fn': make_emails_opened_query,
+        'paired': (("since", "emails_opened__since"),),
         },
     'more_actions': {
         'query_fn': make_more_actions_since_query,
+        'paired': (("since", "more_actions__since"),),
         },
     'donated_more': {
         'query_fn': make_donated_more_than_query,
+        'paired': (("since", "donated_more__since"),),
         },
     'donated_times': {
         'query_fn': make_donated_times_query,
+        'paired': (("since", "donated_times__since"),),
+        },
+    'snapshot': {
+        'query_fn': make_snapshot_query,
         },
     }
 
+USERFIELD_COLUMNS = ('campus', 'skills', 'engagement_level', 'affiliation')
+
+def add_default_columns(users, column_planner):
+    """
+    adds the output columns that every search report includes
+    """
+    select = {'name': "CONCAT(CONCAT(first_name, \" \"), last_name)"}
+    if column_planner.strategy == "join":
+        select['phone'] = column_planner.phone()
+        for name in USERFIELD_COLUMNS:
+            select[name] = column_planner.userfield(name)
+    else:
+        select['phone'] = (
+            "SELECT `normalized_phone` FROM `core_phone` "
+            "WHERE `core_phone`.`user_id`=`core_user`.`id` "
+            "LIMIT 1")
+        for name in USERFIELD_COLUMNS:
+            select[name] = (
+                "SELECT `value` from `core_userfield` "
+                "WHERE`core_userfield`.`parent_id`=`core_user`.`id` "
+                'AND `core_userfield`.`name`="%s" LIMIT 1' % name)
+    return users.extra(select=select)
+
 Query = namedtuple("Query", "human_query query_string raw_sql report_data")
 
-def build_query(querystring, queryset_modifier_fn=None):
-    query_params = QueryDict(querystring)
+query_cache = LRUCache(
+    maxsize=getattr(settings, 'USERSEARCH_QUERY_CACHE_SIZE', 256),
+    ttl=getattr(settings, 'USERSEARCH_QUERY_CACHE_TTL', 300))
 
-    base_user_query = CoreUser.objects.using("ak").order_by("id")
-    
-    includes = []
+def invalidate_query_cache():
+    query_cache.invalidate()
 
-    include_pattern = re.compile("^include:\d+$")
+def canonical_querystring(query_params):
+    """
+    returns a hashable form of the search which ignores parameter
+    order, include group numbering and include groups with no criteria
+    """
+    group_pattern = re.compile("^(include:\d+)(_.*)?$")
+    groups = {}
+    params = []
     for key in query_params.keys():
-        if (include_pattern.match(key)
-            and query_params[key]
-            and (not query_params[key].endswith('_istoggle'))):
-            includes.append((key, query_params.getlist(key)))
+        ## empty values are kept: "country is ''" is a filter, where a
+        ## country with no values at all is none
+        values = tuple(query_params.getlist(key))
+        match = group_pattern.match(key)
+        if match is None:
+            params.append((key, values))
+        else:
+            groups.setdefault(match.group(1), []).append(
+                (match.group(2) or '', values))
+    canonical_groups = []
+    for group, items in groups.items():
+        if not query_params.get(group):
+            continue
+        canonical_groups.append(tuple(sorted(items)))
+    return (tuple(sorted(canonical_groups)), tuple(sorted(params)))
+
+def column_version(column_names):
+    """
+    returns a stamp which changes whenever any of the named SearchColumns
+    is added, removed or edited
+    """
+    rows = SearchColumn.objects.filter(name__in=column_names).values_list(
+        "name", "type", "parameters").order_by("name")
+    return hashlib.sha1(repr(list(rows))).hexdigest()
+
+def build_query(querystring, queryset_modifier_fn=None, id_range=None):
+    if queryset_modifier_fn is not None or id_range is not None:
+        return _build_query(querystring, queryset_modifier_fn, id_range)
 
+    query_params = QueryDict(querystring)
+    key = (canonical_querystring(query_params),
+           column_version(query_params.getlist("column")))
+    query = query_cache.get(key)
+    if query is None:
+        if instrument.enabled():
+            trace = trace_search(querystring, instrument.explain_enabled())
+            instrument.log_trace(trace)
+            query = trace.query
+        else:
+            query = _build_query(querystring)
+        query_cache.set(key, query)
+    return query._replace(query_string=querystring)
+
+def apply_filters(users, filters, label):
+    """
+    applies querytree Filters to the users, returning the queryset and
+    the human query of each filter
+    """
     human_query = []
+    for filter in filters:
+        query_data = QUERIES[filter.name]
+        extra_data = dict(filter.extra)
+        extra_data['istoggle'] = filter.istoggle
+        make_query_fn = query_data.get('query_fn', make_default_user_query)
+        timer = instrument.start(users)
+        users, _human_query = make_query_fn(
+            users, query_data, list(filter.values), filter.name, extra_data)
+        instrument.record("filter", "%s %s" % (label, filter.name),
+                          timer, users, _human_query)
+        human_query.append(_human_query)
+    return users, human_query
 
-    all_user_queries = []
-    for include_group in includes:
-        users = base_user_query
-        _human_query = []
-        for item in include_group[1]:
-            ## "distance" is handled in a group with "zipcode", so we ignore it here
-            if item == "zipcode__distance":
-                continue
-            ## same for "contacted_by", in a group with "contacted_since"
-            if item == "contacted_since__contacted_by":
-                continue
-            if item == "contacted_by__contacted_since":
-                continue
-            ## ditto
-            if item == 'more_actions__since':
-                continue
-
-            possible_values = query_params.getlist(
-                "%s_%s" % (include_group[0], item))
-            if len(possible_values) == 0:
-                continue
-            query_data = QUERIES[item]
-            extra_data = {}
-
-            istogglename = '%s_%s_istoggle' % (include_group[0], item)
-            istoggle = query_params.get(istogglename, '1')
-            try:
-                istoggle = bool(int(istoggle))
-            except ValueError:
-                istoggle = True
-            extra_data['istoggle'] = istoggle
-
-            ## XXX special cased zip code and distance
-            # these two fields are together, if we have another case like this
-            # we should probably formalize this
-            if item == "zipcode":
-                distance = query_params.get('%s_zipcode__distance' % include_group[0])
-                if distance:
-                    extra_data['distance'] = distance
-
-            ## XXX special cased contacted_since and contacted_by
-            # these two fields are together, if we have another case like this
-            # we should probably formalize this
-            if item == "contacted_since":
-                contacted_by = query_params.get(
-                    '%s_contacted_since__contacted_by' % include_group[0])
-                if contacted_by:
-                    extra_data['contacted_by'] = contacted_by
-
-            if item == "contacted_by":
-                contacted_since = query_params.get(
-                    '%s_contacted_by__contacted_since' % include_group[0])
-                if contacted_since:
-                    extra_data['contacted_since'] = contacted_since
-
-            if item == "emails_opened":
-                since = query_params.get('%s_emails_opened__since' % include_group[0])
-                if since:
-                    extra_data['since'] = since
-            if item == "more_actions":
-                since = query_params.get('%s_more_actions__since' % include_group[0])
-                if since:
-                    extra_data['since'] = since
-            if item == "donated_more":
-                since = query_params.get('%s_donated_more__since' % include_group[0])
-                if since:
-                    extra_data['since'] = since
-            if item == "donated_times":
-                since = query_params.get('%s_donated_times__since' % include_group[0])
-                if since:
-                    extra_data['since'] = since
-
-            make_query_fn = query_data.get('query_fn', make_default_user_query)
-            users, __human_query = make_query_fn(
-                users, query_data, possible_values, item, extra_data)
-            _human_query.append(__human_query)
-
-        if not _human_query or (
+def build_include_groups(groups, base_user_query):
+    """
+    returns a (queryset, human query) pair for each querytree Group
+    which has any criteria
+    """
+    built = []
+    for group in groups:
+        group_timer = instrument.start(base_user_query)
+        users, human_query = apply_filters(
+            base_user_query, group.filters, group.key)
+
+        if not human_query or (
             users.query.sql_with_params() == base_user_query.query.sql_with_params()):
             continue
 
-        all_user_queries.append(users)
-        human_query.append("(%s)" % " and ".join(_human_query))
+        built.append((users, "(%s)" % " and ".join(human_query)))
+        instrument.record("group", group.key, group_timer, users,
+                          built[-1][1])
 
-    human_query = "\n or ".join(human_query)
-    users = None
-    for i, query in enumerate(all_user_queries):
-        if i == 0:
-            users = query
-        else:
-            users = users | query
-    if users is None:
-        users = base_user_query
+    return built
 
+def add_user_filters(users, query_params, human_query):
+    """
+    applies the name, email and akid fields of the search, which apply
+    on top of the include groups
+    """
     ### If both of user_name and user_email are filled out,
     ### search for anyone who matches EITHER condition, rather than both.
     extra_where = []
@@ -413,34 +580,81 @@ def build_query(querystring, queryset_modifier_fn=None):
         users = users.extra(
             where=extra_where,
             params=extra_params)
+    return users, human_query
 
-    users = users.extra(select={'phone': (
-                "SELECT `normalized_phone` FROM `core_phone` "
-                "WHERE `core_phone`.`user_id`=`core_user`.`id` "
-                "LIMIT 1"),
-                                'name': (
-                "CONCAT(CONCAT(first_name, \" \"), last_name)"),
-                                'campus': (
-                "SELECT `value` from `core_userfield` "
-                "WHERE`core_userfield`.`parent_id`=`core_user`.`id` "
-                'AND `core_userfield`.`name`="campus" LIMIT 1'),
-                                'skills': (
-                "SELECT `value` from `core_userfield` "
-                "WHERE`core_userfield`.`parent_id`=`core_user`.`id` "
-                'AND `core_userfield`.`name`="skills" LIMIT 1'),
-                                'engagement_level': (
-                "SELECT `value` from `core_userfield` "
-                "WHERE`core_userfield`.`parent_id`=`core_user`.`id` "
-                'AND `core_userfield`.`name`="engagement_level" LIMIT 1'),
-                                'affiliation': (
-                "SELECT `value` from `core_userfield` "
-                "WHERE`core_userfield`.`parent_id`=`core_user`.`id` "
-                'AND `core_userfield`.`name`="affiliation" LIMIT 1'),
-                                })
+def add_subscription_filter(users, query_params, human_query):
+    if not query_params.get('subscription_all_users', False):
+        users = users.filter(subscription_status='subscribed')
+        human_query += "\n and subscription_status is 'subscribed'"
+    return users, human_query
+
+def union_join(groups):
+    """
+    returns a join which restricts core_user to the union of the ids
+    selected by each include group
+
+    Each group is planned as its own id query, so MySQL never has to
+    optimize one big OR across every group's joins, and the UNION
+    removes duplicates so the outer query needs no DISTINCT.
+    """
+    union_sql = []
+    union_params = []
+    for users, human_query in groups:
+        group_sql, group_params = sql.compile_queryset(
+            users.order_by().values_list("id", flat=True))
+        union_sql.append(group_sql)
+        union_params.extend(group_params)
+    return ("INNER JOIN (%s) `included` ON (`included`.`id` = `core_user`.`id`)" % (
+            " UNION ".join(union_sql)), union_params)
+
+def restrict_id_range(users, id_range):
+    """restricts the users to ids in the half-open range (start, stop)"""
+    start, stop = id_range
+    return users.filter(id__gte=start, id__lt=stop)
+
+def _build_query(querystring, queryset_modifier_fn=None, id_range=None):
+    query_params = QueryDict(querystring)
+
+    base_user_query = CoreUser.objects.using("ak").order_by("id")
+    if id_range is not None:
+        ## every include group starts from the base query, so each one
+        ## (and every branch of a UNION) only reads ids in the range
+        base_user_query = restrict_id_range(base_user_query, id_range)
+
+    tree = querytree.parse(query_params, QUERIES)
+    groups = build_include_groups(tree.groups, base_user_query)
+    human_query = "\n or ".join(group[1] for group in groups)
+    joins = []
+    if tree.shared:
+        ## the filters every group has are applied once, outside the UNION
+        users, shared_human_query = apply_filters(
+            base_user_query, tree.shared, "shared")
+        if groups:
+            joins.append(union_join(groups))
+            ## but the search is described the way the user grouped it,
+            ## with the shared filters inside each group's parentheses
+            human_query = "\n or ".join(
+                "(%s and %s)" % (" and ".join(shared_human_query), human[1:-1])
+                for group_users, human in groups)
+        else:
+            human_query = "(%s)" % " and ".join(shared_human_query)
+    elif len(groups) > 1:
+        users = base_user_query
+        joins.append(union_join(groups))
+    elif groups:
+        users = groups[0][0]
+    else:
+        users = base_user_query
+
+    users, human_query = add_user_filters(users, query_params, human_query)
+
+    column_planner = planner.ColumnPlanner(planner.column_strategy())
+    timer = instrument.start(users)
+    users = add_default_columns(users, column_planner)
+    instrument.record("column", "default columns", timer, users)
 
     columns = SearchColumn.objects.filter(name__in=query_params.getlist("column"))
-    for column in columns:
-        users = column.load()(users)
+    users = column_planner.apply(users, [column.load() for column in columns])
 
     if users.query.sql_with_params() == base_user_query.query.sql_with_params():
         users = base_user_query.none()
@@ -448,36 +662,87 @@ def build_query(querystring, queryset_modifier_fn=None):
     if queryset_modifier_fn is not None:
         users = queryset_modifier_fn(users)
 
-    if not query_params.get('subscription_all_users', False):
-        users = users.filter(subscription_status='subscribed')
-        human_query += "\n and subscription_status is 'subscribed'"
-
-    users = users.distinct()
-    raw_sql = sql.raw_sql_from_queryset(users)
+    users, human_query = add_subscription_filter(users, query_params, human_query)
+
+    ## the filters which end up in the outer query rather than in a
+    ## UNION branch
+    outer_filters = list(tree.shared)
+    if not joins:
+        outer_filters.extend(
+            filter for group in tree.groups for filter in group.filters)
+    if (queryset_modifier_fn is not None
+        or querytree.needs_distinct(outer_filters, QUERIES)):
+        users = users.distinct()
+    joins = joins + column_planner.joins()
+    raw_sql = sql.raw_sql_from_queryset(users, joins)
+
+    trace = instrument.current()
+    if trace is not None:
+        trace.joins = [sql.interpolate(*join) for join in joins]
+        trace.sql = raw_sql
 
     del users
 
     return Query(human_query, querystring, raw_sql, None)
 
-def _search2(request, query):
-    querystring = query.query_string
-    query_params = QueryDict(querystring)
-
-    slug = hashlib.sha1(
-        query.raw_sql + datetime.datetime.now().utcnow().isoformat()).hexdigest()
-    slug = slugify(slug)
+def trace_search(querystring, explain=False, alias="ak"):
+    """
+    compiles the search (bypassing the cache) while recording an
+    instrument.Trace of it, and returns the trace, with the EXPLAIN of
+    the result if `explain` is set
+    """
+    with instrument.Trace(querystring) as trace:
+        trace.query = _build_query(querystring)
+    if explain and trace.sql:
+        trace.explain = instrument.explain(trace.sql, alias)
+    return trace
 
-    ## Create a new report
-    ## (https://roboticdogs.actionkit.com/docs/manual/api/rest/reports.html#creating-reports)
-    ## using the raw sql
-    resp = rest.create_report(query.raw_sql, query.human_query, slug, slug)
+def build_count_queries(querystring, base_modifier_fn=None):
+    """
+    returns (human query, sql) pairs which select the distinct ids of
+    the users matched by each include group, followed by one for the
+    whole search; the output columns are left out
 
-    report_id = resp['id']
-    shortname = resp['short_name']
+    `base_modifier_fn` is applied to the core_user queryset that every
+    include group starts from, to restrict the search to a subset of users
+    """
+    query_params = QueryDict(querystring)
 
-    ## and then trigger an asynchronous run of that report
-    ## (https://roboticdogs.actionkit.com/docs/manual/api/rest/reports.html#running-reports-asynchronously)
-    task_id = rest.run_report(shortname, email_to=request.user.email,
-                              data=query.report_data)
+    base_user_query = CoreUser.objects.using("ak").order_by()
+    if base_modifier_fn is not None:
+        base_user_query = base_modifier_fn(base_user_query)
+
+    ## each group is counted with the shared filters put back, so its
+    ## count is of everyone it matches
+    tree = querytree.parse(query_params, QUERIES)
+    groups = build_include_groups(
+        [group._replace(filters=list(tree.shared) + group.filters)
+         for group in tree.groups],
+        base_user_query)
+    repeats_users = querytree.needs_distinct(
+        list(tree.shared) + [filter for group in tree.groups
+                             for filter in group.filters], QUERIES)
+    queries = [(users, human_query, []) for users, human_query in groups]
+    if len(groups) > 1:
+        queries.append((base_user_query,
+                        "\n or ".join(group[1] for group in groups),
+                        [union_join(groups)]))
+    elif not groups:
+        queries.append((base_user_query, "", []))
+
+    counts = []
+    for users, human_query, joins in queries:
+        users, human_query = add_user_filters(users, query_params, human_query)
+        users, human_query = add_subscription_filter(users, query_params, human_query)
+        users = users.values_list("id", flat=True)
+        if not joins and repeats_users:
+            users = users.distinct()
+        counts.append((human_query.strip(),
+                       sql.raw_sql_from_queryset(users, joins)))
+    return counts
 
-    return report_id, shortname, task_id
+def _search2(request, query):
+    ## Reuse (or create) the ActionKit report for this SQL, and trigger
+    ## an asynchronous run of it
+    report, task_id, merged = reports.run_report(query, request.user.email)
+    return report.report_id, report.short_name, task_id, merged
@@ -0,0 +1,31 @@
+"""
+Materializes searches as AudienceSnapshots: bitmaps of the ids of the
+users they matched, which can be combined in memory and used as a
+"snapshot" filter in later searches.
+"""
+from actionkit_usersearch.bitmap import IdBitmap
+from actionkit_usersearch.export import stream_batches
+from actionkit_usersearch.models import AudienceSnapshot
+from actionkit_usersearch.search_functions import build_count_queries
+
+def search_ids(querystring, alias="ak"):
+    """yields the ids of every user the search matches"""
+    human_query, raw_sql = build_count_queries(querystring)[-1]
+    batches = stream_batches(raw_sql, alias)
+    batches.next()
+    for rows in batches:
+        for row in rows:
+            yield row[0]
+
+def materialize(querystring, alias="ak"):
+    """returns an IdBitmap of the users the search matches right now"""
+    return IdBitmap.from_ids(search_ids(querystring, alias))
+
+def snapshot_search(querystring, name, alias="ak"):
+    """runs the search and saves its result as a new AudienceSnapshot"""
+    human_query = build_count_queries(querystring)[-1][0]
+    snapshot = AudienceSnapshot(name=name, query_string=querystring,
+                                human_query=human_query)
+    snapshot.set_bitmap(materialize(querystring, alias))
+    snapshot.save()
+    return snapshot
@@ -1,18 +1,106 @@
+import datetime
+import decimal
+
 from django.db import connections
+from django.db.models.query import EmptyQuerySet
+try:
+    from django.db.models.sql.datastructures import EmptyResultSet
+except ImportError:
+    ## moved in Django 1.11
+    from django.core.exceptions import EmptyResultSet
+
+USER_IDS_PLACEHOLDER = "{{ user_ids }}"
+
+## The value that queryset_modifier_fn callers filter on to mark where
+## ActionKit should substitute its own list of user ids.
+USER_IDS_SENTINEL = "-9999"
+
+_ESCAPES = {
+    "\0": "\\0",
+    "\n": "\\n",
+    "\r": "\\r",
+    "\x1a": "\\Z",
+    "'": "\\'",
+    '"': '\\"',
+    "\\": "\\\\",
+    }
+
+def escape_string(value):
+    return u"".join(_ESCAPES.get(char, char) for char in value)
+
+def literal(value):
+    """
+    renders a python value as a MySQL literal, the same way MySQLdb
+    would when interpolating query parameters
+    """
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return value and "1" or "0"
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        return "'%s'" % value.isoformat(" ")
+    if isinstance(value, (datetime.date, datetime.time)):
+        return "'%s'" % value.isoformat()
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return ",".join(literal(i) for i in value)
+    if isinstance(value, str):
+        value = value.decode("utf-8")
+    return u"'%s'" % escape_string(unicode(value))
 
-def raw_sql_from_queryset(queryset):
-    dummy_queryset = queryset.using('dummy')
+def interpolate(sql, params):
+    return unicode(sql) % tuple(literal(param) for param in params)
+
+def executable(raw_sql):
+    """
+    returns (sql, params) for running interpolated SQL through a Django
+    cursor; the driver %-formats the SQL whenever it gets params (and
+    Django's debug cursor always passes some), so every % is doubled
+    and params are always passed
+    """
+    return raw_sql.replace("%", "%%"), ()
+
+def compile_queryset(queryset, joins=()):
+    """
+    returns the (sql, params) that the queryset would execute, without
+    touching the database connection
+
+    `joins` is a sequence of (sql, params) pairs which are spliced into
+    the FROM clause directly after the queryset's base table
+    """
+    if isinstance(queryset, EmptyQuerySet):
+        raise EmptyResultSet("This search can never match any users")
+    query = queryset.query.clone()
     # @@TODO: this is necessary for some reason.
-    dummy_queryset.query.group_by = None
-    try:
-        # trigger the query
-        list(dummy_queryset)
-    except Exception, e:
-        queries = connections['dummy'].queries
-        actual_sql = queries[-1]['sql']        
-        return actual_sql.replace("-9999", "{{ user_ids }}")
-    else:
-        #sql, params = dummy_queryset.query.sql_with_params()
-        #db = connections['dummy'].cursor()
-        #import pdb; pdb.set_trace()
-        assert False, "Dummy query was expected to fail"
+    query.group_by = None
+    compiler = query.get_compiler(using=queryset.db)
+    if joins:
+        get_from_clause = compiler.get_from_clause
+        def get_from_clause_with_joins():
+            from_, from_params = get_from_clause()
+            join_sql = [join[0] for join in joins]
+            join_params = [param for join in joins for param in join[1]]
+            return (from_[:1] + join_sql + from_[1:],
+                    join_params + list(from_params))
+        compiler.get_from_clause = get_from_clause_with_joins
+    return compiler.as_sql()
+
+def raw_sql_from_queryset(queryset, joins=()):
+    sql, params = compile_queryset(queryset, joins)
+    actual_sql = interpolate(sql, params)
+    return actual_sql.replace(USER_IDS_SENTINEL, USER_IDS_PLACEHOLDER)
+
+def same_database(alias1, alias2):
+    """
+    returns True if two database aliases point at the same database, so
+    that a query on one can be embedded as a subquery in the other
+    """
+    keys = ('ENGINE', 'NAME', 'HOST', 'PORT')
+    settings1 = connections[alias1].settings_dict
+    settings2 = connections[alias2].settings_dict
+    return all(settings1.get(key) == settings2.get(key) for key in keys)
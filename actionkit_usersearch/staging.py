@@ -0,0 +1,119 @@
+"""
+Stages sets of user ids in a table inside the ActionKit database, so
+that report SQL can refer to a set of any size with a short subquery
+instead of an inline list of literals.
+
+A set's key is a hash of its ids, so staging the same set twice gives
+the same SQL (and the same report fingerprint). Sets are deleted
+USERSEARCH_STAGED_IDS_TTL days after they were last staged, unless a
+report run refers to them; those are pinned, and kept until
+USERSEARCH_PINNED_SETS_TTL days after the last such run. A search that
+is compiled again stages its sets again.
+
+Staging is only enabled if the USERSEARCH_STAGING_DATABASE setting names
+a writable database alias that the reports themselves run against.
+"""
+from django.conf import settings
+from django.db import connections
+from django.db import transaction
+import datetime
+import hashlib
+import re
+
+from actionkit_usersearch.bitmap import IdBitmap
+
+TABLE = "usersearch_staged_ids"
+PINS_TABLE = "usersearch_staged_pins"
+
+## how a staged set's key appears in compiled report SQL
+KEY_PATTERN = re.compile(r"`set_key` = '([0-9a-f]{32})'")
+
+def staging_database():
+    return getattr(settings, 'USERSEARCH_STAGING_DATABASE', None)
+
+def staged_ids_ttl():
+    """number of days a staged set is kept before it is deleted"""
+    return getattr(settings, 'USERSEARCH_STAGED_IDS_TTL', 7)
+
+def pinned_sets_ttl():
+    """number of days a set is kept after the last report run using it"""
+    return getattr(settings, 'USERSEARCH_PINNED_SETS_TTL', 90)
+
+def _ensure_tables(cursor):
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS `%s` ("
+        "`set_key` CHAR(32) NOT NULL, "
+        "`id` INT UNSIGNED NOT NULL, "
+        "`created_at` DATETIME NOT NULL, "
+        "PRIMARY KEY (`set_key`, `id`), "
+        "KEY `created_at` (`created_at`)"
+        ")" % TABLE)
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS `%s` ("
+        "`set_key` CHAR(32) NOT NULL PRIMARY KEY, "
+        "`pinned_at` DATETIME NOT NULL"
+        ")" % PINS_TABLE)
+
+def set_key(ids):
+    """the key of an IdBitmap of ids: a hash of its canonical bytes"""
+    return hashlib.md5(ids.to_bytes()).hexdigest()
+
+def stage_ids(chunks):
+    """
+    writes the ids in each chunk (a list of ids) of the given iterable to
+    the staging table, unless that set is already staged, and returns
+    the set's key
+    """
+    ids = IdBitmap.from_ids(id for chunk in chunks for id in chunk)
+    key = set_key(ids)
+    alias = staging_database()
+    cursor = connections[alias].cursor()
+    _ensure_tables(cursor)
+    now = datetime.datetime.now()
+    cursor.execute("DELETE FROM `%s` WHERE `pinned_at` < %%s" % PINS_TABLE,
+                   [now - datetime.timedelta(days=pinned_sets_ttl())])
+    cursor.execute(
+        "DELETE FROM `%s` WHERE `created_at` < %%s "
+        "AND `set_key` NOT IN (SELECT `set_key` FROM `%s`)" % (
+            TABLE, PINS_TABLE),
+        [now - datetime.timedelta(days=staged_ids_ttl())])
+    ## restart the time to live of whatever is staged already, in one
+    ## statement, so that no other process's expiry can delete it after
+    ## we find it; Django's MySQL connections count matched rows, not
+    ## changed ones
+    cursor.execute(
+        "UPDATE `%s` SET `created_at` = %%s WHERE `set_key` = %%s" % TABLE,
+        [now, key])
+    if cursor.rowcount != len(ids):
+        ## new, expired in the meantime, or still being staged elsewhere
+        for batch in ids.batches(10000):
+            cursor.executemany(
+                "INSERT IGNORE INTO `%s` (`set_key`, `id`, `created_at`) "
+                "VALUES (%%s, %%s, %%s)" % TABLE,
+                [(key, id, now) for id in batch])
+    transaction.commit_unless_managed(using=alias)
+    return key
+
+def staged_ids_subquery(key):
+    """returns (sql, params) for a subquery selecting the staged set"""
+    return ("SELECT `id` FROM `%s` WHERE `set_key` = %%s" % TABLE, [key])
+
+def pin_sets(raw_sql):
+    """
+    keeps the staged sets the SQL refers to for another
+    USERSEARCH_PINNED_SETS_TTL days, for SQL that is run as an
+    ActionKit report
+    """
+    keys = set(KEY_PATTERN.findall(raw_sql))
+    alias = staging_database()
+    if not keys or alias is None:
+        return
+    cursor = connections[alias].cursor()
+    _ensure_tables(cursor)
+    now = datetime.datetime.now()
+    cursor.executemany(
+        "INSERT INTO `%s` (`set_key`, `pinned_at`) VALUES (%%s, %%s) "
+        "ON DUPLICATE KEY UPDATE `pinned_at` = VALUES(`pinned_at`)" % (
+            PINS_TABLE),
+        [(key, now) for key in keys])
+    transaction.commit_unless_managed(using=alias)
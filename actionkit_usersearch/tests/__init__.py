@@ -0,0 +1,11 @@
+## Django's test runner (before 1.6) only looks for tests in the app's
+## `tests` module, so every test module is gathered here.
+from actionkit_usersearch.tests.test_zipcodes import *
+from actionkit_usersearch.tests.test_restclient import *
+from actionkit_usersearch.tests.test_dbpool import *
+from actionkit_usersearch.tests.test_replicas import *
+from actionkit_usersearch.tests.test_search_functions import *
+from actionkit_usersearch.tests.test_guardrail import *
+from actionkit_usersearch.tests.test_querytree import *
+from actionkit_usersearch.tests.test_bitmap import *
+from actionkit_usersearch.tests.test_sql import *
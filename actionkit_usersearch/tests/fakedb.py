@@ -0,0 +1,86 @@
+"""
+Stand-ins for Django's per-thread connection wrappers and the DB-API
+connections they hold, which record what is done with them, for
+testing dbpool and replicas without a database.
+"""
+from django.db import DatabaseError
+import itertools
+import threading
+
+class FakeConnection(object):
+    ids = itertools.count(1)
+
+    def __init__(self):
+        self.id = self.ids.next()
+        self.rollbacks = 0
+        self.closed = False
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+class FakeCursor(object):
+
+    def __init__(self, database):
+        self.database = database
+        self.description = None
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        if self.database.error is not None:
+            raise DatabaseError(self.database.error)
+        self.rows = [(1,)]
+        if sql == "SHOW SLAVE STATUS":
+            status = self.database.slave_status
+            self.rows = status is not None and [tuple(status.values())] or []
+            self.description = status is not None and [
+                (name,) for name in status.keys()] or None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchone(self):
+        return self.rows and self.rows.pop(0) or None
+
+class FakeDatabase(object):
+    """
+    what a fake alias's connections report: its vendor, its SHOW SLAVE
+    STATUS row as a dict (None if it isn't a replica), and the error
+    every query raises, if any
+    """
+
+    def __init__(self, vendor="mysql", slave_status=None, error=None):
+        self.vendor = vendor
+        self.slave_status = slave_status
+        self.error = error
+        self.opened = []
+
+class FakeWrapper(object):
+    """connects on first use, as Django's connection wrappers do"""
+
+    def __init__(self, database):
+        self.database = database
+        self.vendor = database.vendor
+        self.connection = None
+
+    def cursor(self):
+        if self.connection is None:
+            self.connection = FakeConnection()
+            self.database.opened.append(self.connection)
+        return FakeCursor(self.database)
+
+class FakeConnections(object):
+    """django.db.connections for fake aliases, with a wrapper per thread"""
+
+    def __init__(self, **databases):
+        self.databases = databases
+        self.local = threading.local()
+
+    def __getitem__(self, alias):
+        wrappers = self.local.__dict__.setdefault('wrappers', {})
+        if alias not in wrappers:
+            wrappers[alias] = FakeWrapper(self.databases[alias])
+        return wrappers[alias]
@@ -0,0 +1,101 @@
+"""
+A local HTTP server answering the ActionKit REST calls that restclient
+makes, for testing and benchmarking the client without a real
+ActionKit instance.
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import itertools
+import json
+import re
+import threading
+import time
+
+class StandInActionKit(ThreadingMixIn, HTTPServer):
+    """
+    Answers each call after `latency` seconds. `failures` maps a method
+    to the statuses its next calls fail with, in order; every call is
+    recorded in `requests` as (method, path, payload, time).
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.01):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+        self.latency = latency
+        self.ids = itertools.count(1)
+        self.reports = {}
+        self.connections = 0
+        self.failures = {}
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def host(self):
+        return "http://127.0.0.1:%s" % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def record(self, method, path, payload=None):
+        """logs the call, and returns the status it should fail with"""
+        with self.lock:
+            self.requests.append((method, path, payload, time.time()))
+            failures = self.failures.get(method)
+            if failures:
+                return failures.pop(0)
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    ## buffer each response into one write, so that keep-alive
+    ## connections don't stall on Nagle's algorithm and delayed ACKs
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, body="", location=None):
+        time.sleep(self.server.latency)
+        self.send_response(status)
+        if location:
+            self.send_header("Location", location)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(
+                int(self.headers.getheader("content-length") or 0)))
+        failure = self.server.record("POST", self.path, payload)
+        if failure:
+            return self.respond(failure)
+        id = self.server.ids.next()
+        if self.path == "/rest/v1/queryreport/":
+            self.server.reports[id] = {'id': id,
+                                       'short_name': payload['short_name']}
+            self.respond(201, location="/rest/v1/queryreport/%s/" % id)
+        elif self.path.startswith("/rest/v1/report/background/"):
+            self.respond(201, location="/rest/v1/backgroundtask/%s/" % id)
+        else:
+            self.respond(404)
+
+    def do_GET(self):
+        failure = self.server.record("GET", self.path)
+        if failure:
+            return self.respond(failure)
+        match = re.match("^/rest/v1/queryreport/(\d+)/$", self.path)
+        if match and int(match.group(1)) in self.server.reports:
+            self.respond(200, json.dumps(
+                    self.server.reports[int(match.group(1))]))
+        elif re.match("^/rest/v1/backgroundtask/(\d+)/$", self.path):
+            self.respond(200, json.dumps({'status': "complete"}))
+        else:
+            self.respond(404)
@@ -0,0 +1,102 @@
+import os
+import random
+import tempfile
+import unittest
+
+from actionkit_usersearch.bitmap import ARRAY_MAX, IdBitmap
+
+def random_ids(rng, chunks, per_chunk):
+    """ids spread over the given chunk keys, `per_chunk` in each"""
+    ids = set()
+    for key in chunks:
+        ids.update((key << 16) + low
+                   for low in rng.sample(xrange(1 << 16), per_chunk))
+    return ids
+
+class IdBitmapTests(unittest.TestCase):
+    """IdBitmap agrees with python sets, over sparse and dense chunks"""
+
+    def setUp(self):
+        rng = random.Random(16)
+        ## chunk 0 dense in both, 1 sparse in both, 2 mixed, 3 and 4 in
+        ## one set only
+        self.a = (random_ids(rng, [0], 30000) | random_ids(rng, [1], 100)
+                  | random_ids(rng, [2], 20000) | random_ids(rng, [3], 50))
+        self.b = (random_ids(rng, [0], 30000) | random_ids(rng, [1], 100)
+                  | random_ids(rng, [2], 200) | random_ids(rng, [4], 5000))
+
+    def bitmaps(self):
+        return IdBitmap.from_ids(self.a), IdBitmap.from_ids(self.b)
+
+    def assert_same(self, bitmap, ids):
+        self.assertEqual(len(bitmap), len(ids))
+        self.assertEqual(list(bitmap), sorted(ids))
+
+    def test_from_ids(self):
+        a, b = self.bitmaps()
+        self.assert_same(a, self.a)
+        self.assert_same(IdBitmap.from_ids([5, 3, 5, 70000]), [3, 5, 70000])
+        self.assert_same(IdBitmap.from_ids([]), [])
+
+    def test_set_algebra(self):
+        a, b = self.bitmaps()
+        self.assert_same(a | b, self.a | self.b)
+        self.assert_same(a & b, self.a & self.b)
+        self.assert_same(a - b, self.a - self.b)
+        self.assert_same(b - a, self.b - self.a)
+        self.assert_same(a - a, [])
+
+    def test_contains(self):
+        a, b = self.bitmaps()
+        for id in list(self.a)[:500] + list(self.b)[:500] + [0, 1 << 16, 999999]:
+            self.assertEqual(id in a, id in self.a)
+
+    def test_chunks_pick_the_smaller_form(self):
+        dense = IdBitmap.from_ids(range(ARRAY_MAX + 1))
+        sparse = IdBitmap.from_ids(range(ARRAY_MAX))
+        self.assertTrue(isinstance(dense.chunks[0], (int, long)))
+        self.assertFalse(isinstance(sparse.chunks[0], (int, long)))
+        ## a dense result thinned out by a difference becomes sparse
+        thinned = (dense - IdBitmap.from_ids(range(100))).compact()
+        self.assertFalse(isinstance(thinned.chunks[0], (int, long)))
+        self.assert_same(thinned, range(100, ARRAY_MAX + 1))
+
+    def test_equality_ignores_representation(self):
+        a, b = self.bitmaps()
+        self.assertEqual((a | b) - b, a - b)
+        self.assertEqual(a & a, a)
+        self.assertNotEqual(a, b)
+
+    def test_batches(self):
+        bitmap = IdBitmap.from_ids(range(25))
+        self.assertEqual([len(batch) for batch in bitmap.batches(10)],
+                         [10, 10, 5])
+        self.assertEqual(sum(bitmap.batches(10), []), range(25))
+
+    def test_serialization_round_trips(self):
+        a, b = self.bitmaps()
+        for bitmap in (a, b, a | b, a - a, IdBitmap.from_ids([7])):
+            self.assertEqual(IdBitmap.from_bytes(bitmap.to_bytes()), bitmap)
+
+    def test_serialization_is_canonical(self):
+        a, b = self.bitmaps()
+        ## the same set, however it was built, has the same bytes; the
+        ## staging table's keys depend on this
+        self.assertEqual(((a | b) - b).to_bytes(),
+                         IdBitmap.from_ids(self.a - self.b).to_bytes())
+
+    def test_rejects_other_data(self):
+        self.assertRaises(ValueError, IdBitmap.from_bytes, "not a bitmap")
+        data = IdBitmap.from_ids([1]).to_bytes()
+        self.assertRaises(ValueError, IdBitmap.from_bytes,
+                          data[:4] + "\x09" + data[5:])
+
+    def test_save_and_load(self):
+        a, b = self.bitmaps()
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            a.save(path)
+            self.assertEqual(IdBitmap.load(path), a)
+        finally:
+            os.remove(path)
@@ -0,0 +1,91 @@
+import threading
+import time
+import unittest
+
+from actionkit_usersearch import dbpool
+from actionkit_usersearch.tests.fakedb import FakeConnections, FakeDatabase
+
+class DatabasePoolTests(unittest.TestCase):
+    """DatabasePool lending fake connections"""
+
+    def setUp(self):
+        self.database = FakeDatabase()
+        self.connections = FakeConnections(ak=self.database)
+        self.real_connections, dbpool.connections = (
+            dbpool.connections, self.connections)
+
+    def tearDown(self):
+        dbpool.connections = self.real_connections
+
+    def use(self, pool):
+        with pool.lend() as wrapper:
+            wrapper.cursor().execute("SELECT 1")
+            return wrapper.connection
+
+    def test_returns_connections_for_reuse(self):
+        pool = dbpool.DatabasePool("ak", 2, 600)
+        first = self.use(pool)
+        second = self.use(pool)
+        self.assertTrue(first is second)
+        self.assertEqual(len(self.database.opened), 1)
+        ## rolled back each time it came back
+        self.assertEqual(first.rollbacks, 2)
+        self.assertFalse(first.closed)
+        self.assertTrue(self.connections["ak"].connection is None)
+        snapshot = pool.snapshot()
+        self.assertEqual((snapshot['lent'], snapshot['created'],
+                          snapshot['reused'], snapshot['idle'],
+                          snapshot['in_use']), (2, 1, 1, 1, 0))
+
+    def test_discards_connections_after_errors(self):
+        pool = dbpool.DatabasePool("ak", 2, 600)
+        try:
+            with pool.lend() as wrapper:
+                wrapper.cursor()
+                raise ValueError
+        except ValueError:
+            pass
+        connection = self.database.opened[0]
+        self.assertTrue(connection.closed)
+        self.assertEqual(pool.snapshot()['discarded'], 1)
+        self.assertFalse(self.use(pool) is connection)
+
+    def test_discards_expired_connections(self):
+        pool = dbpool.DatabasePool("ak", 2, 600)
+        old = self.use(pool)
+        pool.idle = [(old, time.time() - 601)]
+        self.assertFalse(self.use(pool) is old)
+        self.assertTrue(old.closed)
+        self.assertEqual(pool.snapshot()['discarded'], 1)
+
+    def test_leaves_nested_connections_alone(self):
+        pool = dbpool.DatabasePool("ak", 1, 600)
+        with pool.lend() as wrapper:
+            wrapper.cursor()
+            outer = wrapper.connection
+            with pool.lend() as inner:
+                self.assertTrue(inner.connection is outer)
+            self.assertTrue(wrapper.connection is outer)
+        self.assertEqual(pool.snapshot()['lent'], 1)
+
+    def test_callers_wait_for_a_free_connection(self):
+        pool = dbpool.DatabasePool("ak", 1, 600)
+        lent = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with pool.lend() as wrapper:
+                wrapper.cursor()
+                lent.set()
+                release.wait()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        lent.wait()
+        threading.Timer(0.05, release.set).start()
+        self.use(pool)
+        thread.join()
+        snapshot = pool.snapshot()
+        self.assertEqual((snapshot['waits'], snapshot['max_in_use'],
+                          snapshot['created']), (1, 1, 1))
+        self.assertTrue(snapshot['wait_seconds'] > 0)
@@ -0,0 +1,48 @@
+import unittest
+
+from actionkit_usersearch import guardrail
+
+COLUMN = ("(SELECT SUM(`total`) FROM `core_order` "
+          "WHERE `core_order`.`user_id`=`core_user`.`id`) AS `c%s`")
+EXCLUSION = ("NOT EXISTS (SELECT 1 FROM `core_action` "
+             "WHERE `core_action`.`user_id` = `core_user`.`id`)")
+
+def search_sql(columns, exclusions):
+    select = ", ".join(["`core_user`.`id`"] + [COLUMN % i for i in range(columns)])
+    where = " AND ".join(["`core_user`.`email` LIKE '%from (%'"]
+                         + [EXCLUSION] * exclusions)
+    return "SELECT %s FROM `core_user` WHERE %s" % (select, where)
+
+class PatternTests(unittest.TestCase):
+    """guardrail.patterns flags the combinations that run away"""
+
+    def levels(self, raw_sql, query_string=""):
+        return [level for level, reason in
+                guardrail.patterns(raw_sql, query_string)]
+
+    def test_counts_only_column_subqueries(self):
+        limit = guardrail.max_column_subqueries()
+        self.assertEqual(self.levels(search_sql(0, limit + 1)), [])
+        self.assertEqual(self.levels(search_sql(limit + 1, 0)),
+                         [guardrail.WARN])
+
+    def test_select_list_skips_quoted_and_nested_froms(self):
+        raw_sql = search_sql(1, 0)
+        self.assertEqual(guardrail.select_list(raw_sql),
+                         raw_sql[:raw_sql.index(" FROM `core_user`") + 1])
+
+    def test_substring_search_alone_is_allowed(self):
+        self.assertEqual(self.levels("SELECT 1", "user_name=smith"), [])
+
+    def test_substring_search_compounds(self):
+        exclusion = ("&include:0=country&include:0_country=US"
+                     "&include:0_country_istoggle=0")
+        columns = "&column=donated_2019&column=donated_2020"
+        self.assertEqual(self.levels("SELECT 1", "user_name=smith" + exclusion),
+                         [guardrail.WARN])
+        self.assertEqual(self.levels("SELECT 1", "user_email=x" + columns),
+                         [guardrail.WARN])
+        self.assertEqual(
+            self.levels("SELECT 1", "user_name=smith" + exclusion + columns),
+            [guardrail.QUEUE])
+        self.assertEqual(self.levels("SELECT 1", exclusion + columns), [])
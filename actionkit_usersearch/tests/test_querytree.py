@@ -0,0 +1,166 @@
+from django.http import QueryDict
+import unittest
+
+from actionkit_usersearch import querytree
+from actionkit_usersearch.querytree import Filter, Group, SearchTree
+
+SPECS = {
+    'country': {},
+    'state': {},
+    'tag': {'multivalued': True},
+    'action': {'multivalued': True, 'exists': True, 'query_fn': object()},
+    'contacted_since': {'query_fn': object(),
+                        'paired': (("contacted_by",
+                                    "contacted_since__contacted_by"),)},
+    'contacted_by': {'query_fn': object(),
+                     'paired': (("contacted_since",
+                                 "contacted_by__contacted_since"),)},
+    }
+
+def f(name, *values, **kw):
+    return Filter(name, tuple(values), kw.get('istoggle', True),
+                  kw.get('extra', ()))
+
+def parse(querystring):
+    return querytree.parse(QueryDict(querystring), SPECS)
+
+class ParseTests(unittest.TestCase):
+    """querytree.parse reads include groups into Filters"""
+
+    def test_orders_groups_and_dedupes_values(self):
+        tree = parse("include:10=state&include:10_state=NY"
+                     "&include:2=country&include:2_country=US"
+                     "&include:2_country=US&include:2_country=CA")
+        self.assertEqual(tree.groups, [
+                Group("include:2", [f("country", "CA", "US")]),
+                Group("include:10", [f("state", "NY")])])
+        self.assertFalse(tree.shared)
+
+    def test_reads_exclusions(self):
+        tree = parse("include:0=state&include:0_state=NY"
+                     "&include:0_state_istoggle=0")
+        self.assertEqual(tree.groups[0].filters,
+                         [f("state", "NY", istoggle=False)])
+
+    def test_unifies_paired_filters(self):
+        by = parse("include:0=contacted_by&include:0_contacted_by=bob"
+                   "&include:0_contacted_by__contacted_since=2020-01-01")
+        since = parse("include:0=contacted_since"
+                      "&include:0_contacted_since=2020-01-01"
+                      "&include:0_contacted_since__contacted_by=bob")
+        self.assertEqual(by, since)
+        self.assertEqual(by.groups[0].filters, [f(
+                    "contacted_since", "2020-01-01",
+                    extra=(("contacted_by", "bob"),))])
+
+class MergeTests(unittest.TestCase):
+    """querytree.merge_filters within one group"""
+
+    def test_intersects_inclusions_on_one_field(self):
+        self.assertEqual(querytree.merge_filters(
+                [f("state", "CA", "NY"), f("state", "NY", "TX")], SPECS),
+                         [f("state", "NY")])
+
+    def test_unions_exclusions_on_one_field(self):
+        self.assertEqual(querytree.merge_filters(
+                [f("state", "CA", istoggle=False),
+                 f("state", "NY", istoggle=False)], SPECS),
+                         [f("state", "CA", "NY", istoggle=False)])
+
+    def test_keeps_inclusions_that_match_nobody(self):
+        filters = [f("state", "CA"), f("state", "NY")]
+        self.assertEqual(querytree.merge_filters(filters, SPECS), filters)
+
+    def test_keeps_multivalued_inclusions_apart(self):
+        ## tagged 1 and tagged 2 is not the same as tagged 1 or 2
+        filters = [f("tag", "1", "2"), f("tag", "2", "3")]
+        self.assertEqual(querytree.merge_filters(filters, SPECS), filters)
+        filters = [f("action", "1"), f("action", "2")]
+        self.assertEqual(querytree.merge_filters(filters, SPECS), filters)
+
+    def test_drops_duplicates(self):
+        self.assertEqual(querytree.merge_filters(
+                [f("tag", "1"), f("country", "US"), f("tag", "1")], SPECS),
+                         [f("tag", "1"), f("country", "US")])
+
+    def test_leaves_different_fields_and_toggles_alone(self):
+        filters = [f("state", "NY"), f("state", "CA", istoggle=False),
+                   f("country", "US")]
+        self.assertEqual(querytree.merge_filters(filters, SPECS), filters)
+
+class ImpliesTests(unittest.TestCase):
+    """querytree.implies and subsumes"""
+
+    def test_inclusions_imply_wider_inclusions(self):
+        self.assertTrue(querytree.implies(
+                f("state", "NY"), f("state", "NY", "CA"), SPECS))
+        self.assertFalse(querytree.implies(
+                f("state", "NY", "CA"), f("state", "NY"), SPECS))
+
+    def test_exclusions_imply_narrower_exclusions(self):
+        self.assertTrue(querytree.implies(
+                f("state", "NY", "CA", istoggle=False),
+                f("state", "NY", istoggle=False), SPECS))
+        self.assertFalse(querytree.implies(
+                f("state", "NY", istoggle=False),
+                f("state", "NY", "CA", istoggle=False), SPECS))
+
+    def test_custom_filters_only_imply_themselves(self):
+        since = f("contacted_since", "2020-01-01")
+        self.assertTrue(querytree.implies(since, since, SPECS))
+        self.assertFalse(querytree.implies(
+                since, f("contacted_since", "2019-01-01"), SPECS))
+
+    def test_subsumes(self):
+        wide = Group("include:0", [f("state", "NY", "CA")])
+        narrow = Group("include:1", [f("state", "NY"), f("tag", "1")])
+        self.assertTrue(querytree.subsumes(wide, narrow, SPECS))
+        self.assertFalse(querytree.subsumes(narrow, wide, SPECS))
+
+class NormalizeTests(unittest.TestCase):
+    """querytree.normalize of a search's groups"""
+
+    def normalize(self, *filter_lists):
+        return querytree.normalize(
+            [Group("include:%s" % i, list(filters))
+             for i, filters in enumerate(filter_lists)], SPECS)
+
+    def test_drops_subsumed_groups(self):
+        tree = self.normalize([f("state", "NY", "CA")],
+                              [f("state", "NY"), f("tag", "1")],
+                              [f("country", "US")])
+        self.assertEqual([group.key for group in tree.groups],
+                         ["include:0", "include:2"])
+
+    def test_keeps_the_first_of_equivalent_groups(self):
+        tree = self.normalize([f("state", "NY")], [f("state", "NY")])
+        self.assertEqual(tree, SearchTree((), [
+                    Group("include:0", [f("state", "NY")])]))
+
+    def test_hoists_shared_filters(self):
+        tree = self.normalize([f("country", "US"), f("state", "NY")],
+                              [f("tag", "1"), f("country", "US")])
+        self.assertEqual(tree, SearchTree([f("country", "US")], [
+                    Group("include:0", [f("state", "NY")]),
+                    Group("include:1", [f("tag", "1")])]))
+
+    def test_a_group_of_only_shared_filters_absorbs_the_rest(self):
+        tree = self.normalize([f("country", "US")],
+                              [f("country", "US"), f("tag", "1")],
+                              [f("country", "US"), f("state", "NY")])
+        self.assertEqual(tree, SearchTree((), [
+                    Group("include:0", [f("country", "US")])]))
+
+    def test_does_not_hoist_into_a_single_group(self):
+        tree = self.normalize([f("country", "US"), f("state", "NY")],
+                              [f("country", "US"), f("state", "NY"),
+                               f("tag", "1")])
+        self.assertEqual(tree, SearchTree((), [Group(
+                        "include:0", [f("country", "US"), f("state", "NY")])]))
+
+    def test_needs_distinct(self):
+        self.assertTrue(querytree.needs_distinct([f("tag", "1")], SPECS))
+        self.assertFalse(querytree.needs_distinct(
+                [f("tag", "1", istoggle=False)], SPECS))
+        self.assertFalse(querytree.needs_distinct([f("action", "1")], SPECS))
+        self.assertFalse(querytree.needs_distinct([f("state", "NY")], SPECS))
@@ -0,0 +1,109 @@
+from django.db import DatabaseError
+from django.test.utils import override_settings
+import unittest
+
+from actionkit_usersearch import dbpool
+from actionkit_usersearch import replicas
+from actionkit_usersearch.tests.fakedb import FakeConnections, FakeDatabase
+
+def slave_status(lag):
+    return {'Slave_IO_Running': "Yes", 'Seconds_Behind_Master': lag}
+
+class FakeModel(object):
+    def __init__(self, app_label):
+        self._meta = type("Meta", (object,), {'app_label': app_label})
+
+class ReplicaTests(unittest.TestCase):
+    """ReplicaSet and ReplicaRouter over fake replicas r1 and r2"""
+
+    def setUp(self):
+        self.settings = override_settings(
+            USERSEARCH_REPLICAS=("r1", "r2"),
+            USERSEARCH_REPLICA_MAX_LAG=30,
+            USERSEARCH_REPLICA_CHECK_INTERVAL=60)
+        self.settings.enable()
+        self.databases = {
+            'ak': FakeDatabase(),
+            'r1': FakeDatabase(slave_status=slave_status(0)),
+            'r2': FakeDatabase(slave_status=slave_status(5)),
+            }
+        self.real_connections, dbpool.connections = (
+            dbpool.connections, FakeConnections(**self.databases))
+        self.real_pools, dbpool._pools = dbpool._pools, {}
+        self.real_replica_set = replicas.replica_set
+        self.replica_set = replicas.replica_set = replicas.ReplicaSet()
+
+    def tearDown(self):
+        replicas.replica_set = self.real_replica_set
+        dbpool._pools = self.real_pools
+        dbpool.connections = self.real_connections
+        self.settings.disable()
+
+    def test_reads_lag_from_slave_status(self):
+        self.assertEqual(replicas.replication_lag("r2"), 5)
+        self.assertEqual(replicas.replication_lag("ak"), 0)
+        self.databases['r1'].slave_status = slave_status(None)
+        self.assertRaises(replicas.ReplicationStopped,
+                          replicas.replication_lag, "r1")
+
+    def test_other_databases_never_lag(self):
+        self.databases['r1'].vendor = "sqlite"
+        self.databases['r1'].slave_status = slave_status(None)
+        self.assertEqual(replicas.replication_lag("r1"), 0)
+
+    def test_rotates_over_healthy_replicas(self):
+        reads = [self.replica_set.read_alias() for i in range(4)]
+        self.assertEqual(sorted(reads), ["r1", "r1", "r2", "r2"])
+
+    def test_skips_lagging_replicas(self):
+        self.databases['r2'].slave_status = slave_status(31)
+        self.assertEqual(set(self.replica_set.read_alias() for i in range(4)),
+                         set(["r1"]))
+        self.assertEqual(self.replica_set.status()['r2']['lag'], 31)
+
+    def test_skips_replicas_that_stopped_or_are_down(self):
+        self.databases['r1'].slave_status = slave_status(None)
+        self.databases['r2'].error = "Can't connect to MySQL server"
+        self.assertEqual(self.replica_set.read_alias(), "ak")
+        status = self.replica_set.status()
+        self.assertFalse(status['r1']['healthy'])
+        self.assertEqual(status['r2']['error'], "Can't connect to MySQL server")
+
+    def test_caches_health_between_checks(self):
+        self.replica_set.read_alias()
+        self.databases['r1'].slave_status = slave_status(None)
+        self.assertEqual(self.replica_set.current_health("r1")['lag'], 0)
+        self.replica_set.health['r1']['checked_at'] -= 61
+        self.assertFalse(self.replica_set.current_health("r1")['healthy'])
+
+    def test_falls_back_to_the_primary_when_a_replica_fails(self):
+        self.databases['r2'].error = "Can't connect to MySQL server"
+
+        def fail_on_r1(alias):
+            if alias == "r1":
+                self.databases['r1'].error = "Lost connection to MySQL server"
+                raise DatabaseError("Lost connection to MySQL server")
+            return alias
+        self.assertEqual(self.replica_set.read(fail_on_r1), "ak")
+
+    def test_query_errors_are_not_retried(self):
+        def fail(alias):
+            raise DatabaseError("Unknown column")
+        self.assertRaises(DatabaseError, self.replica_set.read, fail)
+
+    def test_reads_from_a_given_alias(self):
+        self.assertEqual(self.replica_set.read(lambda alias: alias, "ak"), "ak")
+        self.assertEqual(self.replica_set.status(), {})
+
+    def test_router(self):
+        router = replicas.ReplicaRouter()
+        actionkit, usersearch = FakeModel("actionkit"), FakeModel("usersearch")
+        self.assertTrue(router.db_for_read(actionkit) in ("r1", "r2"))
+        self.assertEqual(router.db_for_read(usersearch), None)
+        self.assertEqual(router.db_for_write(actionkit), "ak")
+        self.assertEqual(router.db_for_write(usersearch), None)
+        self.assertEqual(router.allow_syncdb("r1", usersearch), False)
+        self.assertEqual(router.allow_syncdb("default", usersearch), None)
+        self.databases['r1'].error = self.databases['r2'].error = "down"
+        self.replica_set.health = {}
+        self.assertEqual(router.db_for_read(actionkit), "ak")
@@ -0,0 +1,123 @@
+from multiprocessing.pool import ThreadPool
+import unittest
+
+from actionkit_usersearch.restclient import RestClient, RestError
+from actionkit_usersearch.tests.standin import StandInActionKit
+
+class RestClientTests(unittest.TestCase):
+    """RestClient against a stand-in ActionKit"""
+
+    def setUp(self):
+        self.server = StandInActionKit(latency=0).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def client(self, concurrency=2, rate=0, retries=2):
+        client = RestClient(self.server.host, "user", "password",
+                            concurrency=concurrency, rate=rate, retries=retries)
+        client.backoff = 0
+        return client
+
+    def calls(self, method):
+        return [path for m, path, payload, at in self.server.requests
+                if m == method]
+
+    def payloads(self, path):
+        return [payload for m, p, payload, at in self.server.requests
+                if p == path]
+
+    def test_reuses_connections(self):
+        client = self.client(concurrency=1)
+        for i in range(5):
+            report = client.create_report("SELECT 1", "test", "t", "t")
+            client.run_report(report['short_name'], "a@example.com")
+        self.assertEqual(len(self.server.requests), 10)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_opens_at_most_concurrency_connections(self):
+        self.server.latency = 0.02
+        client = self.client(concurrency=3)
+        pool = ThreadPool(8)
+        try:
+            pool.map(lambda i: client.run_report("t", "a@example.com"),
+                     range(24))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(len(self.calls("POST")), 24)
+        self.assertTrue(self.server.connections <= 3)
+
+    def test_creates_hidden_reports(self):
+        client = self.client()
+        report = client.create_report("SELECT 1", "a search", "n", "sn")
+        self.assertEqual(report, {'id': "1", 'short_name': "sn"})
+        self.assertEqual(self.payloads("/rest/v1/queryreport/"), [{
+                    'sql': "SELECT 1", 'description': "a search",
+                    'name': "n", 'short_name': "sn", 'hidden': True}])
+
+    def test_runs_reports_fresh_and_emailed(self):
+        client = self.client()
+        client.run_report("sn", "a@example.com", data={'limit': 10})
+        client.run_report("sn")
+        self.assertEqual(self.payloads("/rest/v1/report/background/sn/"), [
+                {'refresh': True, 'full_recalc': True, 'limit': 10,
+                 'use_email': True, 'email': "a@example.com"},
+                {'refresh': True, 'full_recalc': True}])
+
+    def test_run_report_returns_the_task_id(self):
+        client = self.client()
+        task_id = client.run_report("t", "a@example.com")
+        self.assertEqual(client.poll_report(task_id), {'status': "complete"})
+        self.assertEqual(self.calls("GET"),
+                         ["/rest/v1/backgroundtask/%s/" % task_id])
+
+    def test_retries_reads_on_server_errors(self):
+        self.server.failures["GET"] = [503, 500]
+        client = self.client(retries=2)
+        task_id = client.run_report("t", "a@example.com")
+        client.poll_report(task_id)
+        self.assertEqual(len(self.calls("GET")), 3)
+
+    def test_gives_up_after_the_retries(self):
+        self.server.failures["GET"] = [502, 502, 502]
+        client = self.client(retries=2)
+        try:
+            client.poll_report(1)
+        except RestError, e:
+            self.assertEqual(e.status, 502)
+        else:
+            self.fail("expected a RestError")
+        self.assertEqual(len(self.calls("GET")), 3)
+
+    def test_does_not_resend_writes_after_server_errors(self):
+        self.server.failures["POST"] = [500]
+        client = self.client(retries=2)
+        self.assertRaises(RestError, client.run_report, "t", "a@example.com")
+        self.assertEqual(len(self.calls("POST")), 1)
+
+    def test_resends_writes_after_429s(self):
+        self.server.failures["POST"] = [429]
+        client = self.client(retries=2)
+        client.run_report("t", "a@example.com")
+        self.assertEqual(len(self.calls("POST")), 2)
+
+    def test_does_not_retry_client_errors(self):
+        client = self.client(retries=2)
+        self.assertRaises(RestError, client.call, "GET", "/rest/v1/nothing/")
+        self.assertEqual(len(self.calls("GET")), 1)
+
+    def test_rate_limits_across_threads(self):
+        client = self.client(concurrency=4, rate=50)
+        pool = ThreadPool(4)
+        try:
+            pool.map(lambda i: client.run_report("t", "a@example.com"),
+                     range(12))
+        finally:
+            pool.close()
+            pool.join()
+        times = sorted(at for m, path, payload, at in self.server.requests)
+        ## 12 calls at 50 a second span at least 11 intervals of 20ms
+        self.assertTrue(times[-1] - times[0] >= 11 * 0.02 * 0.9,
+                        times[-1] - times[0])
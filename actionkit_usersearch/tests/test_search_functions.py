@@ -0,0 +1,26 @@
+from django.http import QueryDict
+import unittest
+
+from actionkit_usersearch.search_functions import canonical_querystring
+
+def key(querystring):
+    return canonical_querystring(QueryDict(querystring))
+
+class CanonicalQuerystringTests(unittest.TestCase):
+    """searches share a cache key exactly when they compile the same"""
+
+    def test_ignores_order_and_group_numbers(self):
+        self.assertEqual(
+            key("include:0=country&include:0_country=US&user_name=smith"),
+            key("user_name=smith&include:3_country=US&include:3=country"))
+
+    def test_ignores_groups_with_no_criteria(self):
+        self.assertEqual(key("include:0=country&include:0_country=US"),
+                         key("include:0=country&include:0_country=US"
+                             "&include:1=&include:2_state=NY"))
+
+    def test_keeps_empty_values(self):
+        self.assertNotEqual(key("include:0=country&include:0_country="),
+                            key("include:0=country"))
+        self.assertNotEqual(key("include:0=country&include:0_country="),
+                            key("include:0=country&include:0_country=US"))
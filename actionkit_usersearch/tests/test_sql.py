@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from actionkit.models import CoreUser
+import datetime
+import decimal
+import unittest
+
+from actionkit_usersearch import sql
+
+class LiteralTests(unittest.TestCase):
+    """sql.literal renders values as MySQLdb would interpolate them"""
+
+    def test_scalars(self):
+        self.assertEqual(sql.literal(None), "NULL")
+        self.assertEqual(sql.literal(True), "1")
+        self.assertEqual(sql.literal(False), "0")
+        self.assertEqual(sql.literal(42), "42")
+        self.assertEqual(sql.literal(2 ** 40), "1099511627776")
+        self.assertEqual(sql.literal(1.5), "1.5")
+        self.assertEqual(sql.literal(decimal.Decimal("10.50")), "10.50")
+
+    def test_dates_and_times(self):
+        self.assertEqual(sql.literal(datetime.datetime(2012, 1, 2, 3, 4, 5)),
+                         "'2012-01-02 03:04:05'")
+        self.assertEqual(sql.literal(datetime.date(2012, 1, 2)), "'2012-01-02'")
+        self.assertEqual(sql.literal(datetime.time(3, 4)), "'03:04:00'")
+
+    def test_strings_are_escaped(self):
+        self.assertEqual(sql.literal("O'Brien"), u"'O\\'Brien'")
+        self.assertEqual(sql.literal(u'say "hi"\n'), u"'say \\\"hi\\\"\\n'")
+        self.assertEqual(sql.literal("back\\slash\0\r\x1a"),
+                         u"'back\\\\slash\\0\\r\\Z'")
+        self.assertEqual(sql.literal("caf\xc3\xa9"), u"'caf\xe9'")
+        self.assertEqual(sql.literal(u"caf\xe9"), u"'caf\xe9'")
+
+    def test_sequences(self):
+        self.assertEqual(sql.literal([1, "a", None]), "1,'a',NULL")
+        self.assertEqual(sql.literal((2,)), "2")
+
+    def test_interpolate(self):
+        self.assertEqual(
+            sql.interpolate("SELECT * FROM t WHERE a = %s AND b IN (%s)",
+                            ["x'", [1, 2]]),
+            u"SELECT * FROM t WHERE a = 'x\\'' AND b IN (1,2)")
+
+    def test_executable_doubles_percents(self):
+        raw_sql = "SELECT 1 WHERE name LIKE '%smith%'"
+        executable, params = sql.executable(raw_sql)
+        self.assertEqual(executable % params, raw_sql)
+
+    def test_empty_querysets_raise(self):
+        self.assertRaises(sql.EmptyResultSet, sql.compile_queryset,
+                          CoreUser.objects.none())
@@ -0,0 +1,57 @@
+import random
+import unittest
+
+from actionkit_usersearch.zipcodes import ZipcodeGrid, ZipcodeIndex
+from actionkit_usersearch.zipcodes import great_circle_miles
+
+def random_index(rng, points, *regions):
+    """an index of `points` random centroids in each (lats, lons) region"""
+    index = ZipcodeIndex()
+    for lat_range, lon_range in regions:
+        for i in range(points):
+            index.add("Z%s" % len(index),
+                      rng.uniform(*lat_range), rng.uniform(*lon_range))
+    return index
+
+class ZipcodeGridTests(unittest.TestCase):
+    """ZipcodeGrid.within finds exactly what a scan of every centroid does"""
+
+    def assert_matches_brute_force(self, index, centers, radii):
+        grid = ZipcodeGrid(index)
+        points = list(index)
+        for lat, lon in centers:
+            for miles in radii:
+                expected = sorted(
+                    zipcode for zipcode, zlat, zlon in points
+                    if great_circle_miles(lat, lon, zlat, zlon) <= miles)
+                self.assertEqual(sorted(grid.within(lat, lon, miles)), expected,
+                                 "%s miles of %s,%s" % (miles, lat, lon))
+
+    def test_near_north_pole(self):
+        rng = random.Random(1)
+        index = random_index(rng, 4000, ((75, 90), (-180, 180)))
+        centers = [(rng.uniform(80, 90), rng.uniform(-180, 180))
+                   for i in range(20)] + [(90, 0), (89.99, 179.9)]
+        self.assert_matches_brute_force(index, centers, (5, 50, 300, 900))
+
+    def test_near_south_pole(self):
+        rng = random.Random(2)
+        index = random_index(rng, 4000, ((-90, -75), (-180, 180)))
+        centers = [(rng.uniform(-90, -80), rng.uniform(-180, 180))
+                   for i in range(20)] + [(-90, 0)]
+        self.assert_matches_brute_force(index, centers, (5, 50, 300, 900))
+
+    def test_across_antimeridian(self):
+        rng = random.Random(3)
+        index = random_index(rng, 4000, ((-70, 70), (170, 180)),
+                             ((-70, 70), (-180, -170)))
+        centers = [(rng.uniform(-65, 65), rng.choice([179.5, -179.5, 180, -180]))
+                   for i in range(20)]
+        self.assert_matches_brute_force(index, centers, (10, 100, 400))
+
+    def test_mid_latitudes(self):
+        rng = random.Random(4)
+        index = random_index(rng, 4000, ((25, 50), (-125, -65)))
+        centers = [(rng.uniform(30, 45), rng.uniform(-120, -70))
+                   for i in range(20)]
+        self.assert_matches_brute_force(index, centers, (1, 25, 250))
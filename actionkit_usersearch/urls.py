@@ -10,6 +10,18 @@ urlpatterns = patterns(
         'create_report',
         name='usersearch_create_report'),
 
+    url('^count/$',
+        'count',
+        name='usersearch_count'),
+
+    url('^export/$',
+        'export',
+        name='usersearch_export'),
+
+    url('^debug/$',
+        'debug',
+        name='usersearch_debug'),
+
 
     url(r'^autocomplete/sources/$', 'sources', name='autocomplete_sources'),
     url(r'^autocomplete/campuses/$', 'campuses', name='autocomplete_campuses'),
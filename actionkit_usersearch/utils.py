@@ -1,8 +1,17 @@
+from django.conf import settings
+from django.db import IntegrityError
 import urllib2
 from math import cos
 from math import radians
 from json import loads
 
+from actionkit_usersearch.models import GeocodedZipcode
+from actionkit_usersearch.zipcodes import get_index
+from actionkit_usersearch.zipcodes import normalize_zipcode
+
+def clamp(value, minimum, maximum):
+    return max(minimum, min(value, maximum))
+
 def latlon_bbox(lat, lon, d):
     """
     calculates a latlon bbox given a lat/lon and a distance d in miles
@@ -14,10 +23,13 @@ def latlon_bbox(lat, lon, d):
     lat2 = lat + (d / APPROX_MILES_PER_DEGREE)
     return (lat1, lat2, lon1, lon2)
 
+def geocoder_timeout():
+    return getattr(settings, 'USERSEARCH_GEOCODER_TIMEOUT', 5)
+
 def google_zipcode_to_latlon(zipcode):
     """looks up the zip code to determine the lat/lon"""
     url = 'http://maps.googleapis.com/maps/api/geocode/json?sensor=false&address=%s' % zipcode
-    response = urllib2.urlopen(url)
+    response = urllib2.urlopen(url, timeout=geocoder_timeout())
     response_data = response.read()
     try:
         json_result = loads(response_data)
@@ -36,7 +48,7 @@ def google_zipcode_to_latlon(zipcode):
 
 def geonames_zipcode_to_latlon(zipcode):
     url = 'http://api.geonames.org/postalCodeSearchJSON?postalcode=%s&maxRows=1&username=%s' % (zipcode, settings.GEONAMES_API_USERNAME)
-    response = urllib2.urlopen(url)
+    response = urllib2.urlopen(url, timeout=geocoder_timeout())
     response_data = response.read()
     try:
         json_result = loads(response_data)
@@ -51,9 +63,36 @@ def geonames_zipcode_to_latlon(zipcode):
             return (lat, lon)
     raise RuntimeError(json_result)
 
-def zipcode_to_latlon(zipcode):
+def remote_zipcode_to_latlon(zipcode):
     try:
-        return google_zipcode_to_latlon(zipcode)
+        return google_zipcode_to_latlon(zipcode), "google"
     except Exception:
         pass
-    return geonames_zipcode_to_latlon(zipcode)
+    return geonames_zipcode_to_latlon(zipcode), "geonames"
+
+def zipcode_to_latlon(zipcode):
+    """
+    looks up the zip code in the local centroid index, then in the
+    cache of earlier remote lookups, and only then asks the remote
+    geocoding services (caching whatever they answer)
+    """
+    latlon = get_index().lookup(zipcode)
+    if latlon is not None:
+        return latlon
+
+    zipcode = normalize_zipcode(zipcode)
+    try:
+        cached = GeocodedZipcode.objects.get(zipcode=zipcode)
+    except GeocodedZipcode.DoesNotExist:
+        pass
+    else:
+        return (cached.latitude, cached.longitude)
+
+    (lat, lon), source = remote_zipcode_to_latlon(zipcode)
+    try:
+        GeocodedZipcode.objects.create(
+            zipcode=zipcode, latitude=lat, longitude=lon, source=source)
+    except IntegrityError:
+        ## another request cached it first
+        pass
+    return (lat, lon)
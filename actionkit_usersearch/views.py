@@ -1,12 +1,35 @@
 from actionkit.models import *
 from django.conf import settings
-from django.http import HttpResponse
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
 from djangohelpers import rendered_with, allow_http
+import hashlib
 import json
 
-from actionkit_usersearch.models import SearchColumn
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    ## before Django 1.5, a plain response streams an iterator
+    StreamingHttpResponse = HttpResponse
+
+from actionkit_usersearch import autocomplete
+from actionkit_usersearch import choices
+from actionkit_usersearch import dbpool
+from actionkit_usersearch import instrument
+from actionkit_usersearch import replicas
+from actionkit_usersearch.models import AudienceSnapshot, SearchColumn
+from actionkit_usersearch.utils import clamp
+
+def _lookup(sql, params):
+    """runs a lookup query on a read replica, returning its first column"""
+    def run(alias):
+        cursor = connections[alias].cursor()
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+    return replicas.read(run)
 
 @allow_http("GET")
+@instrument.measured
 def campuses(request):
     prefix = request.GET.get('q')
     limit = request.GET.get('limit', '10')
@@ -15,25 +38,29 @@ def campuses(request):
     except ValueError:
         limit = 10
     limit = clamp(limit, 1, 1000)
-    if prefix:
-        cursor = connections['ak'].cursor()
+    autocomplete.campuses.maybe_refresh()
+    if prefix and autocomplete.campuses.ready:
+        index = autocomplete.campuses.index
+        values = (index.prefix(prefix, limit)
+                  or index.substring(prefix, limit))
+    elif prefix:
+        ## the index is still loading
         prefix = prefix + '%'
-        cursor.execute("SELECT distinct value FROM core_userfield "
-                       "WHERE name=\"campus\" and value LIKE %s ORDER BY value LIMIT %s",
-                       [prefix, limit])
-        values = [row[0] for row in cursor.fetchall()]
+        values = _lookup("SELECT distinct value FROM core_userfield "
+                         "WHERE name=\"campus\" and value LIKE %s ORDER BY value LIMIT %s",
+                         [prefix, limit])
         if not values:
             prefix = '%' + prefix
-            cursor.execute("SELECT distinct value FROM core_userfield "
-                           "WHERE name=\"campus\" and value LIKE %s ORDER BY value LIMIT %s",
-                           [prefix, limit])
-            values = [row[0] for row in cursor.fetchall()]
+            values = _lookup("SELECT distinct value FROM core_userfield "
+                             "WHERE name=\"campus\" and value LIKE %s ORDER BY value LIMIT %s",
+                             [prefix, limit])
     else:
         values = []
 
     return HttpResponse(json.dumps(values), content_type='application/json')
 
 @allow_http("GET")
+@instrument.measured
 def sources(request):
     prefix = request.GET.get('q')
     limit = request.GET.get('limit', '10')
@@ -42,70 +69,51 @@ def sources(request):
     except ValueError:
         limit = 10
     limit = clamp(limit, 1, 1000)
-    if prefix:
-        cursor = connections['ak'].cursor()
+    autocomplete.sources.maybe_refresh()
+    if prefix and autocomplete.sources.ready:
+        sources = autocomplete.sources.index.prefix(prefix, limit)
+    elif prefix:
+        ## the index is still loading
         prefix = prefix + '%'
-        cursor.execute("SELECT distinct source FROM core_user "
-                       "WHERE source LIKE %s ORDER BY source LIMIT %s",
-                       [prefix, limit])
-        sources = [row[0] for row in cursor.fetchall()]
+        sources = _lookup("SELECT distinct source FROM core_user "
+                          "WHERE source LIKE %s ORDER BY source LIMIT %s",
+                          [prefix, limit])
     else:
         sources = []
     return HttpResponse(json.dumps(sources), content_type='application/json')
 
 @allow_http("GET")
+@instrument.measured
 def countries(request):
-    countries = CoreUser.objects.using("ak").values_list("country", flat=True).distinct().order_by("country")
-    countries = [(i,i) for i in countries]
-    return HttpResponse(json.dumps(countries),
-                        content_type="application/json")
+    return choices.list_response(request, "countries")
 
 @allow_http("GET")
+@instrument.measured
 def regions(request):
-    countries = request.GET.getlist("country")
-    raw_regions = CoreUser.objects.using("ak").filter(
-        country__in=countries).values(
-        "country", "region").distinct().order_by("country", "region")
-    regions = {}
-    for region in raw_regions:
-        if region['country'] not in regions:
-            regions[region['country']] = []
-        regions[region['country']].append(region['region'])
-    return HttpResponse(json.dumps(regions), 
-                        content_type="application/json")
+    return choices.grouped_response(
+        request, "regions", request.GET.getlist("country"))
 
 @allow_http("GET")
+@instrument.measured
 def states(request):
-    countries = request.GET.getlist("country")
-    raw_states = CoreUser.objects.using("ak").filter(
-        country__in=countries).values(
-        "country", "state").distinct().order_by("country", "state")
-    states = {}
-    for state in raw_states:
-        if state['country'] not in states:
-            states[state['country']] = []
-        states[state['country']].append(state['state'])
-    return HttpResponse(json.dumps(states), 
-                        content_type="application/json")
+    return choices.grouped_response(
+        request, "states", request.GET.getlist("country"))
 
 @allow_http("GET")
+@instrument.measured
 def cities(request):
-    cities = CoreUser.objects.using("ak").values_list("city", flat=True).distinct().order_by("city")
-    cities = [(i,i) for i in cities]
-    return HttpResponse(json.dumps(cities), 
-                        content_type="application/json")
+    return choices.list_response(request, "cities")
 
 @allow_http("GET")
+@instrument.measured
 def pages(request):
-    pages = CorePage.objects.using("ak").all().order_by("title")
-    pages = [(i.id, str(i)) for i in pages]
-    return HttpResponse(json.dumps(pages), 
-                        content_type="application/json")
+    return choices.list_response(request, "pages")
 
 @allow_http("GET")
 @rendered_with("actionkit_usersearch/build_search.html")
 def search(request):
     column_options = SearchColumn.objects.all()
+    snapshots = AudienceSnapshot.objects.defer("data").order_by("-created_at")
 
     """
     tags = CoreTag.objects.using("ak").all().order_by("name")
@@ -149,6 +157,7 @@ def search(request):
              ('more_actions', "More Actions Since"),
              ('donated_more', "Donated Amount More Than"),
              ('donated_times', "Donated Times More Than"),
+             ('snapshot', "In Saved Audience"),
              ),
         'About':
             (('campus', "Campus"),
@@ -164,22 +173,75 @@ def search(request):
 
     return locals()
 
+from actionkit_usersearch import guardrail
+from actionkit_usersearch.counts import count_search
+from actionkit_usersearch.export import csv_stream
 from actionkit_usersearch.search_functions import (build_query, 
+                                                   trace_search,
                                                    _search2)
 
+@allow_http("GET", "POST")
+def count(request):
+    if request.method == "POST":
+        querystring = request.body
+    else:
+        querystring = request.META.get("QUERY_STRING", "")
+    return HttpResponse(json.dumps(count_search(querystring)),
+                        content_type="application/json")
+
+@allow_http("GET", "POST")
+def export(request):
+    ## the export holds every matching member's contact details
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    if request.method == "POST":
+        querystring = request.body
+    else:
+        querystring = request.META.get("QUERY_STRING", "")
+    query = build_query(querystring)
+    response = StreamingHttpResponse(csv_stream(query.raw_sql),
+                                     content_type="text/csv")
+    response['Content-Disposition'] = 'attachment; filename="search-%s.csv"' % (
+        hashlib.sha1(query.raw_sql.encode("utf-8")).hexdigest()[:12])
+    return response
+
+@allow_http("GET")
+def debug(request):
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    trace = trace_search(request.META.get("QUERY_STRING", ""),
+                         explain=request.GET.get("explain", "1") != "0")
+    return HttpResponse(json.dumps({
+                'trace': trace.as_dict(),
+                'views': instrument.view_metrics.snapshot(),
+                'pools': dbpool.metrics(),
+                'replicas': replicas.replica_set.status(),
+                }, indent=2, default=str), content_type="application/json")
+
 @allow_http("POST")
 def create_report(request):
-    # @@TODO
-    """
     if request.GET.get("count_submit"):
-        resp = redirect("search_count")
-        resp['Location'] += "%s" % qsify(request.GET)
-        return resp
-        """
+        return count(request)
 
     query = build_query(request.body)
+    warning = ""
+    if guardrail.guardrail_enabled():
+        assessment = guardrail.assess(query)
+        reasons = "; ".join(assessment.reasons)
+        if assessment.action == guardrail.REJECT:
+            return HttpResponse("This search was not run, because it would put too much load on the ActionKit database: %s" % reasons,
+                                status=400)
+        if assessment.action == guardrail.QUEUE:
+            guardrail.enqueue(query, request.user.email, assessment)
+            return HttpResponse("This search is expensive, so it has been queued to run when the ActionKit database is quieter (%s).  The results will be emailed to %s." % (
+                    reasons, request.user.email))
+        if assessment.action == guardrail.WARN:
+            warning = "  Warning: this search may take a long time to run (%s)." % reasons
     report = _search2(request, query)
+    if report[3]:
+        return HttpResponse("This search is already running for you, so it was not started again.  Its results will be emailed from 'ActionKit Reports' to %s when it finishes.  The subject of the email will be '%s' (sorry!)%s" % (
+                request.user.email, report[1], warning))
 
-    return HttpResponse("If all goes well, an email will be sent from 'ActionKit Reports' to %s shortly.  The subject of the email will be '%s' (sorry!)"  %(
-            request.user.email, report[1]))
+    return HttpResponse("If all goes well, an email will be sent from 'ActionKit Reports' to %s shortly.  The subject of the email will be '%s' (sorry!)%s"  %(
+            request.user.email, report[1], warning))
 
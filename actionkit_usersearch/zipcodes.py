@@ -0,0 +1,201 @@
+"""
+An in-memory index of postal code centroids, loaded from a CSV file with
+`zipcode,latitude,longitude` rows (a header row is optional).
+
+The file is read from the USERSEARCH_ZIPCODE_CSV setting, or from
+data/zipcodes.csv inside this package if that exists.
+"""
+from array import array
+from django.conf import settings
+from math import asin, cos, degrees, floor, radians, sin, sqrt
+import csv
+import os
+import re
+import threading
+
+NAN = float("nan")
+US_ZIPCODE = re.compile(r"^(\d{5})(-?\d{4})?$")
+NUM_US_ZIPCODES = 100000
+EARTH_RADIUS_MILES = 3958.8
+
+def normalize_zipcode(zipcode):
+    """
+    returns the five-digit form of US zip codes (dropping any +4 suffix),
+    and the stripped, uppercased form of anything else
+    """
+    zipcode = zipcode.strip().upper()
+    match = US_ZIPCODE.match(zipcode)
+    if match is not None:
+        return match.group(1)
+    return zipcode
+
+class ZipcodeIndex(object):
+    """
+    Five-digit US zip codes are stored positionally in two flat float
+    arrays, so a lookup is a single array index and the whole US set
+    takes under a megabyte. Any other postal codes go in a dict.
+    """
+
+    def __init__(self):
+        self.latitudes = array("f", [NAN]) * NUM_US_ZIPCODES
+        self.longitudes = array("f", [NAN]) * NUM_US_ZIPCODES
+        self.other = {}
+        self.size = 0
+
+    def add(self, zipcode, lat, lon):
+        zipcode = normalize_zipcode(zipcode)
+        if US_ZIPCODE.match(zipcode):
+            i = int(zipcode)
+            if self.latitudes[i] != self.latitudes[i]:
+                self.size += 1
+            self.latitudes[i] = lat
+            self.longitudes[i] = lon
+        else:
+            if zipcode not in self.other:
+                self.size += 1
+            self.other[zipcode] = (lat, lon)
+
+    def lookup(self, zipcode):
+        """returns (lat, lon) for the zip code, or None if it is unknown"""
+        zipcode = normalize_zipcode(zipcode)
+        if US_ZIPCODE.match(zipcode):
+            i = int(zipcode)
+            lat = self.latitudes[i]
+            if lat != lat:
+                return None
+            return (lat, self.longitudes[i])
+        return self.other.get(zipcode)
+
+    def __iter__(self):
+        """yields (zipcode, lat, lon) for every zip code in the index"""
+        for i in xrange(NUM_US_ZIPCODES):
+            lat = self.latitudes[i]
+            if lat == lat:
+                yield ("%05d" % i, lat, self.longitudes[i])
+        for zipcode, (lat, lon) in self.other.iteritems():
+            yield (zipcode, lat, lon)
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def from_csv(cls, fp):
+        index = cls()
+        for row in csv.reader(fp):
+            if len(row) < 3:
+                continue
+            try:
+                lat, lon = float(row[1]), float(row[2])
+            except ValueError:
+                ## header row
+                continue
+            index.add(row[0], lat, lon)
+        return index
+
+def great_circle_miles(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = (sin((lat2 - lat1) / 2) ** 2
+         + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_MILES * asin(min(1.0, sqrt(a)))
+
+class ZipcodeGrid(object):
+    """
+    A spatial index over the centroids of a ZipcodeIndex, bucketing them
+    into cells of `cell_size` degrees so that a radius search only has to
+    measure the distance to centroids in nearby cells.
+    """
+
+    def __init__(self, index, cell_size=0.25):
+        self.cell_size = cell_size
+        self.num_columns = int(round(360 / cell_size))
+        cells = {}
+        for zipcode, lat, lon in index:
+            cells.setdefault(self.cell(lat, lon), []).append((zipcode, lat, lon))
+        self.cells = cells
+
+    def cell(self, lat, lon):
+        row = int(floor(lat / self.cell_size))
+        column = int(floor((lon + 180) / self.cell_size)) % self.num_columns
+        return (row, column)
+
+    def columns_within(self, lat, lon, miles, lat_lo, lat_hi):
+        """
+        returns the cell columns which a circle of the given radius can
+        reach: all of them if the circle contains a pole, otherwise the
+        exact longitude span of the circle at its widest
+        """
+        angle = miles / EARTH_RADIUS_MILES
+        if lat_lo <= -90 or lat_hi >= 90 or angle >= radians(90 - abs(lat)):
+            return range(self.num_columns)
+        span = degrees(asin(min(1.0, sin(angle) / cos(radians(lat)))))
+        first = int(floor((lon - span + 180) / self.cell_size))
+        last = int(floor((lon + span + 180) / self.cell_size))
+        if last - first + 1 >= self.num_columns:
+            return range(self.num_columns)
+        return [column % self.num_columns for column in range(first, last + 1)]
+
+    def within(self, lat, lon, miles):
+        """
+        returns the zip codes whose centroids lie within `miles` miles
+        (by great-circle distance) of the given point
+        """
+        span = degrees(miles / EARTH_RADIUS_MILES)
+        lat_lo, lat_hi = max(-90.0, lat - span), min(90.0, lat + span)
+        first_row = int(floor(lat_lo / self.cell_size))
+        last_row = int(floor(lat_hi / self.cell_size))
+        columns = self.columns_within(lat, lon, miles, lat_lo, lat_hi)
+        cells = self.cells
+        found = []
+        for row in xrange(first_row, last_row + 1):
+            for column in columns:
+                for zipcode, zlat, zlon in cells.get((row, column), ()):
+                    if great_circle_miles(lat, lon, zlat, zlon) <= miles:
+                        found.append(zipcode)
+        return found
+
+def zipcode_csv_path():
+    path = getattr(settings, 'USERSEARCH_ZIPCODE_CSV', None)
+    if path is None:
+        path = os.path.join(os.path.dirname(__file__), "data", "zipcodes.csv")
+    return path
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_index():
+    """
+    returns the process-wide zip code index, loading it on first use;
+    the index is empty if no CSV file is available
+    """
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                path = zipcode_csv_path()
+                if os.path.exists(path):
+                    with open(path, "rb") as fp:
+                        _index = ZipcodeIndex.from_csv(fp)
+                else:
+                    _index = ZipcodeIndex()
+    return _index
+
+_grid = None
+
+def get_grid():
+    """returns the process-wide spatial index over get_index()"""
+    global _grid
+    if _grid is None:
+        index = get_index()
+        with _index_lock:
+            if _grid is None:
+                _grid = ZipcodeGrid(index)
+    return _grid
+
+def zipcodes_within(lat, lon, miles):
+    """
+    returns the known zip codes within `miles` of the point, or None if
+    there is no local zip code index to answer from
+    """
+    if not len(get_index()):
+        return None
+    return get_grid().within(lat, lon, miles)